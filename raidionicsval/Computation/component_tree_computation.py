@@ -0,0 +1,130 @@
+import numpy as np
+from scipy.ndimage import label
+
+from ..Computation.cropping_computation import compute_union_bounding_box
+from ..Validation.instance_segmentation_validation import label_objects, select_one_to_one_pairs,\
+    compute_instance_detection_results
+
+
+class ProbabilityComponentTree:
+    """
+    Component tree of a probability map over a set of probability thresholds, where the nodes at level k are the
+    connected components of the detection binarized at the k-th lowest threshold, and the parent of each node is the
+    component containing it at the previous level.
+    The thresholded detections being nested, the tree is built in a single sweep where each level is only labeled
+    within the bounding box of the previous one, and the detection objects for every threshold, with their size and
+    overlap with the ground truth objects, are then directly read off the tree. The objects are identical (including
+    their label ordering) to the ones obtained with a connected components analysis of each binarized detection.
+    """
+    def __init__(self, probabilities, thresholds, gt_labels=None):
+        """
+        :param probabilities: prediction array with values in [0., 1.].
+        :param thresholds: list of probability thresholds (float), in any order.
+        :param gt_labels: (optional) labeled ground truth objects, to accumulate the overlap with each detection object.
+        """
+        self.thresholds = np.asarray(thresholds, dtype='float64')
+        self.sorted_thresholds = np.sort(self.thresholds)
+        levels = np.searchsorted(self.sorted_thresholds, np.asarray(probabilities), side='right')
+        levels = levels.astype(np.uint16 if len(self.thresholds) < 2**16 else np.uint32)
+        self.__build(levels, gt_labels)
+
+    def __build(self, levels, gt_labels):
+        node_levels = []
+        node_parents = []
+        node_areas = []
+        pairs = []
+        nb_nodes = 0
+        previous_nb_nodes = 0
+        previous_labels = None
+        previous_box = None
+        box = tuple([slice(0, x) for x in levels.shape])
+        for level in range(1, len(self.thresholds) + 1):
+            # The foreground at the current level is included in the foreground at the previous level.
+            sub_box = compute_union_bounding_box([levels[box] >= level], margin=0)
+            if sub_box is None:
+                break
+            box = tuple([slice(x.start + y.start, x.start + y.stop) for x, y in zip(box, sub_box)])
+            labels, nb_labels = label(levels[box] >= level)
+            flat_labels = labels.ravel()
+
+            node_levels.append(np.full(nb_labels, level, dtype=np.int64))
+            node_areas.append(np.bincount(flat_labels, minlength=nb_labels + 1)[1:].astype(np.int64))
+            if previous_labels is None:
+                node_parents.append(np.full(nb_labels, -1, dtype=np.int64))
+            else:
+                # Each component lies within a single component of the previous level, given by any of its voxels.
+                parent_box = tuple([slice(x.start - y.start, x.stop - y.start) for x, y in zip(box, previous_box)])
+                parent_labels = np.zeros(nb_labels + 1, dtype=np.int64)
+                parent_labels[flat_labels] = previous_labels[parent_box].ravel()
+                node_parents.append(previous_nb_nodes + parent_labels[1:] - 1)
+
+            if gt_labels is not None:
+                gt_values = gt_labels[box].ravel()
+                overlap = (flat_labels != 0) & (gt_values != 0)
+                nb_gt_labels = int(np.max(gt_values)) + 1 if np.count_nonzero(overlap) != 0 else 1
+                pair_ids, counts = np.unique(flat_labels[overlap].astype(np.int64) * nb_gt_labels +
+                                             gt_values[overlap].astype(np.int64), return_counts=True)
+                pairs.append((nb_nodes + (pair_ids // nb_gt_labels) - 1, pair_ids % nb_gt_labels, counts))
+
+            previous_nb_nodes = nb_nodes
+            nb_nodes += nb_labels
+            previous_labels = labels
+            previous_box = box
+
+        self.node_levels = np.concatenate(node_levels) if len(node_levels) != 0 else np.zeros(0, dtype=np.int64)
+        self.node_parents = np.concatenate(node_parents) if len(node_parents) != 0 else np.zeros(0, dtype=np.int64)
+        self.node_areas = np.concatenate(node_areas) if len(node_areas) != 0 else np.zeros(0, dtype=np.int64)
+        self.pair_nodes = np.concatenate([x[0] for x in pairs]) if len(pairs) != 0 else np.zeros(0, dtype=np.int64)
+        self.pair_gt_values = np.concatenate([x[1] for x in pairs]) if len(pairs) != 0 else np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.concatenate([x[2] for x in pairs]) if len(pairs) != 0 else np.zeros(0, dtype=np.int64)
+
+    def get_threshold_objects(self, threshold_index, min_size=0):
+        """
+        Detection objects obtained when binarizing the probability map at the given threshold.
+        :param threshold_index: index of the threshold in the list given upon creation.
+        :param min_size: minimum number of voxels for an object to be kept.
+        :return: np.ndarray with the tree nodes of the objects, ordered as their labels would be.
+        """
+        level = int(np.searchsorted(self.sorted_thresholds, self.thresholds[threshold_index], side='right'))
+        return np.flatnonzero((self.node_levels == level) & (self.node_areas >= min_size))
+
+
+def compute_thresholded_objectwise_results(gt, probabilities, thresholds, min_size=0, object_matching='many-to-many'):
+    """
+    Object-wise metrics for all probability thresholds from a single component tree of the probability map, identical
+    to running InstanceSegmentationValidation on the detection binarized at each threshold.
+    :param gt: binary ground truth array.
+    :param probabilities: prediction array with the same shape as gt, with values in [0., 1.].
+    :param thresholds: list of probability thresholds (float), in any order.
+    :param min_size: minimum number of voxels for an object to be kept, in both the ground truth and detections.
+    :param object_matching: strategy for pairing the objects, from [many-to-many, one-to-one].
+    :return: list, for each threshold in the input order, with [Dice, Recall, Precision, F1, Largest Focus Dice,
+    number of ground truth objects, number of detection objects].
+    """
+    gt_labels, gt_candidates = label_objects(gt, min_size)
+    gt_areas = np.asarray([x.area for x in gt_candidates], dtype=np.int64)
+    tree = ProbabilityComponentTree(probabilities, thresholds, gt_labels=gt_labels)
+
+    results = []
+    for t in range(len(thresholds)):
+        objects = tree.get_threshold_objects(t, min_size=min_size)
+        detection_labels = np.zeros(len(tree.node_areas), dtype=np.int64)
+        detection_labels[objects] = np.arange(1, len(objects) + 1)
+
+        matching_results = []
+        if len(objects) != 0 and len(gt_areas) != 0:
+            kept = detection_labels[tree.pair_nodes] != 0
+            gt_values = tree.pair_gt_values[kept]
+            det_values = detection_labels[tree.pair_nodes[kept]]
+            counts = tree.pair_counts[kept]
+            order = np.lexsort((det_values, gt_values))
+            gt_values, det_values, counts = gt_values[order], det_values[order], counts[order]
+            dices = counts * 2.0 / (gt_areas[gt_values - 1] + tree.node_areas[objects][det_values - 1])
+            if object_matching == 'one-to-one' and len(dices) != 0:
+                selection = select_one_to_one_pairs(gt_values, det_values, dices)
+                gt_values, det_values, dices = gt_values[selection], det_values[selection], dices[selection]
+            matching_results = [[int(g), int(d), dice] for g, d, dice in zip(gt_values, det_values, dices)]
+
+        results.append(compute_instance_detection_results(matching_results, list(gt_areas), len(objects)) +
+                       [len(gt_areas), len(objects)])
+    return results
@@ -0,0 +1,142 @@
+import numpy as np
+
+
+def compute_thresholded_confusion_counts(gt, probabilities, thresholds, chunk_size=2**22):
+    """
+    Compute the voxel-wise confusion counts (TP, FP, FN, TN) for all probability thresholds in a single pass over
+    the volume. A histogram of the probabilities is built separately inside and outside the ground truth mask, using
+    the thresholds as bin edges, and the counts for each threshold are then read off from the reversed cumulative sums.
+    A voxel is considered as detected at threshold t when its probability is >= t, identical to the binarization
+    performed in separate_dice_computation.
+    :param gt: binary ground truth array.
+    :param probabilities: prediction array with the same shape as gt, with values in [0., 1.].
+    :param thresholds: list of probability thresholds (float), in any order.
+    :param chunk_size: number of voxels processed at once, to keep the memory footprint bounded.
+    :return: four np.ndarray (int64) with the TP, FP, FN, and TN counts for each threshold, in the input order.
+    """
+    thresholds = np.asarray(thresholds, dtype='float64')
+    order = np.argsort(thresholds, kind='stable')
+    sorted_thresholds = thresholds[order]
+    nb_bins = len(thresholds) + 1
+
+    gt_flat = np.ravel(gt)
+    probabilities_flat = np.ravel(probabilities)
+    if gt_flat.size != probabilities_flat.size:
+        raise ValueError('The ground truth and probability arrays must have the same number of voxels.')
+
+    inside_histogram = np.zeros(nb_bins, dtype=np.int64)
+    outside_histogram = np.zeros(nb_bins, dtype=np.int64)
+    for start in range(0, probabilities_flat.size, chunk_size):
+        # Bin index k means that exactly k thresholds are lower or equal to the voxel probability.
+        bins = np.searchsorted(sorted_thresholds, probabilities_flat[start:start + chunk_size], side='right')
+        inside = gt_flat[start:start + chunk_size] != 0
+        inside_histogram += np.bincount(bins[inside], minlength=nb_bins)
+        outside_histogram += np.bincount(bins[~inside], minlength=nb_bins)
+
+    # A voxel is positive at the j-th sorted threshold if its bin index is strictly above j.
+    tp_sorted = np.cumsum(inside_histogram[::-1])[::-1][1:]
+    fp_sorted = np.cumsum(outside_histogram[::-1])[::-1][1:]
+
+    tp = np.zeros(len(thresholds), dtype=np.int64)
+    fp = np.zeros(len(thresholds), dtype=np.int64)
+    tp[order] = tp_sorted
+    fp[order] = fp_sorted
+    fn = inside_histogram.sum() - tp
+    tn = outside_histogram.sum() - fp
+
+    return tp, fp, fn, tn
+
+
+def compute_pixelwise_metrics_from_counts(tp, fp, fn):
+    """
+    Pixel-wise Dice, recall, precision, and F1-score from the confusion counts, matching the values obtained from the
+    binary volumes.
+    :return: list with [dice, recall, precision, f1].
+    """
+    dice = 0.
+    if tp != 0:
+        dice = (tp * 2.0) / ((tp + fn) + (tp + fp))
+    recall = tp / (tp + fn + 1e-6)
+    precision = tp / (tp + fp + 1e-6)
+    f1 = 2 * tp / ((2 * tp) + fp + fn + 1e-6)
+
+    return [dice, recall, precision, f1]
+
+
+def compute_probability_histograms(gt, probabilities, nb_bins=1000, chunk_size=2**22):
+    """
+    Histograms of the prediction probabilities inside and outside the ground truth mask, over nb_bins equally-sized
+    bins covering [0., 1.]. The histograms from different patients can be summed to obtain cohort-level curves.
+    :param gt: binary ground truth array.
+    :param probabilities: prediction array with the same shape as gt, with values in [0., 1.].
+    :param nb_bins: number of bins, probabilities falling in the same bin are considered as ties.
+    :param chunk_size: number of voxels processed at once, to keep the memory footprint bounded.
+    :return: two np.ndarray (int64) with the histograms of the positive and negative voxels.
+    """
+    gt_flat = np.ravel(gt)
+    probabilities_flat = np.ravel(probabilities)
+    if gt_flat.size != probabilities_flat.size:
+        raise ValueError('The ground truth and probability arrays must have the same number of voxels.')
+
+    inside_histogram = np.zeros(nb_bins, dtype=np.int64)
+    outside_histogram = np.zeros(nb_bins, dtype=np.int64)
+    for start in range(0, probabilities_flat.size, chunk_size):
+        chunk = np.asarray(probabilities_flat[start:start + chunk_size], dtype='float64')
+        bins = np.clip((chunk * nb_bins).astype(np.int64), 0, nb_bins - 1)
+        inside = gt_flat[start:start + chunk_size] != 0
+        inside_histogram += np.bincount(bins[inside], minlength=nb_bins)
+        outside_histogram += np.bincount(bins[~inside], minlength=nb_bins)
+
+    return inside_histogram, outside_histogram
+
+
+def compute_roc_auc_from_histograms(inside_histogram, outside_histogram):
+    """
+    Area under the ROC curve from the probability histograms, computed as the Mann-Whitney rank statistic, i.e.,
+    the probability for a positive voxel to have a higher probability than a negative voxel, with ties counting half.
+    :return: the ROC-AUC value, or np.inf if either class is absent.
+    """
+    positives = float(np.sum(inside_histogram))
+    negatives = float(np.sum(outside_histogram))
+    if positives == 0 or negatives == 0:
+        return np.inf
+
+    inside_histogram = np.asarray(inside_histogram, dtype='float64')
+    outside_histogram = np.asarray(outside_histogram, dtype='float64')
+    negatives_below = np.cumsum(outside_histogram) - outside_histogram
+    wins = np.sum(inside_histogram * (negatives_below + (0.5 * outside_histogram)))
+    return float(wins / (positives * negatives))
+
+
+def compute_average_precision_from_histograms(inside_histogram, outside_histogram):
+    """
+    Average precision (area under the precision-recall curve as a step function) from the probability histograms,
+    using each bin as an operating point from the highest to the lowest probability.
+    :return: the average precision value, or np.inf if there is no positive voxel.
+    """
+    positives = float(np.sum(inside_histogram))
+    if positives == 0:
+        return np.inf
+
+    tp = np.cumsum(np.asarray(inside_histogram, dtype='float64')[::-1])
+    fp = np.cumsum(np.asarray(outside_histogram, dtype='float64')[::-1])
+    recall_increments = np.diff(np.concatenate(([0.], tp / positives)))
+    valid = (tp + fp) != 0
+    return float(np.sum(recall_increments[valid] * (tp[valid] / (tp[valid] + fp[valid]))))
+
+
+def compute_probability_curves_from_histograms(inside_histogram, outside_histogram):
+    """
+    ROC and precision-recall curves from the probability histograms, with one operating point per bin lower edge.
+    :return: pd.DataFrame-ready dictionary with the Threshold, FPR, TPR (Recall), and Precision values.
+    """
+    nb_bins = len(inside_histogram)
+    tp = np.cumsum(np.asarray(inside_histogram, dtype='float64')[::-1])[::-1]
+    fp = np.cumsum(np.asarray(outside_histogram, dtype='float64')[::-1])[::-1]
+    positives = tp[0] if tp[0] != 0 else np.nan
+    negatives = fp[0] if fp[0] != 0 else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where((tp + fp) != 0, tp / (tp + fp), 1.)
+    curves = {'Threshold': np.arange(nb_bins) / nb_bins, 'FPR': fp / negatives, 'TPR': tp / positives,
+              'Precision': precision}
+    return curves
@@ -0,0 +1,29 @@
+import numpy as np
+from typing import List
+
+
+def compute_union_bounding_box(volumes: List[np.ndarray], margin: int = 1):
+    """
+    Bounding box enclosing the non-zero voxels of all the given volumes (e.g., ground truth and detection), enlarged
+    by a margin on each side and clipped to the volume extent. Cropping to this box does not alter any voxel-level
+    metric as long as the margin is of at least one voxel: the removed voxels are all true negatives, and the crop
+    keeps a layer of background around the objects for the distance transforms and morphological operations.
+    :param volumes: list of arrays with identical shapes.
+    :param margin: number of voxels added on each side of the box.
+    :return: tuple of slices to crop the volumes with, or None if all volumes are empty.
+    """
+    union = np.zeros(volumes[0].shape, dtype=bool)
+    for v in volumes:
+        if v.shape != union.shape:
+            raise ValueError('All volumes must have the same shape to compute their union bounding box.')
+        union |= (v != 0)
+
+    crop = []
+    for axis in range(union.ndim):
+        projection = np.any(union, axis=tuple(x for x in range(union.ndim) if x != axis))
+        indices = np.flatnonzero(projection)
+        if len(indices) == 0:
+            return None
+        crop.append(slice(max(indices[0] - margin, 0), min(indices[-1] + margin + 1, union.shape[axis])))
+
+    return tuple(crop)
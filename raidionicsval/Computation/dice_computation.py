@@ -1,9 +1,16 @@
 import numpy as np
+import itertools
 import traceback
-from copy import deepcopy
 
 from raidionicsval.Utils.resources import SharedResources
+from raidionicsval.Utils.io_converters import ClassVolumes
+from raidionicsval.Utils.shared_volumes import get_volume_array, share_volume, release_volume
+from raidionicsval.Utils.parallel_backend import get_parallel_backend, create_pool
 from raidionicsval.Validation.instance_segmentation_validation import InstanceSegmentationValidation
+from raidionicsval.Computation.confusion_computation import compute_pixelwise_metrics_from_counts, \
+    compute_thresholded_confusion_counts, compute_probability_histograms
+from raidionicsval.Computation.component_tree_computation import compute_thresholded_objectwise_results
+from raidionicsval.Validation.extra_metrics_computation import PROBABILITY_BASED_METRICS
 
 
 def compute_dice(volume1, volume2):
@@ -21,21 +28,40 @@ def compute_dice_uncertain(volume1, volume2, epsilon=0.1):
 def separate_dice_computation(args):
     """
     Dice computation method linked to the multiprocessing strategy. Effectively where the call to compute is made.
-    :param args: list of arguments split from the lists given to the multiprocessing.Pool call.
+    :param args: list of arguments split from the lists given to the multiprocessing.Pool call. The optional seventh
+    argument holds the [TP, FP, FN, TN] voxel counts at the given threshold, as precomputed for all thresholds at
+    once with compute_thresholded_confusion_counts. When provided, the prediction is only binarized if the object-wise
+    metrics have to be computed. The optional eighth argument holds the prediction probabilities cropped to the same
+    region as the ground truth (see compute_union_bounding_box), in which case the voxels outside of the region are
+    considered as true negatives. The optional ninth argument holds the object-wise results at the given threshold, as
+    precomputed for all thresholds at once with compute_thresholded_objectwise_results, in which case the prediction
+    is not binarized anymore. The ground truth and probabilities can be given as SharedVolume, to avoid pickling them
+    for every task when using a pool of processes.
     :return: list with the computed results for the current patient, at the given probability threshold.
     """
-    t = np.round(args[0], 2)
+    t = np.round(args[0], 4)
     fold_number = args[1]
-    gt = args[2]
+    gt = get_volume_array(args[2])
     detection_ni = args[3]
     patient_id = args[4]
     volumes_extra = args[5]
+    confusion_counts = args[6] if len(args) > 6 else None
+    probabilities = get_volume_array(args[7]) if len(args) > 7 and args[7] is not None else\
+        np.asanyarray(detection_ni.dataobj)
+    objectwise_results = args[8] if len(args) > 8 else None
     results = []
 
-    detection = deepcopy(detection_ni.get_fdata())
-    detection[detection < t] = 0
-    detection[detection >= t] = 1
-    detection = detection.astype('uint8')
+    detection = None
+    if confusion_counts is None or ("objectwise" in SharedResources.getInstance().validation_metric_spaces and
+                                    objectwise_results is None):
+        detection = (probabilities >= t).astype('uint8')
+    if confusion_counts is None:
+        tp = np.count_nonzero((gt == 1) & (detection == 1))
+        fp = np.count_nonzero((gt == 0) & (detection == 1))
+        fn = np.count_nonzero((gt == 1) & (detection == 0))
+        tn = int(np.prod(detection_ni.shape)) - tp - fp - fn
+    else:
+        tp, fp, fn, tn = confusion_counts
 
     # # Cleaning the too small objects that might be noise in the detection
     # if np.count_nonzero(detection) > 0:
@@ -50,42 +76,129 @@ def separate_dice_computation(args):
 
     pixelwise_results = [-1., -1., -1., -1.]
     if "pixelwise" in SharedResources.getInstance().validation_metric_spaces:
-        pixelwise_results = __pixelwise_computation(gt, detection)
-
-    det_volume = np.round(np.count_nonzero(detection) * np.prod(detection_ni.header.get_zooms()) * 1e-3, 4)
-
-    obj_val = InstanceSegmentationValidation(gt_image=gt, detection_image=detection)
-    if "objectwise" in SharedResources.getInstance().validation_metric_spaces:
-        try:
-            # obj_val.set_trace_parameters(self.output_folder, fold_number, patient, t)
-            obj_val.spacing = detection_ni.header.get_zooms()
-            obj_val.run()
-        except Exception as e:
-            print('Issue computing instance segmentation parameters for patient {}'.format(patient_id))
-            print(traceback.format_exc())
-    instance_results = obj_val.instance_detection_results
+        pixelwise_results = compute_pixelwise_metrics_from_counts(tp, fp, fn)
+
+    det_volume = np.round(int(tp + fp) * np.prod(detection_ni.header.get_zooms()) * 1e-3, 4)
+
+    if objectwise_results is not None:
+        instance_results = list(objectwise_results[:5])
+        nb_objects = list(objectwise_results[5:7])
+    else:
+        obj_val = InstanceSegmentationValidation(gt_image=gt, detection_image=detection)
+        if "objectwise" in SharedResources.getInstance().validation_metric_spaces:
+            try:
+                # obj_val.set_trace_parameters(self.output_folder, fold_number, patient, t)
+                obj_val.spacing = detection_ni.header.get_zooms()
+                obj_val.run()
+            except Exception as e:
+                print('Issue computing instance segmentation parameters for patient {}'.format(patient_id))
+                print(traceback.format_exc())
+        instance_results = obj_val.instance_detection_results
+        nb_objects = [len(obj_val.gt_candidates), len(obj_val.detection_candidates)]
 
     results.append([fold_number, patient_id, t] + pixelwise_results + volumes_extra +
-                   [det_volume] + instance_results + [len(obj_val.gt_candidates), len(obj_val.detection_candidates)])
+                   [det_volume] + instance_results + nb_objects)
 
     return results
 
 
-def __pixelwise_computation(gt, detection):
-    dice = compute_dice(gt, detection)
-
-    tp_array = np.zeros(detection.shape)
-    fp_array = np.zeros(detection.shape)
-    tn_array = np.zeros(detection.shape)
-    fn_array = np.zeros(detection.shape)
-
-    tp_array[(gt == 1) & (detection == 1)] = 1
-    fp_array[(gt == 0) & (detection == 1)] = 1
-    tn_array[(gt == 0) & (detection == 0)] = 1
-    fn_array[(gt == 1) & (detection == 0)] = 1
-
-    recall = np.sum(tp_array) / (np.sum(tp_array) + np.sum(fn_array) + 1e-6)
-    precision = np.sum(tp_array) / (np.sum(tp_array) + np.sum(fp_array) + 1e-6)
-    f1 = 2 * np.sum(tp_array) / ((2 * np.sum(tp_array)) + np.sum(fp_array) + np.sum(fn_array) + 1e-6)
-
-    return [dice, recall, precision, f1]
+def compute_patient_dice_scores(args):
+    """
+    Computation of the basic metrics for all classes of one patient, for the given probability thresholds, linked to
+    the multiprocessing strategy dispatching whole patients to the processes.
+    :param args: list with the patient unique id, the patient id, the fold number, the list of [ground truth,
+    prediction] filenames for each class, the probability thresholds, and the number of processes to use for computing
+    the thresholds in parallel (only 1 when the function is itself running in a process from a pool). The optional
+    seventh argument holds the ClassVolumes already loaded for each class (e.g., by a VolumesPrefetcher).
+    :return: list with, for each class, the results from separate_dice_computation for each threshold, the probability
+    histograms (if needed for the extra metrics), and the cropped ClassVolumes (if extra metrics are to be computed),
+    or None if the computation failed.
+    """
+    unique_id = args[0]
+    uid = args[1]
+    fold_number = args[2]
+    classes_filenames = args[3]
+    thr_range = np.round(np.asarray(args[4], dtype='float64'), 4)
+    number_processes = args[5]
+    preloaded_volumes = args[6] if len(args) > 6 else None
+
+    try:
+        classes_results = []
+        for c, (gt_filename, det_filename) in enumerate(classes_filenames):
+            # The volumes are loaded once in a compact form, and kept for the extra metrics computation if needed
+            volumes = preloaded_volumes[c] if preloaded_volumes is not None else \
+                ClassVolumes(gt_filename, det_filename,
+                             dtype=SharedResources.getInstance().validation_probability_dtype)
+            ground_truth_ni = volumes.ground_truth_ni
+            detection_ni = volumes.detection_ni
+            gt = volumes.gt
+
+            class_tp_threshold = SharedResources.getInstance().validation_true_positive_volume_thresholds[c]
+            gt_volume = np.count_nonzero(gt) * np.prod(ground_truth_ni.header.get_zooms()) * 1e-3
+            tp_state = True if gt_volume > class_tp_threshold else False
+            extra = [np.round(gt_volume, 4), tp_state]
+
+            # Voxel-wise counts for all thresholds at once, from a single pass over the prediction
+            probabilities = volumes.probabilities
+            tp, fp, fn, tn = compute_thresholded_confusion_counts(gt, probabilities, thr_range)
+            thr_counts = [[tp[x], fp[x], fn[x], tn[x]] for x in range(len(thr_range))]
+            probability_histograms = None
+            if len([x for x in SharedResources.getInstance().validation_metric_names if x in PROBABILITY_BASED_METRICS]) != 0:
+                probability_histograms = compute_probability_histograms(gt, probabilities)
+
+            # The object-wise analysis is restricted to the region containing the ground truth and the detection at
+            # the lowest threshold, which encloses the detections at all other thresholds.
+            volumes.crop(np.min(thr_range), margin=SharedResources.getInstance().validation_crop_margin)
+            gt = volumes.gt
+            probabilities = volumes.probabilities
+
+            # Object-wise results for all thresholds at once, read off a single component tree of the probabilities
+            thr_objects = [None] * len(thr_range)
+            if "objectwise" in SharedResources.getInstance().validation_metric_spaces and \
+                    SharedResources.getInstance().validation_objectwise_strategy == 'component-tree':
+                try:
+                    thr_objects = compute_thresholded_objectwise_results(
+                        gt, probabilities, thr_range,
+                        min_size=SharedResources.getInstance().validation_tiny_objects_removal_threshold,
+                        object_matching=SharedResources.getInstance().validation_object_matching)
+                except Exception as e:
+                    print('Issue computing the component tree for patient {}, falling back to per-threshold'
+                          ' object-wise computation.'.format(uid))
+                    print(traceback.format_exc())
+            pat_results = []
+            if number_processes > 1 and get_parallel_backend() != 'serial':
+                # The volumes are placed once in shared memory for processes, while threads directly share them
+                shared_gt = share_volume(gt, get_parallel_backend())
+                shared_probabilities = share_volume(probabilities, get_parallel_backend())
+                try:
+                    pool = create_pool(processes=number_processes)
+                    pat_results = pool.map(separate_dice_computation, zip(thr_range,
+                                                                          itertools.repeat(fold_number),
+                                                                          itertools.repeat(shared_gt),
+                                                                          itertools.repeat(detection_ni),
+                                                                          itertools.repeat(uid),
+                                                                          itertools.repeat(extra),
+                                                                          thr_counts,
+                                                                          itertools.repeat(shared_probabilities),
+                                                                          thr_objects
+                                                                          )
+                                           )
+                    pool.close()
+                    pool.join()
+                finally:
+                    release_volume(shared_gt)
+                    release_volume(shared_probabilities)
+            else:
+                for thr_value, counts, objects in zip(thr_range, thr_counts, thr_objects):
+                    thr_res = separate_dice_computation([thr_value, fold_number, gt, detection_ni, uid, extra,
+                                                         counts, probabilities, objects])
+                    pat_results.append(thr_res)
+
+            if len(SharedResources.getInstance().validation_metric_names) == 0:
+                volumes = None
+            classes_results.append([pat_results, probability_histograms, volumes])
+    except Exception as e:
+        print('Issue processing patient {}\n'.format(unique_id))
+        print(traceback.format_exc())
+        return None
+    return classes_results
@@ -3,8 +3,9 @@ import traceback
 import numpy as np
 from typing import Tuple
 from scipy.stats import pearsonr
-from scipy.ndimage import _ni_support, label, find_objects, distance_transform_edt
-from scipy.ndimage.morphology import distance_transform_edt, binary_erosion, generate_binary_structure
+from scipy.spatial import cKDTree
+from scipy.ndimage import _ni_support, label, find_objects, distance_transform_edt, binary_erosion, binary_dilation,\
+    generate_binary_structure
 
 """
 The MedPy library has not been updated since 2019 and no recent package has been produced as of yet
@@ -12,13 +13,24 @@ The MedPy library has not been updated since 2019 and no recent package has been
 Sampling the code for some of the metrics to continue supporting here (https://github.com/loli/medpy)
 """
 
+# Relative cost of the distance transform per voxel against the KD-tree per point (and per tree level), used to
+# select the backend for computing the distances.
+KDTREE_COST_RATIO = 0.05
 
-def compute_volume_correlation(results, references):
+
+def compute_volume_correlation(results, references, nb_slices=None):
+    """
+    Pearson correlation between the volumes of the slices (along the first axis) of the two arrays.
+    :param nb_slices: total number of slices when the arrays have been cropped, the missing slices being empty.
+    """
     results = np.atleast_2d(np.array(results).astype(np.bool_))
     references = np.atleast_2d(np.array(references).astype(np.bool_))
 
     results_volumes = [np.count_nonzero(r) for r in results]
     references_volumes = [np.count_nonzero(r) for r in references]
+    if nb_slices is not None and nb_slices > len(results_volumes):
+        results_volumes.extend([0] * (nb_slices - len(results_volumes)))
+        references_volumes.extend([0] * (nb_slices - len(references_volumes)))
 
     return pearsonr(results_volumes, references_volumes)
 
@@ -37,10 +49,8 @@ def compute_ravd(result, reference):
 
 
 def compute_hd95(reference, result, voxelspacing=None, connectivity=1):
-    hd1 = __surface_distances(result, reference, voxelspacing, connectivity)
-    hd2 = __surface_distances(reference, result, voxelspacing, connectivity)
-    hd95 = np.percentile(np.hstack((hd1, hd2)), 95)
-    return hd95
+    return SurfaceDistances(result, reference, voxelspacing=voxelspacing,
+                            connectivity=connectivity).hausdorff_distance(percentile=95)
 
 
 def compute_assd(volume1, volume2, voxel_spacing=(1, 1, 1)):
@@ -55,30 +65,13 @@ def compute_assd(volume1, volume2, voxel_spacing=(1, 1, 1)):
     Returns:
     - Average symmetric surface distance.
     """
-    # Ensure volumes are binary masks
-    volume1 = np.asarray(volume1).astype(bool)
-    volume2 = np.asarray(volume2).astype(bool)
-
-    # Compute the distance transform for both volumes
-    dist_transform1 = distance_transform_edt(volume1, sampling=voxel_spacing)
-    dist_transform2 = distance_transform_edt(volume2, sampling=voxel_spacing)
-
-    # Compute the surface distances
-    surface_distances_1_to_2 = dist_transform1[volume2]
-    surface_distances_2_to_1 = dist_transform2[volume1]
-
-    # Combine distances from both volumes
-    all_surface_distances = np.concatenate([surface_distances_1_to_2, surface_distances_2_to_1])
-
-    # Compute the average symmetric surface distance
-    average_symmetric_surface_distance = np.mean(all_surface_distances)
-
-    return average_symmetric_surface_distance
+    return SurfaceDistances(volume1, volume2, voxelspacing=voxel_spacing).average_symmetric_distance()
 
 
 def compute_object_assd(volume1, volume2, voxel_spacing=(1, 1, 1)):
     """
     Compute Object-wise Average Symmetric Surface Distance (oASD) between two 3D volumes.
+    The volumes being converted to binary masks, the foreground is the only object and the oASD is equal to the ASSD.
 
     Parameters:
     - volume1: Binary mask of the first volume (numpy array).
@@ -88,57 +81,101 @@ def compute_object_assd(volume1, volume2, voxel_spacing=(1, 1, 1)):
     Returns:
     - oASD: Object-wise Average Symmetric Surface Distance.
     """
+    # Ensure input volumes have the same shape
+    if volume1.shape != volume2.shape:
+        raise ValueError("Input volumes must have the same shape.")
 
-    def surface_distances(mask1, mask2, voxel_spacing):
+    return SurfaceDistances(volume1, volume2, voxelspacing=voxel_spacing).average_symmetric_distance()
+
+
+class SurfaceDistances:
+    """
+    Distances between two binary volumes, shared by all the distance-based metrics (i.e., Hausdorff distance
+    percentiles, ASSD, OASSD, and surface Dice). The borders and distance transforms are only computed upon first
+    request, and then reused for all subsequent metrics.
+    """
+    def __init__(self, result, reference, voxelspacing=None, connectivity=1, backend='auto'):
+        self._result = np.atleast_1d(np.asarray(result).astype(np.bool_))
+        self._reference = np.atleast_1d(np.asarray(reference).astype(np.bool_))
+        if self._result.shape != self._reference.shape:
+            raise ValueError("Input volumes must have the same shape.")
+        self._voxelspacing = None
+        if voxelspacing is not None:
+            self._voxelspacing = np.asarray(_ni_support._normalize_sequence(voxelspacing, self._result.ndim),
+                                            dtype=np.float64)
+        self._connectivity = connectivity
+        self._backend = backend
+        self._result_surface_distances = None
+        self._reference_surface_distances = None
+        self._result_volume_distances = None
+        self._reference_volume_distances = None
+
+    @property
+    def result_surface_distances(self) -> np.ndarray:
         """
-        Compute surface distances between two binary masks.
+        Distances from the border voxels of the result to the nearest border voxel of the reference.
         """
-        distances = distance_transform_edt(mask1, sampling=voxel_spacing) * mask2
-        surface_distances = distances[mask2 == 1]
-        return surface_distances
+        if self._result_surface_distances is None:
+            self._result_surface_distances = _surface_distances(self._result, self._reference, self._voxelspacing,
+                                                                self._connectivity, backend=self._backend)
+        return self._result_surface_distances
 
-    def compute_ASD(mask1, mask2, voxel_spacing):
+    @property
+    def reference_surface_distances(self) -> np.ndarray:
         """
-        Compute Average Symmetric Surface Distance (ASD) between two binary masks.
+        Distances from the border voxels of the reference to the nearest border voxel of the result.
         """
-        distances1 = surface_distances(mask1, mask2, voxel_spacing)
-        distances2 = surface_distances(mask2, mask1, voxel_spacing)
-        distances = np.concatenate([distances1, distances2])
-        ASD = np.mean(distances)
-        return ASD
-
-    # Ensure input volumes have the same shape
-    if volume1.shape != volume2.shape:
-        raise ValueError("Input volumes must have the same shape.")
-
-    # Convert volumes to binary masks
-    mask1 = np.asarray(volume1, dtype=bool)
-    mask2 = np.asarray(volume2, dtype=bool)
-
-    # Compute ASD for each object in the volumes
-    unique_objects = np.unique(np.concatenate([mask1, mask2]))
-    oASD_values = []
+        if self._reference_surface_distances is None:
+            self._reference_surface_distances = _surface_distances(self._reference, self._result, self._voxelspacing,
+                                                                   self._connectivity, backend=self._backend)
+        return self._reference_surface_distances
 
-    for obj_label in unique_objects:
-        if obj_label == 0:  # Skip background
-            continue
+    @property
+    def result_volume_distances(self) -> np.ndarray:
+        """
+        Distances from the voxels of the result to the background of the reference (zero outside the reference).
+        """
+        if self._result_volume_distances is None:
+            self._result_volume_distances = _volume_distances(self._result, self._reference, self._voxelspacing,
+                                                              backend=self._backend)
+        return self._result_volume_distances
 
-        obj1 = (mask1 == obj_label).astype(int)
-        obj2 = (mask2 == obj_label).astype(int)
+    @property
+    def reference_volume_distances(self) -> np.ndarray:
+        """
+        Distances from the voxels of the reference to the background of the result (zero outside the result).
+        """
+        if self._reference_volume_distances is None:
+            self._reference_volume_distances = _volume_distances(self._reference, self._result, self._voxelspacing,
+                                                                 backend=self._backend)
+        return self._reference_volume_distances
 
-        ASD_obj = compute_ASD(obj1, obj2, voxel_spacing)
-        oASD_values.append(ASD_obj)
+    def hausdorff_distance(self, percentile=100.):
+        """
+        Percentile of the symmetric surface distances, e.g., 95 for the HD95 and 100 for the Hausdorff distance.
+        """
+        return np.percentile(np.hstack((self.result_surface_distances, self.reference_surface_distances)), percentile)
 
-    # Compute oASD as the average of individual ASD values
-    oASD = np.mean(oASD_values)
+    def average_symmetric_distance(self):
+        return np.mean(np.concatenate([self.reference_volume_distances, self.result_volume_distances]))
 
-    return oASD
+    def surface_dice(self, tolerance):
+        """
+        Surface Dice, as the fraction of border voxels from both volumes lying within the given tolerance (in the
+        unit of the voxel spacing, usually mm) from the border of the other volume.
+        """
+        within_tolerance = np.count_nonzero(self.result_surface_distances <= tolerance) +\
+            np.count_nonzero(self.reference_surface_distances <= tolerance)
+        return within_tolerance / (len(self.result_surface_distances) + len(self.reference_surface_distances))
 
 
-def __surface_distances(result, reference, voxelspacing=None, connectivity=1):
+def _surface_distances(result, reference, voxelspacing=None, connectivity=1, backend='auto'):
     """
     The distances between the surface voxel of binary objects in result and their
     nearest partner surface voxel of a binary object in reference.
+    The distances are computed either with a distance transform over the whole volume (edt backend), or by querying
+    a KD-tree built on the reference surface voxels (kdtree backend), which is faster for small surfaces. Both give
+    identical values, and the auto backend selects the fastest one with select_distance_backend.
     """
     result = np.atleast_1d(result.astype(np.bool_))
     reference = np.atleast_1d(reference.astype(np.bool_))
@@ -161,6 +198,12 @@ def __surface_distances(result, reference, voxelspacing=None, connectivity=1):
     result_border = result ^ binary_erosion(result, structure=footprint, iterations=1)
     reference_border = reference ^ binary_erosion(reference, structure=footprint, iterations=1)
 
+    if backend == 'auto':
+        backend = select_distance_backend(np.count_nonzero(result_border) + np.count_nonzero(reference_border),
+                                          result.size)
+    if backend == 'kdtree':
+        return _kdtree_distances(np.argwhere(result_border), np.argwhere(reference_border), voxelspacing)
+
     # compute average surface distance
     # Note: scipys distance transform is calculated only inside the borders of the
     #       foreground objects, therefore the input has to be reversed
@@ -168,3 +211,57 @@ def __surface_distances(result, reference, voxelspacing=None, connectivity=1):
     sds = dt[result_border]
 
     return sds
+
+
+def _volume_distances(result, reference, voxelspacing=None, backend='auto'):
+    """
+    The distances between the voxels of result and the nearest background voxel of reference, i.e., the values of the
+    distance transform of reference at the result voxels (zero for the result voxels outside of reference).
+    The nearest background voxel always being face-connected to the reference, the kdtree backend only needs the
+    background voxels along the outer border of reference.
+    """
+    if backend == 'auto':
+        backend = select_distance_backend(np.count_nonzero(result & reference), result.size)
+    outer_border = None
+    if backend == 'kdtree':
+        footprint = generate_binary_structure(reference.ndim, 1)
+        outer_border = binary_dilation(reference, structure=footprint, iterations=1) & ~reference
+    if outer_border is None or np.count_nonzero(outer_border) == 0:
+        return distance_transform_edt(reference, sampling=voxelspacing)[result]
+
+    distances = np.zeros(np.count_nonzero(result), dtype=np.float64)
+    distances[reference[result]] = _kdtree_distances(np.argwhere(result & reference), np.argwhere(outer_border),
+                                                     voxelspacing)
+    return distances
+
+
+def _kdtree_distances(query_indices, tree_indices, voxelspacing=None):
+    """
+    Distances between each query voxel and its nearest tree voxel, given as voxel indices.
+    The distances are computed from the voxel indices exactly as in scipy's distance_transform_edt, such that both
+    backends give identical values. The only exception is when several voxels are equally close with an anisotropic
+    spacing, where the nearest voxel picked by each backend might differ in the last floating-point digit.
+    """
+    spacing = np.ones(query_indices.shape[1], dtype=np.float64) if voxelspacing is None else\
+        np.asarray(voxelspacing, dtype=np.float64)
+    if len(query_indices) == 0:
+        return np.zeros(0, dtype=np.float64)
+    tree = cKDTree(tree_indices * spacing)
+    _, nearest = tree.query(query_indices * spacing)
+    dt = (tree_indices[nearest] - query_indices).astype(np.float64)
+    if voxelspacing is not None:
+        dt *= spacing
+    np.multiply(dt, dt, dt)
+    squared_distances = dt[:, 0].copy()
+    for ii in range(1, dt.shape[1]):
+        squared_distances += dt[:, ii]
+    return np.sqrt(squared_distances)
+
+
+def select_distance_backend(nb_points: int, nb_voxels: int) -> str:
+    """
+    Select the fastest backend for computing the distances, based on the number of points involved (i.e., the surface
+    or object voxels to query and to build the KD-tree with) compared to the total number of voxels in the volume,
+    processed by the distance transform.
+    """
+    return 'kdtree' if nb_points * max(np.log2(max(nb_points, 1)), 1.) < KDTREE_COST_RATIO * nb_voxels else 'edt'
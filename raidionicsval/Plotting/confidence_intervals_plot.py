@@ -2,17 +2,25 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import traceback
-from arch.bootstrap import IIDBootstrap
+from ..Utils.resources import SharedResources
+from ..Utils.bootstrap import bootstrap_mean_confidence_intervals
 
 
 def compute_dice_confidence_intervals(folder, dices, best_overlap, postfix=""):
+    """
+    Bootstrap confidence intervals of the average Dice over all patients and over the patients found (i.e., with a
+    Dice above the overlap cut-off), both drawn from the same resamples, together with their histograms.
+    """
     folder = os.path.join(folder, 'Dice_CIs')
     os.makedirs(folder, exist_ok=True)
 
     try:
         best_dices_per_patient = np.array(dices)
-        bs_pls = IIDBootstrap(best_dices_per_patient)
-        ci_pls = bs_pls.conf_int(np.mean, 10000, method='bca')
+        found_dices = best_dices_per_patient[best_dices_per_patient >= best_overlap]
+        ci_pls, ci_found = bootstrap_mean_confidence_intervals([best_dices_per_patient, found_dices],
+                                                               nb_resamples=SharedResources.getInstance().studies_confidence_intervals_resamples,
+                                                               method=SharedResources.getInstance().studies_confidence_intervals_method,
+                                                               seed=SharedResources.getInstance().studies_confidence_intervals_seed)
         print("Computed confidence intervals for: {}\n".format(postfix))
         print(ci_pls)
 
@@ -36,8 +44,7 @@ def compute_dice_confidence_intervals(folder, dices, best_overlap, postfix=""):
         plt.clf()
 
         best_dices_per_patient = np.ma.masked_array(best_dices_per_patient, [x < best_overlap for x in best_dices_per_patient])
-        bs_pls = IIDBootstrap(best_dices_per_patient)
-        ci_pls = bs_pls.conf_int(np.mean, 10000, method='bca')
+        ci_pls = ci_found
         print(ci_pls)
 
         fig2, ax2 = plt.subplots()
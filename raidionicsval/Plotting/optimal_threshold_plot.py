@@ -0,0 +1,56 @@
+import os
+import matplotlib.pyplot as plt
+import pandas as pd
+
+
+def plot_optimal_threshold_study(folder, study_results: pd.DataFrame):
+    """
+    Plot the average Dice and F1-score over the probability thresholds, for each Dice overlap cut-off.
+    :param folder: destination folder for the figures (will be created if non-existing).
+    :param study_results: pd.DataFrame with the optimal threshold study, as given by compute_optimal_threshold_study.
+    """
+    plt.rcParams["font.weight"] = "bold"
+    plt.rcParams["axes.labelweight"] = "bold"
+    fig, ax = plt.subplots()
+    fig2, ax2 = plt.subplots()
+    fig3, ax3 = plt.subplots()
+    fig4, ax4 = plt.subplots()
+    for obj, overlap_results in study_results.groupby('Detection threshold', sort=False):
+        threshs = overlap_results['Dice threshold'].values
+        dices = overlap_results['Dice'].values
+        F1s = overlap_results['PiW F1'].values
+        ax.plot(threshs, dices, label=str(obj * 100) + '% overlap')
+        ax2.plot(threshs, F1s, label=str(obj * 100) + '% overlap')
+        ax3.plot(dices, F1s, label=str(obj * 100) + '% overlap')
+        ax4.scatter(threshs, dices, label=str(obj * 100) + '% overlap' + '_Dice', marker='x')
+        ax4.scatter(threshs, F1s, label=str(obj * 100) + '% overlap' + '_F1s', marker='o')
+
+    ax.set(xlabel='Network probability threshold', ylabel='Dice')  # title='Dice over network probability.'
+    ax.set_xlim(0., 1.)
+    ax.set_ylim(0., 1.)
+    ax.grid(linestyle='--')
+    ax.legend()
+    ax2.set(xlabel='Network probability threshold', ylabel='F1-score')  # , title='F1-score over network probability.'
+    ax2.set_xlim(0., 1.)
+    ax2.set_ylim(0., 1.)
+    ax2.grid(linestyle='--')
+    ax2.legend()
+    ax3.set(xlabel='Dices', ylabel='F1-score')  # , title='F1-score over dice evolution.'
+    ax3.set_xlim(0., 1.)
+    ax3.set_ylim(0., 1.)
+    ax3.grid(linestyle='--')
+    ax3.legend()
+    ax4.set(xlabel='Network probability threshold',
+            ylabel='Probability')  # , title='Combined dice/F1-score over network probability.'
+    ax4.set_xlim(0., 1.)
+    ax4.set_ylim(0., 1.)
+    ax4.grid(linestyle='--')
+    ax4.legend(loc='lower center')
+
+    os.makedirs(folder, exist_ok=True)
+    fig.savefig(os.path.join(folder, 'dice_over_threshold.png'), dpi=300, bbox_inches="tight")
+    fig2.savefig(os.path.join(folder, 'F1_over_threshold.png'), dpi=300, bbox_inches="tight")
+    fig3.savefig(os.path.join(folder, 'F1_over_dice.png'), dpi=300, bbox_inches="tight")
+    fig4.savefig(os.path.join(folder, 'metrics_scatter_over_threshold.png'), dpi=300, bbox_inches="tight")
+    for f in [fig, fig2, fig3, fig4]:
+        plt.close(f)
@@ -1,16 +1,14 @@
 import sys
 import os
 import pandas as pd
-import numpy as np
-from copy import deepcopy
 from abc import ABC, abstractmethod
 from typing import List
 import traceback
-import math
 from ..Utils.resources import SharedResources
 from ..Utils.io_converters import reload_optimal_validation_parameters
+from ..Utils.cohort_metrics import CohortMetrics
 from ..Plotting.metric_versus_binned_boxplot import compute_binned_metric_over_metric_boxplot
-from ..Validation.validation_utilities import compute_patientwise_fold_metrics, compute_singe_fold_average_metrics
+from ..Validation.validation_utilities import compute_fold_average_metrics
 from ..Validation.extra_metrics_computation import compute_overall_metrics_correlation
 
 
@@ -20,6 +18,7 @@ class AbstractStudy(ABC):
     """
     _class_names = None
     _classes_optimal = {}  # Optimal probability threshold and overlap values, for each class, based on the analysis from the validation round
+    _cohort = None  # Results of the validation round for all classes, loaded once
 
     def __init__(self):
         self.input_folder = SharedResources.getInstance().studies_input_folder
@@ -36,6 +35,7 @@ class AbstractStudy(ABC):
 
         self._class_names = SharedResources.getInstance().studies_class_names
         self._classes_optimal = {}
+        self._cohort = None
 
         for c in self.class_names:
             self.__retrieve_optimum_values(c)
@@ -48,6 +48,12 @@ class AbstractStudy(ABC):
     def classes_optimal(self) -> dict:
         return self._classes_optimal
 
+    @property
+    def cohort(self) -> CohortMetrics:
+        if self._cohort is None:
+            self._cohort = CohortMetrics.from_folder(os.path.join(self.input_folder, 'Validation'), self.class_names)
+        return self._cohort
+
     @abstractmethod
     def run(self):
         """
@@ -82,15 +88,11 @@ class AbstractStudy(ABC):
         :return:
         """
         try:
-            results_filename = os.path.join(self.input_folder, 'Validation', class_name + '_dice_scores.csv')
-            results_df = pd.read_csv(results_filename)
-            results_df.replace('inf', np.nan, inplace=True)
-            if category == 'True Positive':
-                results_df = results_df.loc[results_df["True Positive"] == True]
-
-            self.metric_names = list(results_df.columns)[17:]  # Hard-coded, needs to be improved.
-            self.__compute_dice_confidence_intervals(data=results_df, class_name=class_name, category=category)
-            self.__compute_results_metric_over_metric(data=results_df, class_name=class_name, metric1='PiW Dice',
+            default_metric_names = self.cohort.metric_names[:SharedResources.getInstance().upper_default_metrics_index - 3]
+            self.metric_names = [x for x in self.cohort.get_class_metric_names(class_name) if
+                                 x not in default_metric_names]
+            self.__compute_dice_confidence_intervals(class_name=class_name, category=category)
+            self.__compute_results_metric_over_metric(class_name=class_name, metric1='PiW Dice',
                                                       metric2='GT volume (ml)', category=category, suffix='_')
         except Exception as e:
             print('{}'.format(traceback.format_exc()))
@@ -105,27 +107,24 @@ class AbstractStudy(ABC):
         :return:
         """
         try:
-            results_filename = os.path.join(self.input_folder, 'Validation', class_name + '_dice_scores.csv')
-            results_df = pd.read_csv(results_filename)
-            results_df.replace('inf', np.nan, inplace=True)
             suffix = '_' + category.lower()
             if category == 'True Positive':
-                results_df = results_df.loc[results_df["True Positive"] == True]
                 suffix = '_tp'
 
             optimal_overlap = self.classes_optimal[class_name][category][0]
             optimal_threshold = self.classes_optimal[class_name][category][1]
+            results_df = self.cohort.get_optimal_table(class_name, optimal_threshold, category)
             compute_overall_metrics_correlation(self.input_folder, self.output_folder, data=results_df,
                                                 class_name=class_name, best_threshold=optimal_threshold,
                                                 best_overlap=optimal_overlap, suffix=suffix)
         except Exception as e:
             print('{}'.format(traceback.format_exc()))
 
-    def __compute_dice_confidence_intervals(self, class_name: str, data=None, category: str = 'All', suffix=''):
+    def __compute_dice_confidence_intervals(self, class_name: str, cohort=None, category: str = 'All', suffix=''):
         """
 
         :param class_name:
-        :param data:
+        :param cohort: CohortMetrics with the results to use, all the results from the validation round if None.
         :param category:
         :param suffix:
         :return:
@@ -134,17 +133,11 @@ class AbstractStudy(ABC):
             from raidionicsval.Plotting.confidence_intervals_plot import compute_dice_confidence_intervals
             try:
                 filename_extra = '' if category == 'All' else '_tp'
-                if data is None:
-                    results_filename = os.path.join(self.input_folder, 'Validation', class_name + '_dice_scores.csv')
-                    results = pd.read_csv(results_filename)
-                    results.replace('inf', np.nan, inplace=True)
-                else:
-                    results = deepcopy(data)
-                dice_thresholds = [np.round(x, 2) for x in list(np.unique(results['Threshold'].values))]
-                nb_tresholds = len(dice_thresholds)
+                if cohort is None:
+                    cohort = self.cohort
                 optimal_threshold = self.classes_optimal[class_name]['All'][1] if category == 'All' else self.classes_optimal[class_name]['True Positive'][1]
-                optimal_threshold_index = dice_thresholds.index(optimal_threshold)
-                best_dices_per_patient = results['PiW Dice'].values[optimal_threshold_index::nb_tresholds]
+                dices, population = cohort.get_optimal_values(class_name, optimal_threshold, ['PiW Dice'], category)
+                best_dices_per_patient = dices[..., 0][population]
                 optimal_overlap = self.classes_optimal[class_name]['All'][0] if category == 'All' else self.classes_optimal[class_name]['True Positive'][0]
                 compute_dice_confidence_intervals(folder=self.output_folder, dices=best_dices_per_patient,
                                                   postfix='_overall' + suffix + '_' + class_name + filename_extra,
@@ -154,16 +147,12 @@ class AbstractStudy(ABC):
         else:
             print('Confidence intervals can only be computed with a Python version > 3.7.0, current version is {}.\n'.format(str(sys.version_info[0]) + '.' + str(sys.version_info[1]) + '.' + str(sys.version_info[2])))
 
-    def __compute_results_metric_over_metric(self, class_name: str, data=None, metric1='Dice', metric2='Volume',
+    def __compute_results_metric_over_metric(self, class_name: str, cohort=None, metric1='Dice', metric2='Volume',
                                              category: str = 'All', suffix=''):
         try:
             filename_extra = '' if category == 'All' else '_tp'
-            if data is None:
-                results_filename = os.path.join(self.input_folder, 'Validation', class_name + '_dice_scores.csv')
-                results = pd.read_csv(results_filename)
-                results.replace('inf', np.nan, inplace=True)
-            else:
-                results = deepcopy(data)
+            if cohort is None:
+                cohort = self.cohort
 
             # if self.extra_patient_parameters is None:
             #     return
@@ -171,15 +160,12 @@ class AbstractStudy(ABC):
             number_bins = 10
             if metric2 == "SpacZ":
                 number_bins = 5
-            total_thresholds = [np.round(x, 2) for x in list(np.unique(results['Threshold'].values))]
-            nb_thresholds = len(np.unique(results['Threshold'].values))
             optimal_threshold = self.classes_optimal[class_name]['All'][1] if category == 'All' else self.classes_optimal[class_name]['True Positive'][1]
-            optimal_thresold_index = total_thresholds.index(optimal_threshold)
-            optimal_results_per_patient = results[optimal_thresold_index::nb_thresholds]
+            results = cohort.get_optimal_table(class_name, optimal_threshold, category)
+            optimal_results_per_patient = results
             # Not elegant, but either the two files have been merged before or not, so this test should be sufficient.
             if self.extra_patient_parameters is not None:
                 if True in [x not in list(results.columns) for x in list(self.extra_patient_parameters.columns)]:
-                    optimal_results_per_patient['Patient'] = optimal_results_per_patient.Patient.astype(str)
                     optimal_results_per_patient = pd.merge(optimal_results_per_patient, self.extra_patient_parameters,
                                                            on="Patient", how='left') #how='outer'
 
@@ -196,13 +182,11 @@ class AbstractStudy(ABC):
             fold_base_folder = os.path.join(folder, 'fold_analysis')
             os.makedirs(fold_base_folder, exist_ok=True)
 
-            existing_folds = np.unique(results['Fold'].values)
+            existing_folds = cohort.folds[cohort.get_fold_patients_count(class_name, category) > 0]
             for f, fold in enumerate(existing_folds):
-                results_fold = results.loc[results['Fold'] == fold]
-                optimal_results_per_patient = results_fold[optimal_thresold_index::nb_thresholds]
+                optimal_results_per_patient = results.loc[results['Fold'] == fold]
                 if self.extra_patient_parameters is not None:
                     if True in [x not in list(results.columns) for x in list(self.extra_patient_parameters.columns)]:
-                        optimal_results_per_patient['Patient'] = optimal_results_per_patient.Patient.astype(str)
                         # Trick to only keep extra information for patients from the current fold with the 'how' attribute
                         fold_optimal_results = pd.merge(optimal_results_per_patient, self.extra_patient_parameters,
                                                         on="Patient", how='left')
@@ -236,18 +220,9 @@ class AbstractStudy(ABC):
         :return: Nothing is returned, and the corresponding results are saved on disk.
         """
         try:
-            if data is None:
-                results_filename = os.path.join(self.input_folder, 'Validation', class_name + '_dice_scores.csv')
-                results = pd.read_csv(results_filename)
-                results.replace('inf', np.nan, inplace=True)
-            else:
-                results = deepcopy(data)
-            total_thresholds = [np.round(x, 2) for x in list(np.unique(results['Threshold'].values))]
-            nb_thresholds = len(np.unique(results['Threshold'].values))
+            cohort = self.cohort if data is None else CohortMetrics({class_name: data})
             optimal_threshold = self.classes_optimal[class_name]['All'][1] if category == 'All' else self.classes_optimal[class_name]['True Positive'][1]
-            optimal_thresold_index = total_thresholds.index(optimal_threshold)
-            optimal_results_per_patient = results[optimal_thresold_index::nb_thresholds]
-            optimal_results_per_patient['Patient'] = optimal_results_per_patient.Patient.astype(str)
+            optimal_results_per_patient = cohort.get_optimal_table(class_name, optimal_threshold, category)
             if self.extra_patient_parameters is not None:
                 total_optimal_results = pd.merge(optimal_results_per_patient, self.extra_patient_parameters, on="Patient")
             else:
@@ -277,12 +252,13 @@ class AbstractStudy(ABC):
                                           true_positive_state=(category == 'True Positive'),
                                           class_names=SharedResources.getInstance().studies_class_names
                                           )
+                cat_cohort = CohortMetrics({class_name: optimal_results_per_cutoff[cat]})
                 self.__compute_dice_confidence_intervals(class_name=class_name,
                                                          category=category,
-                                                         data=optimal_results_per_cutoff[cat],
+                                                         cohort=cat_cohort,
                                                          suffix=suffix + '_' + metric2 + '_' + cat)
                 self.__compute_results_metric_over_metric(class_name=class_name,
-                                                          data=optimal_results_per_cutoff[cat], metric1=metric1,
+                                                          cohort=cat_cohort, metric1=metric1,
                                                           metric2=metric2,
                                                           category=category,
                                                           suffix=suffix + '_' + metric2 + '_' + cat)
@@ -313,102 +289,21 @@ class AbstractStudy(ABC):
         :return:
         """
         try:
-            results = None
+            category = 'True Positive' if true_positive_state else 'All'
             if data is None:
-                results_filename = os.path.join(folder, class_name + '_dice_scores.csv')
-                results = pd.read_csv(results_filename)
-                if true_positive_state:
-                    results = results.loc[results["True Positive"] == True]
+                cohort = CohortMetrics.from_folder(folder, [class_name])
             else:
-                results = deepcopy(data)
+                cohort = CohortMetrics({class_name: data})
+                category = 'All'
 
             suffix = "tp" + suffix if true_positive_state else suffix
-            results.replace('inf', np.nan, inplace=True)
-            results.replace(float('inf'), np.nan, inplace=True)
-            results.replace('', np.nan, inplace=True)
-            results.replace(' ', np.nan, inplace=True)
-            unique_folds = np.unique(results['Fold'])
-            nb_folds = len(unique_folds)
-            metrics_per_fold = []
-
-            metric_names = list(results.columns[3:list(results.columns).index("#Det") + 1])
-            if metrics is not None:
-                metric_names.extend(metrics)
-
-            fold_average_columns = ['Fold', '# samples', 'Patient-wise recall', 'Patient-wise precision',
-                                    'Patient-wise specificity',
-                                    'Patient-wise F1', 'Patient-wise Accuracy', 'Patient-wise Balanced accuracy']
-            for m in metric_names:
-                fold_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-
-            # Regarding the overlap threshold, should the patient discarded for recall be
-            # used for other metrics computation?
-            for f in unique_folds:
-                patientwise_metrics = compute_patientwise_fold_metrics(results, f, best_threshold, best_overlap)
-                fold_average_metrics, fold_std_metrics = compute_singe_fold_average_metrics(results, f, best_threshold,
-                                                                                            best_overlap, metrics)
-                fold_metrics = []
-                for m in range(len(fold_average_metrics)):
-                    fold_metrics.append(fold_average_metrics[m])
-                    fold_metrics.append(fold_std_metrics[m])
-                fold_average = [f, len(np.unique(
-                    results.loc[results['Fold'] == f]['Patient'].values))] + patientwise_metrics + fold_metrics
-                metrics_per_fold.append(fold_average)
-
-            metrics_per_fold_df = pd.DataFrame(data=metrics_per_fold, columns=fold_average_columns)
+            metrics_per_fold_df, pooled_fold_averaged_results_df = compute_fold_average_metrics(cohort, class_name,
+                                                                                                best_threshold,
+                                                                                                best_overlap, metrics,
+                                                                                                category)
             study_filename = os.path.join(folder, class_name + '_folds_metrics_average.csv') if suffix == '' else\
                 os.path.join(folder, class_name + '_folds_metrics_average_' + suffix + '.csv')
             metrics_per_fold_df.to_csv(study_filename, index=False)
-
-            ####### Averaging the results from the different folds ###########
-            total_samples = metrics_per_fold_df['# samples'].sum()
-            patientwise_fold_metrics_to_average = metrics_per_fold_df.values[:, 2:8]
-            fold_metrics_to_average = metrics_per_fold_df.values[:, 8:][:, 0::2]
-            fold_std_metrics_to_average = metrics_per_fold_df.values[:, 8:][:, 1::2]
-            total_fold_metrics_to_average = np.concatenate((patientwise_fold_metrics_to_average, fold_metrics_to_average),
-                                                           axis=1)
-            fold_metrics_average = np.mean(total_fold_metrics_to_average, axis=0)
-            fold_metrics_std = np.std(total_fold_metrics_to_average, axis=0)
-            fold_averaged_results = [total_samples]
-            for m in range(len(fold_metrics_average)):
-                fold_averaged_results.append(fold_metrics_average[m])
-                fold_averaged_results.append(fold_metrics_std[m])
-
-            # Performing pooled estimates (taking into account the sample size for each fold) when relevant
-            pooled_fold_averaged_results = [len(unique_folds), total_samples]
-            pw_index = 6  # Length of the initial fold_average_columns, without the first two elements.
-            for m in range(total_fold_metrics_to_average.shape[1]):
-                mean_final = 0
-                std_final = 0
-                for f in range(len(unique_folds)):
-                    fold_val = total_fold_metrics_to_average[f, m]
-                    fold_sample_size = list(metrics_per_fold_df['# samples'])[f]
-                    mean_final = mean_final + (fold_val * fold_sample_size)
-                    # For patient-wise metrics, there is no std value for within each fold
-                    if m < pw_index:
-                        std_final = std_final
-                    else:
-                        std_final = std_final + (
-                                    (fold_sample_size - 1) * math.pow(fold_std_metrics_to_average[f, m - pw_index], 2) + (
-                                fold_sample_size) * math.pow(fold_val, 2))
-                mean_final = mean_final / total_samples
-                if m >= pw_index:
-                    std_final = math.sqrt(
-                        (1 / (total_samples - 1)) * (std_final - (total_samples * math.pow(mean_final, 2))))
-                else:
-                    std_final = np.std(total_fold_metrics_to_average[:, m])
-                pooled_fold_averaged_results.extend([mean_final, std_final])
-
-            overall_average_columns = ['Fold', '# samples']
-            for m in ['Patient-wise recall', 'Patient-wise precision', 'Patient-wise specificity', 'Patient-wise F1',
-                      'Patient-wise Accuracy', 'Patient-wise Balanced accuracy']:
-                overall_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-
-            for m in metric_names:
-                overall_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-            pooled_fold_averaged_results_df = pd.DataFrame(
-                data=np.asarray(pooled_fold_averaged_results).reshape(1, len(overall_average_columns)),
-                columns=overall_average_columns)
             study_filename = os.path.join(folder, class_name + '_overall_metrics_average.csv') if suffix == ''\
                 else os.path.join(folder, class_name + '_overall_metrics_average_' + suffix + '.csv')
             pooled_fold_averaged_results_df.to_csv(study_filename, index=False)
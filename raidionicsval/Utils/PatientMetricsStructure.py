@@ -5,50 +5,54 @@ from typing import List
 import pandas as pd
 
 from ..Utils.resources import SharedResources
+from ..Utils.results_store import read_results_table, results_table_exists
+
+# Floating-point type in which all metrics are held in memory
+METRICS_DTYPE = 'float32'
+# Index dictionaries shared by all the ClassMetrics with the same thresholds (or extra metrics), never modified in place
+_shared_indices = {}
 
 
 class PatientMetrics:
-    _unique_id = ""  # Internal unique identifier for the patient
-    _patient_id = ""  # Unique identifier for the patient (might be multiple times the same patient in different folds)
-    _fold_number = None  # Fold integer to which the patient belongs to
-    _ground_truth_filepaths = None
-    _prediction_filepaths = None
-    _patientwise_metrics = None
-    _pixelwise_metrics = None
-    _objectwise_metrics = None
-    _extra_metrics = None
-    _class_names = None
-    _class_metrics = None
+    """
+    Metrics of one patient for all probability thresholds, for each class (ClassMetrics) and averaged over all classes
+    (i.e., the content of the all_dice_scores table), together with the files and the intermediate results (e.g.,
+    loaded volumes) used for computing them.
+    """
+    __slots__ = ['_unique_id', '_patient_id', '_fold_number', '_ground_truth_filepaths', '_prediction_filepaths',
+                 '_average_metrics', '_class_names', '_class_metrics', '_class_probability_histograms',
+                 '_class_volumes']
 
     def __init__(self, id: str, patient_id: str, fold_number: int, class_names: List[str]) -> None:
         """
 
         """
         self.__reset()
-        self._unique_id = id
+        self._unique_id = id  # Internal unique identifier for the patient
+        # Unique identifier for the patient (might be multiple times the same patient in different folds)
         self._patient_id = patient_id
-        self._fold_number = fold_number
+        self._fold_number = fold_number  # Fold integer to which the patient belongs to
         self._class_names = class_names
+        self._average_metrics = ClassMetrics('All', self._patient_id, fold_number=self._fold_number)
         self._class_metrics = {}
+        # Probability histograms inside/outside the ground truth, for each class
+        self._class_probability_histograms = {}
+        # Loaded ground truth and prediction volumes kept for the extra metrics, for each class
+        self._class_volumes = {}
         for c in class_names:
             self._class_metrics[c] = ClassMetrics(c, self._patient_id, fold_number=self._fold_number)
 
     def __reset(self):
-        """
-        All objects share class or static variables.
-        An instance or non-static variables are different for different objects (every object has a copy).
-        """
         self._unique_id = ""
         self._patient_id = ""
         self._fold_number = None
         self._prediction_filepaths = None
         self._ground_truth_filepaths = None
-        self._patientwise_metrics = None
-        self._pixelwise_metrics = None
-        self._objectwise_metrics = None
-        self._extra_metrics = None
+        self._average_metrics = None
         self._class_metrics = None
         self._class_names = None
+        self._class_probability_histograms = None
+        self._class_volumes = None
 
     @property
     def unique_id(self) -> str:
@@ -63,66 +67,41 @@ class PatientMetrics:
         self._patient_id = patient_id
 
     @property
-    def extra_metrics(self) -> str:
-        return self._extra_metrics
+    def fold_number(self) -> int:
+        return self._fold_number
+
+    @property
+    def extra_metrics(self):
+        return self._average_metrics.get_extra_metrics()
 
     @property
     def class_names(self) -> List[str]:
         return self._class_names
 
     def init_from_file(self, study_folder: str):
-        all_scores_filename = os.path.join(study_folder, 'all_dice_scores.csv')
-
-        for c in list(self._class_metrics.keys()):
-            class_scores_filename = os.path.join(study_folder, c + '_dice_scores.csv')
-            self._class_metrics[c].init_from_file(class_scores_filename)
+        self.init_from_scores(load_patients_scores(study_folder, self._class_names).get((self._fold_number,
+                                                                                         self._patient_id)))
 
-        if not os.path.exists(all_scores_filename):
-            return
-        scores_df = pd.read_csv(all_scores_filename)
-        scores_df['Patient'] = scores_df.Patient.astype(str)
-        if len(scores_df.loc[(scores_df["Patient"] == self._patient_id) & (scores_df["Fold"] == self._fold_number)]) == 0:
+    def init_from_scores(self, scores) -> None:
+        """
+        Fill in the metrics from the rows of the results tables for the current patient.
+        :param scores: [rows from all_dice_scores, {class name: rows from [class]_dice_scores}] for the current patient,
+        each given as [list of column names, np.ndarray of row values] by load_patients_scores, or None if the patient
+        is not present in any results table.
+        """
+        if scores is None:
             return
-
-        patient_class_scores = scores_df.loc[(scores_df["Patient"] == self._patient_id) & (scores_df["Fold"] == self._fold_number)]
-        self._patientwise_metrics = []
-        self._pixelwise_metrics = []
-        self._objectwise_metrics = []
-        self._extra_metrics = []
-        for thr in list(patient_class_scores["Threshold"].values):
-            thr_results = patient_class_scores.loc[patient_class_scores["Threshold"] == thr].values[0]
-            thr_val = thr_results[2]
-            pixelwise_values = list(thr_results[3:7])
-            patientwise_values = list(thr_results[7:10])
-            objectwise_values = list(thr_results[10:SharedResources.getInstance().upper_default_metrics_index])
-            extra_values = list(thr_results[SharedResources.getInstance().upper_default_metrics_index:])
-            [extra_values.append(None) for x in range(len(list(thr_results[SharedResources.getInstance().upper_default_metrics_index:])), len(SharedResources.getInstance().validation_metric_names))]
-            extra_values_description = list(scores_df.columns[SharedResources.getInstance().upper_default_metrics_index:])
-            [extra_values_description.append(x) for x in SharedResources.getInstance().validation_metric_names]
-            self._pixelwise_metrics.append([thr_val] + pixelwise_values)
-            self._patientwise_metrics.append([thr_val] + patientwise_values)
-            self._objectwise_metrics.append([thr_val] + objectwise_values)
-            extra_values_cat = [[x, y] for x, y in zip(extra_values_description, extra_values)]
-            if len(extra_values_cat) != 0:
-                self._extra_metrics.append([thr_val] + extra_values_cat)
-        if len(self._extra_metrics) == 0:
-            self._extra_metrics = None
+        patient_scores, classes_scores = scores
+        for c in list(self._class_metrics.keys()):
+            self._class_metrics[c].init_from_scores(classes_scores.get(c))
+        self._average_metrics.init_from_scores(patient_scores)
 
     def is_complete(self):
         """
         @TODO. Will require much deeper checks to see if any value is missing and a recompute triggered
         :return:
         """
-        status = False
-        complete_pixelwise_metrics = True not in [-1. in x for x in
-                                                  self._pixelwise_metrics] if self._pixelwise_metrics is not None else False
-        complete_objectwise_metrics = True not in [-1. in x for x in
-                                                  self._objectwise_metrics] if self._objectwise_metrics is not None else False
-        if 'objectwise' not in SharedResources.getInstance().validation_metric_spaces:
-            status = complete_pixelwise_metrics
-        else:
-            status = complete_pixelwise_metrics & complete_objectwise_metrics
-
+        status = self._average_metrics.is_complete()
         for c in list(self._class_metrics.keys()):
             status = status & self._class_metrics[c].is_complete()
         return status
@@ -147,148 +126,142 @@ class PatientMetrics:
     def get_class_extra_metrics(self, class_name: str):
         return self._class_metrics[class_name].get_extra_metrics()
 
-    def get_class_extra_metrics_without_header(self, class_name: str):
-        return self._class_metrics[class_name].get_extra_metrics_without_header()
+    def get_class_metrics_array(self, class_name: str, thresholds: List[float], extra_metric_names: List[str] = []):
+        return self._class_metrics[class_name].get_metrics_array(thresholds, extra_metric_names)
 
     def get_optimal_class_metrics(self, class_index: int, optimal_threshold: float):
-        class_name = self._class_names[class_index]
-        for i in range(len(self._class_metrics[class_name].get_all_metrics())):
-            if self._class_metrics[class_name].get_all_metrics()[i][0] == optimal_threshold:
-                return self._class_metrics[class_name].get_all_metrics()[i]
-        return None
+        return self._class_metrics[self._class_names[class_index]].get_threshold_metrics(optimal_threshold)
 
     def get_optimal_class_extra_metrics(self, class_index: int, optimal_threshold: float):
-        class_name = self._class_names[class_index]
-        for i in range(len(self._class_metrics[class_name].get_all_metrics())):
-            if self._class_metrics[class_name].get_all_metrics()[i][0] == optimal_threshold:
-                if self._class_metrics[class_name].get_extra_metrics() is not None:
-                    return self._class_metrics[class_name].get_extra_metrics()[i]
-        return None
+        return self._class_metrics[self._class_names[class_index]].get_threshold_extra_metrics(optimal_threshold)
+
+    def get_class_probability_histograms(self, class_index: int):
+        return self._class_probability_histograms.get(self._class_names[class_index], None)
+
+    def set_class_probability_histograms(self, class_index: int, histograms) -> None:
+        self._class_probability_histograms[self._class_names[class_index]] = histograms
+
+    def get_class_volumes(self, class_index: int):
+        return self._class_volumes.get(self._class_names[class_index], None)
 
-    def set_optimal_class_extra_metrics(self, class_index: int, optimal_threshold: float, metrics_values: List):
+    def set_class_volumes(self, class_index: int, volumes) -> None:
+        self._class_volumes[self._class_names[class_index]] = volumes
+
+    def release_class_volumes(self, class_index: int) -> None:
+        self._class_volumes.pop(self._class_names[class_index], None)
+
+    def get_missing_probability_thresholds(self, thresholds: List[float]) -> List[float]:
+        """
+        Probability thresholds for which the regular metrics have not been computed yet, for at least one class.
+        """
+        missing_thresholds = []
+        for c in list(self._class_metrics.keys()):
+            missing_thresholds.extend([x for x in thresholds if not self._class_metrics[c].has_threshold(x)])
+        return sorted(set(missing_thresholds))
+
+    def set_optimal_class_extra_metrics(self, class_index: int, optimal_threshold: float,
+                                        metrics_values: List) -> List[str]:
+        """
+        :return: list of the names of the extra metrics whose value has changed.
+        """
         class_name = self._class_names[class_index]
-        self._class_metrics[class_name].set_extra_metrics(optimal_threshold, metrics_values)
+        return self._class_metrics[class_name].set_extra_metrics(optimal_threshold, metrics_values)
 
     def setup_extra_metrics(self, metric_names):
         """
         Adjust the size of the extra metrics, if new metrics have been requested to be computed in the config file.
         N-B: For already computed metrics, even if removed from the list in the config file, a removal from the
         container will not be performed and results will be kept.
-
-
         """
-        thr_list = self._class_metrics[self.class_names[0]].get_probability_thresholds_list()
-        if self._extra_metrics is None:
-            self._extra_metrics = []
-            for thr in thr_list:
-                curr_thr = [thr]
-                for m in metric_names:
-                    curr_thr.append([m, float('nan')])
-                self._extra_metrics.append(curr_thr)
-        else:
-            existing_metrics = [x[0] for x in self._extra_metrics[0][1:]]
-            matching_metrics_states = all(element in existing_metrics for element in metric_names)
-            if not matching_metrics_states:
-                for m in metric_names:
-                    if m not in existing_metrics:
-                        for th in range(len(self._extra_metrics)):
-                            self._extra_metrics[th].append([m, float('nan')])
-
+        self._average_metrics.setup_extra_metrics(metric_names)
         # Performs the same operation on the extra metrics for each class
         for cl in self._class_names:
             self._class_metrics[cl].setup_extra_metrics(metric_names)
 
 
 class ClassMetrics:
-    _unique_id = ""  # Internal unique identifier for the class
-    _patient_id = None
-    _fold_number = None
-    _patientwise_metrics = None
-    _pixelwise_metrics = None
-    _objectwise_metrics = None
-    _extra_metrics = None
+    """
+    Metrics of one patient for one class (or averaged over all classes), for each probability threshold.
+    The regular metrics (pixel-wise, patient-wise, and object-wise) and the extra metrics are held in two float32
+    arrays with one row per threshold, kept sorted by increasing threshold. The rows and the extra metrics columns are
+    found through dictionaries, rather than scanning the metrics for the requested threshold or metric name.
+    """
+    __slots__ = ['_unique_id', '_patient_id', '_fold_number', '_threshold_rows', '_metrics', '_extra_metric_columns',
+                 '_extra_metrics']
 
     def __init__(self, id: str, patient_id: str, fold_number: int) -> None:
         """
 
         """
         self.__reset()
-        self._unique_id = id
+        self._unique_id = id  # Internal unique identifier for the class
         self._patient_id = patient_id
         self._fold_number = fold_number
 
     def __reset(self):
-        """
-        All objects share class or static variables.
-        An instance or non-static variables are different for different objects (every object has a copy).
-        """
         self._unique_id = ""
         self._patient_id = None
         self._fold_number = None
-        self._patientwise_metrics = None
-        self._pixelwise_metrics = None
-        self._objectwise_metrics = None
-        self._extra_metrics = None
+        self._threshold_rows = None  # Row of the metrics arrays for each probability threshold
+        self._metrics = None  # Array with the regular metrics, for each probability threshold
+        self._extra_metric_columns = None  # Column of the extra metrics array for each metric name
+        self._extra_metrics = None  # Array with the extra metrics, for each probability threshold
 
     @property
     def unique_id(self) -> str:
         return self._unique_id
 
     @property
-    def pixelwise_metrics(self) -> str:
-        return self._pixelwise_metrics
+    def pixelwise_metrics(self):
+        if self._metrics is None:
+            return None
+        return np.concatenate([self.get_probability_thresholds_array()[:, np.newaxis], self._metrics[:, 0:4]], axis=1)
+
+    @staticmethod
+    def get_regular_metrics_number() -> int:
+        return SharedResources.getInstance().upper_default_metrics_index - 3
 
     def set_results(self, results):
         """
-        Updates the internal values only for the "regular" metrics (i.e. excluding the extra metrics)
+        Updates the internal values only for the "regular" metrics (i.e. excluding the extra metrics). Results for
+        probability thresholds already present are overwritten, and the other ones are added, keeping all the
+        metrics sorted by increasing threshold.
         :param results:
         :return:
         """
-        self._patientwise_metrics = []
-        self._pixelwise_metrics = []
-        self._objectwise_metrics = []
-        for index in range(len(results)):
-            thr_results = results[index][0]
-            thr_val = thr_results[2]
-            pixelwise_values = thr_results[3:7]
-            patientwise_values = thr_results[7:10]
-            objectwise_values = thr_results[10:SharedResources.getInstance().upper_default_metrics_index]
-            extra_values = thr_results[SharedResources.getInstance().upper_default_metrics_index:]
-            self._pixelwise_metrics.append([thr_val] + pixelwise_values)
-            self._patientwise_metrics.append([thr_val] + patientwise_values)
-            self._objectwise_metrics.append([thr_val] + objectwise_values)
+        nb_metrics = self.get_regular_metrics_number()
+        thresholds = [x[0][2] for x in results]
+        values = to_metrics_array([x[0][3:3 + nb_metrics] for x in results], nb_metrics)
+        self.__set_rows(thresholds, values)
 
     def init_from_file(self, scores_filename: str) -> None:
-        if not os.path.exists(scores_filename):
-            return
+        self.init_from_scores(group_scores_by_patient(scores_filename).get((self._fold_number, self._patient_id)))
 
-        scores_df = pd.read_csv(scores_filename)
-        scores_df['Patient'] = scores_df.Patient.astype(str)
-        if len(scores_df.loc[(scores_df["Patient"] == self._patient_id) & (scores_df["Fold"] == self._fold_number)]) == 0:
+    def init_from_scores(self, patient_class_scores: List) -> None:
+        """
+        Fill in the metrics from the rows of a results table for the current patient, if any, given as
+        [list of column names, np.ndarray of row values]. For rows with the same threshold, the first one is kept.
+        """
+        if patient_class_scores is None:
             return
 
-        patient_class_scores = scores_df.loc[(scores_df["Patient"] == self._patient_id) & (scores_df["Fold"] == self._fold_number)]
-        self._patientwise_metrics = []
-        self._pixelwise_metrics = []
-        self._objectwise_metrics = []
-        self._extra_metrics = []
-        for thr in list(np.unique(patient_class_scores["Threshold"].values)):
-            thr_results = patient_class_scores.loc[patient_class_scores["Threshold"] == thr].values[0]
-            thr_val = thr_results[2]
-            pixelwise_values = list(thr_results[3:7])
-            patientwise_values = list(thr_results[7:10])
-            objectwise_values = list(thr_results[10:SharedResources.getInstance().upper_default_metrics_index])
-            extra_values = list(thr_results[SharedResources.getInstance().upper_default_metrics_index:])
-            [extra_values.append(float('nan')) for x in range(len(list(thr_results[SharedResources.getInstance().upper_default_metrics_index:])), len(SharedResources.getInstance().validation_metric_names))]
-            extra_values_description = list(scores_df.columns[SharedResources.getInstance().upper_default_metrics_index:])
-            [extra_values_description.append(x) for x in SharedResources.getInstance().validation_metric_names if x not in extra_values_description]
-            self._pixelwise_metrics.append([thr_val] + pixelwise_values)
-            self._patientwise_metrics.append([thr_val] + patientwise_values)
-            self._objectwise_metrics.append([thr_val] + objectwise_values)
-            extra_values_cat = [[x, y] for x, y in zip(extra_values_description, extra_values)]
-            if len(extra_values_cat) != 0:
-                self._extra_metrics.append([thr_val] + extra_values_cat)
-        if len(self._extra_metrics) == 0:
+        columns, rows = patient_class_scores
+        threshold_rows = get_threshold_rows(rows)
+        thresholds = sorted(threshold_rows.keys())
+        rows = np.asarray([threshold_rows[x] for x in thresholds], dtype=object).reshape(len(thresholds), len(columns))
+        upper_index = SharedResources.getInstance().upper_default_metrics_index
+        self._threshold_rows = get_shared_index([float(x) for x in thresholds])
+        self._metrics = to_metrics_array(rows[:, 3:upper_index], upper_index - 3)
+
+        extra_metric_names = list(columns[upper_index:])
+        extra_metric_names.extend([x for x in SharedResources.getInstance().validation_metric_names if
+                                   x not in extra_metric_names])
+        self._extra_metric_columns = get_shared_index(extra_metric_names)
+        self._extra_metrics = np.full((len(thresholds), len(extra_metric_names)), np.nan, dtype=METRICS_DTYPE)
+        self._extra_metrics[:, :len(columns) - upper_index] = to_metrics_array(rows[:, upper_index:],
+                                                                               len(columns) - upper_index)
+        if len(extra_metric_names) == 0:
+            self._extra_metric_columns = None
             self._extra_metrics = None
 
     def is_complete(self):
@@ -296,58 +269,188 @@ class ClassMetrics:
 
         :return:
         """
-        status = False
-        complete_pixelwise_metrics = True not in [-1. in x for x in
-                                                  self._pixelwise_metrics] if self._pixelwise_metrics is not None else False
-        complete_objectwise_metrics = True not in [-1. in x for x in
-                                                  self._objectwise_metrics] if self._objectwise_metrics is not None else False
-        if 'objectwise' not in SharedResources.getInstance().validation_metric_spaces:
-            status = complete_pixelwise_metrics
-        else:
-            status = complete_pixelwise_metrics & complete_objectwise_metrics
+        if self._metrics is None:
+            return False
+        status = not np.any(self._metrics[:, 0:4] == -1.)
+        if 'objectwise' in SharedResources.getInstance().validation_metric_spaces:
+            status = status & (not np.any(self._metrics[:, 7:] == -1.))
         return status
 
+    def has_threshold(self, threshold: float) -> bool:
+        return self._threshold_rows is not None and threshold in self._threshold_rows
+
+    def get_probability_thresholds_list(self) -> List[float]:
+        return list(self._threshold_rows.keys()) if self._threshold_rows is not None else []
+
+    def get_probability_thresholds_array(self) -> np.ndarray:
+        return np.asarray(self.get_probability_thresholds_list(), dtype='float64')
+
     def get_all_metrics(self):
-        return [[self._pixelwise_metrics[x][0]] + self._pixelwise_metrics[x][1:] + self._patientwise_metrics[x][1:] + self._objectwise_metrics[x][1:] for x in range(len(self._pixelwise_metrics))]
+        """
+        Regular metrics as a list with [threshold, metric values] for each probability threshold.
+        """
+        if self._metrics is None:
+            return []
+        return [[thr] + self._metrics[i].tolist() for thr, i in self._threshold_rows.items()]
+
+    def get_threshold_metrics(self, threshold: float):
+        """
+        Regular metrics as [threshold, metric values] for the given probability threshold, or None if missing.
+        """
+        if not self.has_threshold(threshold):
+            return None
+        return [threshold] + self._metrics[self._threshold_rows[threshold]].tolist()
 
     def get_extra_metrics(self):
-        return self._extra_metrics
-
-    def set_extra_metrics(self, optimal_threshold: float, metrics_values: List):
-        for i in range(len(self._extra_metrics)):
-            if self._extra_metrics[i][0] == optimal_threshold:
-                self._extra_metrics[i][1:] = metrics_values
-                return True
-        return False
-
-    def get_extra_metrics_without_header(self):
-        if self._extra_metrics:
-            return [x[1][1::2] for x in self._extra_metrics]
-        else:
-            #return [[None]] * len(self._pixelwise_metrics)
-            return [[None] * len(SharedResources.getInstance().validation_metric_names)] * len(self._pixelwise_metrics)
+        """
+        Extra metrics as a list with [threshold, [metric name, metric value], ...] for each probability threshold.
+        """
+        if self._extra_metrics is None:
+            return None
+        return [self.get_threshold_extra_metrics(thr) for thr in self._threshold_rows.keys()]
 
-    def get_probability_thresholds_list(self) -> List[float]:
-        res = [x[0] for x in self.pixelwise_metrics]
-        return res
+    def get_threshold_extra_metrics(self, threshold: float):
+        """
+        Extra metrics as [threshold, [metric name, metric value], ...] for the given probability threshold, or None if
+        missing.
+        """
+        if self._extra_metrics is None or not self.has_threshold(threshold):
+            return None
+        values = self._extra_metrics[self._threshold_rows[threshold]].tolist()
+        return [threshold] + [[x, values[i]] for x, i in self._extra_metric_columns.items()]
 
-    def setup_extra_metrics(self, metric_names):
+    def get_metrics_array(self, thresholds: List[float], extra_metric_names: List[str] = []) -> np.ndarray:
+        """
+        Regular metrics followed by the requested extra metrics (NaN if missing), for the given probability thresholds.
+        :return: np.ndarray of shape (number of thresholds, number of regular and extra metrics).
         """
+        rows = [self._threshold_rows[x] for x in thresholds]
+        extra_metrics = np.full((len(rows), len(extra_metric_names)), np.nan, dtype=METRICS_DTYPE)
+        if self._extra_metrics is not None:
+            for i, m in enumerate(extra_metric_names):
+                if m in self._extra_metric_columns:
+                    extra_metrics[:, i] = self._extra_metrics[rows, self._extra_metric_columns[m]]
+        return np.concatenate([self._metrics[rows], extra_metrics], axis=1)
+
+    def set_extra_metrics(self, optimal_threshold: float, metrics_values: List) -> List[str]:
+        """
+        Set the extra metrics for the given probability threshold, from a list of [metric name, metric value] pairs.
+        :return: list of the names of the metrics whose value has changed.
+        """
+        if self._extra_metrics is None or not self.has_threshold(optimal_threshold):
+            return []
+        self.setup_extra_metrics([x[0] for x in metrics_values])
+        row = self._threshold_rows[optimal_threshold]
+        updated_metrics = []
+        for metric, value in metrics_values:
+            value = to_metrics_array([[value]], 1)[0, 0]
+            previous_value = self._extra_metrics[row, self._extra_metric_columns[metric]]
+            if value != previous_value and not (np.isnan(value) and np.isnan(previous_value)):
+                self._extra_metrics[row, self._extra_metric_columns[metric]] = value
+                updated_metrics.append(metric)
+        return updated_metrics
 
+    def setup_extra_metrics(self, metric_names):
+        """
+        Add the (empty) columns for the extra metrics not present yet.
         """
-        thr_list = self.get_probability_thresholds_list()
+        if self._metrics is None:
+            return
         if self._extra_metrics is None:
-            self._extra_metrics = []
-            for thr in thr_list:
-                curr_thr = [thr]
-                for m in metric_names:
-                    curr_thr.append([m, float('nan')])
-                self._extra_metrics.append(curr_thr)
-        else:
-            existing_metrics = [x[0] for x in self._extra_metrics[0][1:]]
-            matching_metrics_states = all(element in existing_metrics for element in metric_names)
-            if not matching_metrics_states:
-                for m in metric_names:
-                    if m not in existing_metrics:
-                        for th in range(len(self._extra_metrics)):
-                            self._extra_metrics[th].append([m, float('nan')])
+            self._extra_metric_columns = get_shared_index([])
+            self._extra_metrics = np.zeros((len(self._metrics), 0), dtype=METRICS_DTYPE)
+        missing_metrics = [x for x in metric_names if x not in self._extra_metric_columns]
+        if len(missing_metrics) != 0:
+            self._extra_metric_columns = get_shared_index(list(self._extra_metric_columns.keys()) + missing_metrics)
+            self._extra_metrics = np.concatenate([self._extra_metrics,
+                                                  np.full((len(self._metrics), len(missing_metrics)), np.nan,
+                                                          dtype=METRICS_DTYPE)], axis=1)
+
+    def __set_rows(self, thresholds: List[float], values: np.ndarray) -> None:
+        """
+        Overwrite the regular metrics for the probability thresholds already present, and add the other ones, with
+        empty extra metrics.
+        """
+        existing_thresholds = self.get_probability_thresholds_list()
+        all_thresholds = sorted(set(existing_thresholds + [float(x) for x in thresholds]))
+        if all_thresholds != existing_thresholds:
+            metrics = np.full((len(all_thresholds), values.shape[1]), np.nan, dtype=METRICS_DTYPE)
+            extra_metrics = None
+            if self._extra_metrics is not None:
+                extra_metrics = np.full((len(all_thresholds), self._extra_metrics.shape[1]), np.nan,
+                                        dtype=METRICS_DTYPE)
+            new_rows = get_shared_index(all_thresholds)
+            if self._metrics is not None:
+                previous_rows = [new_rows[x] for x in existing_thresholds]
+                metrics[previous_rows] = self._metrics
+                if extra_metrics is not None:
+                    extra_metrics[previous_rows] = self._extra_metrics
+            self._threshold_rows = new_rows
+            self._metrics = metrics
+            self._extra_metrics = extra_metrics
+        self._metrics[[self._threshold_rows[float(x)] for x in thresholds]] = values
+
+
+def get_shared_index(keys: List) -> dict:
+    """
+    Dictionary with the position of each key, shared by all the callers with the same list of keys.
+    """
+    return _shared_indices.setdefault(tuple(keys), dict([(x, i) for i, x in enumerate(keys)]))
+
+
+def to_metrics_array(values, nb_metrics: int) -> np.ndarray:
+    """
+    Metrics values (possibly given as None, booleans, or text) as a float32 array, with NaN for the missing values.
+    """
+    values = np.asarray(values, dtype=object).reshape(-1, nb_metrics)
+    try:
+        return values.astype(METRICS_DTYPE)
+    except (ValueError, TypeError):
+        return pd.DataFrame(values).apply(pd.to_numeric, errors='coerce').values.astype(METRICS_DTYPE)
+
+
+def group_scores_by_patient(scores_filename: str) -> dict:
+    """
+    Rows of a results table grouped by patient, reading the table only once.
+    :param scores_filename: results table (e.g., all_dice_scores.csv).
+    :return: dictionary with, for each (fold number, patient id) pair, the list of column names and a np.ndarray with
+    the row values of the patient.
+    """
+    if not results_table_exists(scores_filename):
+        return {}
+
+    scores_df = read_results_table(scores_filename)
+    scores_df['Patient'] = scores_df.Patient.astype(str)
+    columns = list(scores_df.columns)
+    values = scores_df.values
+    patients_indices = scores_df.groupby(['Fold', 'Patient'], sort=False).indices
+    return dict([((int(k[0]), str(k[1])), [columns, values[v]]) for k, v in patients_indices.items()])
+
+
+def load_patients_scores(study_folder: str, class_names: List[str]) -> dict:
+    """
+    Results of all patients from the results tables of a study folder, read once for hydrating all PatientMetrics
+    together (e.g., when resuming a validation run) with init_from_scores.
+    :param study_folder: folder containing the all_dice_scores and [class]_dice_scores tables.
+    :param class_names: list of class names.
+    :return: dictionary with, for each (fold number, patient id) pair, the scores expected by init_from_scores.
+    """
+    patients_scores = group_scores_by_patient(os.path.join(study_folder, 'all_dice_scores.csv'))
+    classes_scores = dict([(c, group_scores_by_patient(os.path.join(study_folder, c + '_dice_scores.csv'))) for c in
+                           class_names])
+    scores = {}
+    for key in list(patients_scores.keys()) + [k for c in class_names for k in classes_scores[c].keys()]:
+        if key not in scores:
+            scores[key] = [patients_scores.get(key), dict([(c, classes_scores[c][key]) for c in class_names if
+                                                           key in classes_scores[c]])]
+    return scores
+
+
+def get_threshold_rows(rows: np.ndarray) -> dict:
+    """
+    First row of the given results for each probability threshold.
+    """
+    threshold_rows = {}
+    for values in rows:
+        threshold_rows.setdefault(values[2], values)
+    return threshold_rows
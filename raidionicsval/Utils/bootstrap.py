@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.stats import norm
+from typing import List
+
+
+BOOTSTRAP_METHODS = ['percentile', 'bca']
+
+
+def bootstrap_mean_confidence_intervals(samples: List[np.ndarray], nb_resamples: int = 10000, method: str = 'bca',
+                                        confidence: float = 0.95, seed: int = 0,
+                                        chunk_size: int = 2 ** 22) -> List[np.ndarray]:
+    """
+    IID bootstrap confidence intervals of the mean, for several samples (e.g., strata of patients) and metrics at
+    once. A single (B x n) matrix of uniform draws is generated from the seed, n being the size of the largest sample,
+    and each sample of size m is resampled from its first m columns scaled to [0, m). The resampled means of all the
+    metrics of a sample are then given by one product between the (B x m) resampling counts and its (m x metrics)
+    values. The draws are generated by blocks of resamples to bound the memory use, independently of the samples.
+    :param samples: list of np.ndarray of shape (m) or (m, metrics), one for each sample, without missing values.
+    :param nb_resamples: number of bootstrap resamples (B).
+    :param method: type of confidence interval, from ['percentile', 'bca'] (bias-corrected and accelerated).
+    :param confidence: coverage of the two-sided confidence intervals.
+    :param seed: seed of the random generator, for reproducible intervals.
+    :param chunk_size: maximum number of uniform draws held in memory at once.
+    :return: list of np.ndarray of shape (2, metrics) with the lower and upper bounds for each sample, as NaN for
+    empty samples.
+    """
+    if method not in BOOTSTRAP_METHODS:
+        raise ValueError('Unsupported bootstrap confidence interval method: {}.'.format(method))
+    samples = [np.asarray(x, dtype='float64') for x in samples]
+    samples = [x[:, np.newaxis] if x.ndim == 1 else x for x in samples]
+    nb_draws = max([len(x) for x in samples] + [1])
+    resampled_means = [np.zeros((nb_resamples, x.shape[1]), dtype='float64') for x in samples]
+    rng = np.random.default_rng(seed)
+    block = max(1, chunk_size // nb_draws)
+    for start in range(0, nb_resamples, block):
+        stop = min(start + block, nb_resamples)
+        draws = rng.random((stop - start, nb_draws))
+        for s, sample in enumerate(samples):
+            m = len(sample)
+            if m == 0:
+                continue
+            indices = np.minimum((draws[:, :m] * m).astype('int64'), m - 1)
+            offsets = np.arange(stop - start, dtype='int64')[:, np.newaxis] * m
+            counts = np.bincount((indices + offsets).ravel(), minlength=(stop - start) * m).reshape(stop - start, m)
+            resampled_means[s][start:stop] = (counts @ sample) / m
+
+    intervals = []
+    for sample, means in zip(samples, resampled_means):
+        if len(sample) == 0:
+            intervals.append(np.full((2, sample.shape[1]), np.nan))
+            continue
+        intervals.append(compute_confidence_interval(sample, means, method, confidence))
+    return intervals
+
+
+def compute_confidence_interval(sample: np.ndarray, resampled_means: np.ndarray, method: str = 'bca',
+                                confidence: float = 0.95) -> np.ndarray:
+    """
+    Confidence interval of the mean of each metric from its bootstrap distribution. For the BCa interval, the
+    acceleration is derived from the jackknife (leave-one-out) means, given in closed form for the mean. The metrics
+    whose bootstrap distribution lies entirely on one side of the sample mean fall back to the percentile interval,
+    and the metrics without any variability get an interval reduced to their constant value.
+    :param sample: np.ndarray of shape (m, metrics).
+    :param resampled_means: np.ndarray of shape (B, metrics) with the bootstrap means.
+    :return: np.ndarray of shape (2, metrics) with the lower and upper bounds.
+    """
+    alpha = (1. - confidence) / 2.
+    nb_resamples = resampled_means.shape[0]
+    means = sample.mean(axis=0)
+    lower_levels = np.full(sample.shape[1], alpha)
+    upper_levels = np.full(sample.shape[1], 1. - alpha)
+    if method == 'bca':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bias = norm.ppf(np.count_nonzero(resampled_means < means, axis=0) / nb_resamples)
+            if len(sample) > 1:
+                jackknife_means = (sample.sum(axis=0) - sample) / (len(sample) - 1)
+                deviations = jackknife_means.mean(axis=0) - jackknife_means
+                acceleration = (deviations ** 3).sum(axis=0) / (6. * ((deviations ** 2).sum(axis=0) ** 1.5))
+            else:
+                acceleration = np.zeros(sample.shape[1])
+            acceleration[~np.isfinite(acceleration)] = 0.
+            for levels, z in [(lower_levels, norm.ppf(alpha)), (upper_levels, norm.ppf(1. - alpha))]:
+                adjusted = norm.cdf(bias + (bias + z) / (1. - acceleration * (bias + z)))
+                valid = np.isfinite(bias) & np.isfinite(adjusted)
+                levels[valid] = adjusted[valid]
+
+    interval = np.stack([np.asarray([np.quantile(resampled_means[:, k], lower_levels[k]) for k in
+                                     range(sample.shape[1])]),
+                         np.asarray([np.quantile(resampled_means[:, k], upper_levels[k]) for k in
+                                     range(sample.shape[1])])])
+    # Checked on the sample, the resampled means of constant values varying in the last floating-point digits
+    constant = np.all(sample == sample[0], axis=0)
+    interval[:, constant] = sample[0, constant]
+    return interval
@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import List
+
+from ..Utils.results_store import read_results_table, results_table_exists
+
+
+class CohortMetrics:
+    """
+    Dense cube with the results of the whole cohort, indexed as (class x fold x patient x probability threshold x
+    metric), built once from the [class]_dice_scores tables. The rows are placed by their (Fold, Patient, Threshold)
+    values, such that selecting the results at a given threshold does not depend on the ordering of the rows in the
+    tables. Within each fold, the patients are kept in their order of appearance in the tables, the missing
+    (fold, patient, threshold) entries being marked as absent and filled with NaN.
+    All metrics are held as float64, with the True Positive column as 1. (True), 0. (False), or NaN (missing).
+    """
+    def __init__(self, results: dict) -> None:
+        """
+        :param results: dictionary with, for each class name, a pd.DataFrame with the content of its
+        [class]_dice_scores table (or a subset of its rows).
+        """
+        self.class_names = list(results.keys())
+        self.metric_names = []
+        for results_df in results.values():
+            self.metric_names.extend([x for x in list(results_df.columns)[3:] if x not in self.metric_names])
+
+        # Fold, patient, and threshold axes, shared by all classes
+        patients_order = {}
+        thresholds = []
+        for results_df in results.values():
+            for fold, patient in zip(pd.to_numeric(results_df['Fold']).astype('int64').values,
+                                     results_df['Patient'].astype(str).values):
+                patients_order.setdefault((int(fold), patient), len(patients_order))
+            thresholds.extend(list(np.round(pd.to_numeric(results_df['Threshold']).values.astype('float64'), 4)))
+        self.folds = np.asarray(sorted(set([x[0] for x in patients_order])), dtype='int64')
+        self.thresholds = np.unique(np.asarray(thresholds, dtype='float64'))
+        fold_patients = dict([(f, []) for f in self.folds])
+        for fold, patient in patients_order.keys():
+            fold_patients[fold].append(patient)
+        nb_patients = max([len(x) for x in fold_patients.values()]) if len(fold_patients) != 0 else 0
+        self.patients = np.full((len(self.folds), nb_patients), '', dtype=object)
+        self.patient_index = {}
+        for f, fold in enumerate(self.folds):
+            for p, patient in enumerate(fold_patients[fold]):
+                self.patients[f, p] = patient
+                self.patient_index[(int(fold), patient)] = (f, p)
+
+        self.values = np.full((len(self.class_names), len(self.folds), nb_patients, len(self.thresholds),
+                               len(self.metric_names)), np.nan, dtype='float64')
+        self.present = np.zeros(self.values.shape[:4], dtype=bool)
+        for c, results_df in enumerate(results.values()):
+            self.__fill_class(c, results_df)
+
+    @classmethod
+    def from_folder(cls, folder: str, class_names: List[str]):
+        """
+        Cohort metrics from the [class]_dice_scores tables inside a folder, for the classes with existing results.
+        """
+        results = {}
+        for c in class_names:
+            results_filename = os.path.join(folder, c + '_dice_scores.csv')
+            if results_table_exists(results_filename):
+                results[c] = read_results_table(results_filename)
+        return cls(results)
+
+    def __fill_class(self, class_index: int, results_df: pd.DataFrame) -> None:
+        if len(results_df) == 0:
+            return
+        folds = pd.to_numeric(results_df['Fold']).astype('int64').values
+        patients = results_df['Patient'].astype(str).values
+        rows = np.asarray([self.patient_index[(int(f), p)] for f, p in zip(folds, patients)], dtype='int64')
+        thresholds = np.round(pd.to_numeric(results_df['Threshold']).values.astype('float64'), 4)
+        threshold_indices = np.searchsorted(self.thresholds, thresholds)
+
+        # Only the first row is kept for each (fold, patient, threshold), similar to the patient metrics
+        flat_indices = np.ravel_multi_index((rows[:, 0], rows[:, 1], threshold_indices), self.present.shape[1:])
+        _, first_rows = np.unique(flat_indices, return_index=True)
+        first_rows = np.sort(first_rows)
+
+        metric_columns = [self.metric_names.index(x) for x in list(results_df.columns)[3:]]
+        values = np.stack([to_metric_values(results_df[x].values[first_rows], x) for x in list(results_df.columns)[3:]],
+                          axis=1)
+        entries = (class_index, rows[first_rows, 0], rows[first_rows, 1], threshold_indices[first_rows])
+        self.values[entries[0], entries[1][:, np.newaxis], entries[2][:, np.newaxis], entries[3][:, np.newaxis],
+                    np.asarray(metric_columns)[np.newaxis, :]] = values
+        self.present[entries] = True
+
+    def get_class_index(self, class_name: str) -> int:
+        return self.class_names.index(class_name)
+
+    def get_metric_index(self, metric_name: str) -> int:
+        return self.metric_names.index(metric_name)
+
+    def get_class_metric_names(self, class_name: str) -> List[str]:
+        """
+        Metrics with at least one value for the class, leaving out the columns only filled for other classes.
+        """
+        c = self.get_class_index(class_name)
+        has_values = np.any(~np.isnan(self.values[c][self.present[c]]), axis=0)
+        return [x for x, v in zip(self.metric_names, has_values) if v]
+
+    def get_threshold_index(self, threshold: float) -> int:
+        """
+        Index of a probability threshold along the threshold axis.
+        """
+        matches = np.flatnonzero(np.isclose(self.thresholds, threshold))
+        if len(matches) == 0:
+            raise ValueError('The probability threshold {} is not part of the results.'.format(threshold))
+        return int(matches[0])
+
+    def get_population_mask(self, class_name: str, category: str = 'All') -> np.ndarray:
+        """
+        Entries belonging to the population of patients to focus on, for each (fold, patient, threshold).
+        :param class_name: name of the class of interest.
+        :param category: population of patients, from ['All', 'True Positive'].
+        :return: np.ndarray of booleans of shape (folds, patients, thresholds).
+        """
+        mask = self.present[self.get_class_index(class_name)]
+        if category == 'True Positive':
+            mask = mask & (self.values[self.get_class_index(class_name), ..., self.get_metric_index('True Positive')] == 1.)
+        return mask
+
+    def get_metric_values(self, class_name: str, metric_name: str) -> np.ndarray:
+        """
+        Values of one metric, of shape (folds, patients, thresholds).
+        """
+        return self.values[self.get_class_index(class_name), ..., self.get_metric_index(metric_name)]
+
+    def get_optimal_values(self, class_name: str, threshold: float, metric_names: List[str] = None,
+                           category: str = 'All'):
+        """
+        Values of the requested metrics at the optimal probability threshold, for each patient.
+        :return: np.ndarray of shape (folds, patients, metrics), and the np.ndarray of booleans of shape
+        (folds, patients) indicating the patients from the population.
+        """
+        t = self.get_threshold_index(threshold)
+        metric_indices = [self.get_metric_index(x) for x in metric_names] if metric_names is not None else\
+            list(range(len(self.metric_names)))
+        values = self.values[self.get_class_index(class_name), :, :, t][..., metric_indices]
+        return values, self.get_population_mask(class_name, category)[:, :, t]
+
+    def get_optimal_table(self, class_name: str, threshold: float, category: str = 'All') -> pd.DataFrame:
+        """
+        Rows of the results table at the optimal probability threshold, for the patients from the population, with
+        the patients of each fold in their original order.
+        """
+        values, mask = self.get_optimal_values(class_name, threshold, category=category)
+        fold_indices, patient_indices = np.nonzero(mask)
+        table = pd.DataFrame(values[fold_indices, patient_indices], columns=self.metric_names)
+        if 'True Positive' in self.metric_names:
+            table['True Positive'] = table['True Positive'].map({1.: True, 0.: False})
+        table.insert(0, 'Threshold', self.thresholds[self.get_threshold_index(threshold)])
+        table.insert(0, 'Patient', self.patients[fold_indices, patient_indices].astype(str))
+        table.insert(0, 'Fold', self.folds[fold_indices])
+        return table
+
+    def get_fold_patients_count(self, class_name: str, category: str = 'All') -> np.ndarray:
+        """
+        Number of patients from the population in each fold, for any probability threshold.
+        """
+        return np.count_nonzero(np.any(self.get_population_mask(class_name, category), axis=2), axis=1)
+
+    def reduce_optimal_values(self, class_name: str, threshold: float, metric_names: List[str] = None,
+                              category: str = 'All', reduction=np.mean, per_fold: bool = True) -> np.ndarray:
+        """
+        Reduction (e.g., mean or standard deviation) of the metrics at the optimal probability threshold over the
+        patients from the population, for each fold or over the whole cohort.
+        :return: np.ndarray of shape (folds, metrics) if per_fold, (metrics) otherwise.
+        """
+        values, mask = self.get_optimal_values(class_name, threshold, metric_names, category)
+        if not per_fold:
+            return reduction(values[mask], axis=0)
+        return np.stack([reduction(values[f][mask[f]], axis=0) for f in range(len(self.folds))])
+
+
+def to_metric_values(values: np.ndarray, metric_name: str) -> np.ndarray:
+    """
+    Column of a results table as float64 values, with the True Positive flags as 1. or 0. (the class-averaged
+    fractions being kept as is) and the values which are not numbers as NaN.
+    """
+    if metric_name == 'True Positive':
+        flags = pd.Series(values).map(lambda x: {'True': 1., 'False': 0.}.get(str(x), x))
+        return pd.to_numeric(flags, errors='coerce').values.astype('float64')
+    return pd.to_numeric(pd.Series(values), errors='coerce').values.astype('float64')
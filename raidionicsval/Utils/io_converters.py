@@ -1,7 +1,15 @@
 import os
 import pickle
+import threading
+import traceback
 import pandas as pd
 import numpy as np
+import nibabel as nib
+from collections import deque
+from typing import List
+
+from ..Computation.cropping_computation import compute_union_bounding_box
+from ..Utils.volume_cache import get_volume_cache
 
 
 def get_fold_from_file(filename, fold_number):
@@ -52,3 +60,145 @@ def reload_optimal_validation_parameters(study_filename):
     optimums = study_df.iloc[-1]
 
     return optimums['Detection threshold'], optimums['Dice threshold']
+
+
+def load_ground_truth_volume(image_ni: nib.Nifti1Image) -> np.ndarray:
+    """
+    Binary ground truth read directly from the stored data, without the float64 copy made by get_fdata.
+    :param image_ni: loaded nifti ground truth image.
+    :return: np.ndarray of type uint8, with 1 for all voxels with a label value of at least one.
+    """
+    return (np.asanyarray(image_ni.dataobj) >= 1).astype('uint8')
+
+
+def load_probability_volume(image_ni: nib.Nifti1Image, dtype: str = 'float32') -> np.ndarray:
+    """
+    Prediction probabilities read directly from the stored data, without the float64 copy made by get_fdata.
+    Integer predictions (e.g., binary masks) are kept in their stored type, and floating-point predictions are
+    brought to the requested precision.
+    :param image_ni: loaded nifti prediction image.
+    :param dtype: floating-point type for the probabilities, from [float32, float64].
+    :return: np.ndarray with the probabilities.
+    """
+    probabilities = np.asanyarray(image_ni.dataobj)
+    if probabilities.dtype.kind == 'f' and probabilities.dtype != np.dtype(dtype):
+        probabilities = probabilities.astype(dtype)
+    return probabilities
+
+
+class ClassVolumes:
+    """
+    Ground truth and prediction of one patient for one class, loaded once in a compact form to be shared between the
+    probability thresholds sweep and the extra metrics computation.
+    The volumes can be cropped to the region containing the ground truth and the detection at a given threshold, in
+    which case they remain valid for computing the metrics at any higher threshold.
+    When a volume cache is in use, the decoded volumes are memory-mapped (read-only) from the cache if available.
+    """
+    def __init__(self, gt_filename: str, detection_filename: str, dtype: str = 'float32') -> None:
+        self.ground_truth_ni = nib.load(gt_filename)
+        self.detection_ni = nib.load(detection_filename)
+        self.shape = self.detection_ni.shape
+        cache = get_volume_cache()
+        if cache is not None:
+            self.gt = cache.load(gt_filename, 'ground-truth',
+                                 lambda: load_ground_truth_volume(self.ground_truth_ni))
+            self.probabilities = cache.load(detection_filename, 'probabilities-' + dtype,
+                                            lambda: load_probability_volume(self.detection_ni, dtype))
+        else:
+            self.gt = load_ground_truth_volume(self.ground_truth_ni)
+            self.probabilities = load_probability_volume(self.detection_ni, dtype)
+        self.crop_threshold = None
+
+    @property
+    def nbytes(self) -> int:
+        return self.gt.nbytes + self.probabilities.nbytes
+
+    def crop(self, threshold: float, margin: int = 1) -> None:
+        """
+        Crop the volumes to the bounding box of the ground truth and the detection at the given threshold.
+        """
+        crop = compute_union_bounding_box([self.gt, self.probabilities >= threshold], margin=margin)
+        if crop is not None:
+            self.gt = self.gt[crop].copy()
+            self.probabilities = self.probabilities[crop].copy()
+        self.crop_threshold = threshold
+
+    def is_valid_for(self, threshold: float) -> bool:
+        """
+        Whether the volumes hold the ground truth and the detection at the given threshold entirely.
+        """
+        return self.crop_threshold is None or threshold >= self.crop_threshold
+
+
+class VolumesPrefetcher:
+    """
+    Background loading of the ClassVolumes of the upcoming patients, while the current patient is being processed.
+    The files are read and decompressed by a separate thread (both releasing the GIL), into a queue holding at most
+    depth patients and memory_limit MB of volumes (the last loaded patient possibly exceeding the limit).
+    Iterating over the prefetcher gives, in order, the list of ClassVolumes for each patient, or None if the loading
+    failed (in which case the volumes should be loaded again to report the issue).
+    """
+    def __init__(self, patients_filenames: List[List[List[str]]], depth: int = 2, memory_limit: float = 2048,
+                 dtype: str = 'float32') -> None:
+        """
+        :param patients_filenames: list with, for each patient, the list of [ground truth, prediction] filenames for
+        each class.
+        :param depth: maximum number of patients loaded in advance.
+        :param memory_limit: maximum memory (in MB) used by the patients loaded in advance.
+        :param dtype: floating-point type for the probabilities, from [float32, float64].
+        """
+        self._patients_filenames = patients_filenames
+        self._depth = max(depth, 1)
+        self._memory_limit = memory_limit * 1e6
+        self._dtype = dtype
+        self._queue = deque()
+        self._queue_nbytes = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self.__load, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __iter__(self):
+        for _ in range(len(self._patients_filenames)):
+            with self._condition:
+                while len(self._queue) == 0:
+                    self._condition.wait()
+                volumes, nbytes = self._queue.popleft()
+                self._queue_nbytes -= nbytes
+                self._condition.notify_all()
+            yield volumes
+
+    def close(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._condition.notify_all()
+        self._thread.join()
+
+    def __load(self) -> None:
+        for classes_filenames in self._patients_filenames:
+            with self._condition:
+                while not self._stopped and (len(self._queue) >= self._depth or
+                                             (len(self._queue) != 0 and self._queue_nbytes >= self._memory_limit)):
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            try:
+                volumes = [ClassVolumes(gt_filename, det_filename, dtype=self._dtype) for gt_filename, det_filename in
+                           classes_filenames]
+                nbytes = sum([x.nbytes for x in volumes])
+            except Exception as e:
+                print('Issue prefetching the volumes for {}'.format(classes_filenames))
+                print(traceback.format_exc())
+                volumes = None
+                nbytes = 0
+            with self._condition:
+                self._queue.append((volumes, nbytes))
+                self._queue_nbytes += nbytes
+                self._condition.notify_all()
@@ -0,0 +1,46 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from ..Utils.resources import SharedResources
+
+
+def get_parallel_backend() -> str:
+    """
+    Backend used for the parallel computations, from [process, thread, serial], as set in the configuration file.
+    The computations are always serial when a single process is allowed.
+    """
+    if SharedResources.getInstance().number_processes <= 1:
+        return 'serial'
+    return SharedResources.getInstance().parallel_backend
+
+
+def create_pool(processes: int = None):
+    """
+    Pool of workers for the parallel backend, either processes or threads (with the same interface in both cases).
+    The processes are initialized with the parameters of the run, as they do not inherit the configuration from the
+    main process with the spawn start method (default on macOS and Windows).
+    :param processes: number of workers, defaulting to the number of processes from the configuration file.
+    :return: multiprocessing.Pool or multiprocessing.pool.ThreadPool.
+    """
+    if processes is None:
+        processes = SharedResources.getInstance().number_processes
+    if get_parallel_backend() == 'thread':
+        return ThreadPool(processes=processes)
+    return multiprocessing.Pool(processes=processes, initializer=init_worker_resources,
+                                initargs=(get_worker_resources(),))
+
+
+def get_worker_resources() -> dict:
+    """
+    Parameters of the run held by the SharedResources singleton, to be handed to the pool processes. The parsed
+    configuration file itself is left out, all its values being already available as attributes.
+    """
+    return dict([(k, v) for k, v in vars(SharedResources.getInstance()).items() if k != 'config'])
+
+
+def init_worker_resources(resources: dict) -> None:
+    """
+    Initialization of each process from a pool, restoring the parameters of the run in its SharedResources singleton.
+    """
+    for k, v in resources.items():
+        setattr(SharedResources.getInstance(), k, v)
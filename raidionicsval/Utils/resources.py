@@ -1,7 +1,9 @@
 import os
 import sys
+import math
 import logging
 import configparser
+import importlib.util
 logger = logging.getLogger(__name__)
 
 
@@ -39,12 +41,16 @@ class SharedResources:
         self.data_root = ""
         self.task = None
         self.number_processes = 8
+        self.parallel_backend = 'process'
 
         self.studies_input_folder = ''
         self.studies_output_folder = ''
         self.studies_task = ''
         self.studies_extra_parameters_filename = ''
         self.studies_class_names = []
+        self.studies_confidence_intervals_method = 'bca'
+        self.studies_confidence_intervals_resamples = 10000
+        self.studies_confidence_intervals_seed = 0
 
         self.validation_input_folder = ''
         self.validation_output_folder = ''
@@ -60,6 +66,23 @@ class SharedResources:
         self.validation_class_names = []
         self.validation_true_positive_volume_thresholds = []
         self.validation_use_brats_data = []
+        self.validation_probability_thresholds = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+        self.validation_probability_threshold_search = 'exhaustive'
+        self.validation_probability_threshold_candidates = 2
+        self.validation_crop_margin = 1
+        self.validation_surface_dice_tolerances = [1.0]
+        self.validation_object_matching = 'many-to-many'
+        self.validation_objectwise_strategy = 'per-threshold'
+        self.validation_probability_dtype = 'float32'
+        self.validation_volumes_memory_limit = 4096
+        self.validation_prefetch_depth = 2
+        self.validation_prefetch_memory_limit = 2048
+        self.validation_volume_cache_folder = None
+        self.validation_volume_cache_size = 10240
+        self.validation_volume_cache_content_hash = False
+        self.validation_results_formats = ['csv']
+        self.validation_optimal_threshold_objective = 'dice'
+        self.validation_optimal_threshold_objective_weights = [0.5, 0.5]
 
     def set_environment(self, config_filename):
         self.config = configparser.ConfigParser()
@@ -82,6 +105,10 @@ class SharedResources:
         :param: data_root: (str) main folder entry-point containing the raw data (assuming a specific folder structure).
         :param: task: (str) identifier for the task to perform, for now validation or study
         :param: number_processes: (int) number of parallel processes to use to perform the different task
+        :param: parallel_backend: (str) how the parallel computations are run, to sample from [process, thread, serial].
+        With process, the volumes are handed to a pool of processes through shared memory. With thread, a pool of
+        threads works directly on the loaded volumes (most NumPy/SciPy computations releasing the GIL), without any
+        copy. With serial, everything is computed in the main process, whatever the number of processes.
         :return:
         """
         if self.config.has_option('Default', 'data_root'):
@@ -96,6 +123,12 @@ class SharedResources:
             if self.config['Default']['number_processes'].split('#')[0].strip() != '':
                 self.number_processes = int(self.config['Default']['number_processes'].split('#')[0].strip())
 
+        if self.config.has_option('Default', 'parallel_backend'):
+            if self.config['Default']['parallel_backend'].split('#')[0].strip() != '':
+                self.parallel_backend = self.config['Default']['parallel_backend'].split('#')[0].strip().lower()
+        if self.parallel_backend not in ['process', 'thread', 'serial']:
+            raise ValueError('Unsupported parallel backend: {}.'.format(self.parallel_backend))
+
     def __parse_studies_parameters(self):
         """
         Parse the user-selected configuration parameters linked to the study process (plotting and visualization).
@@ -106,6 +139,10 @@ class SharedResources:
         the /Studies sub-directory.
         :param: studies_extra_parameters_filename: resources file containing patient-specific information, for example
         the tumor volume, data origin, etc... for in-depth results analysis.
+        :param: studies_confidence_intervals_method: type of bootstrap confidence intervals for the average Dice, from
+        [percentile, bca].
+        :param: studies_confidence_intervals_resamples: number of bootstrap resamples for the confidence intervals.
+        :param: studies_confidence_intervals_seed: seed of the random generator used for the bootstrap resamples.
         :return:
         """
         if self.config.has_option('Studies', 'input_folder'):
@@ -129,6 +166,22 @@ class SharedResources:
                 self.studies_class_names = [x.strip() for x in
                                             self.config['Studies']['class_names'].split('#')[0].strip().split(',')]
 
+        if self.config.has_option('Studies', 'confidence_intervals_method'):
+            if self.config['Studies']['confidence_intervals_method'].split('#')[0].strip() != '':
+                self.studies_confidence_intervals_method = self.config['Studies']['confidence_intervals_method'].split('#')[0].strip().lower()
+        if self.studies_confidence_intervals_method not in ['percentile', 'bca']:
+            raise ValueError('Unsupported confidence intervals method: {}.'.format(self.studies_confidence_intervals_method))
+
+        if self.config.has_option('Studies', 'confidence_intervals_resamples'):
+            if self.config['Studies']['confidence_intervals_resamples'].split('#')[0].strip() != '':
+                self.studies_confidence_intervals_resamples = int(self.config['Studies']['confidence_intervals_resamples'].split('#')[0].strip())
+        if self.studies_confidence_intervals_resamples < 1:
+            raise ValueError('The number of bootstrap resamples must be positive, got {}.'.format(self.studies_confidence_intervals_resamples))
+
+        if self.config.has_option('Studies', 'confidence_intervals_seed'):
+            if self.config['Studies']['confidence_intervals_seed'].split('#')[0].strip() != '':
+                self.studies_confidence_intervals_seed = int(self.config['Studies']['confidence_intervals_seed'].split('#')[0].strip())
+
     def __parse_validation_parameters(self):
         """
         Parse the user-selected configuration parameters linked to the validation process.
@@ -147,6 +200,50 @@ class SharedResources:
         positive.
         :param: validation_prediction_files_suffix: suffix to append to the input sample name (from the list in
         cross_validation_folds.txt) in order to generate the network's prediction filename, including its extension.
+        :param: validation_probability_thresholds: list of probability thresholds used to binarize the predictions,
+        either given as comma-separated values or as a start:stop:step range (e.g., 0.01:1.0:0.01). The values are
+        rounded to 4 decimals.
+        :param: validation_probability_threshold_search: strategy for searching the optimal probability threshold, to
+        sample from [exhaustive, coarse-to-fine]. With exhaustive, all patients are evaluated for every threshold. With
+        coarse-to-fine, the patients are first evaluated on a coarse subset of the thresholds, and then only on the
+        thresholds lying around the best coarse candidates.
+        :param: validation_probability_threshold_candidates: number of best coarse thresholds (per class) to refine
+        around when using the coarse-to-fine search.
+        :param: validation_crop_margin: number of voxels added on each side of the bounding box enclosing the ground
+        truth and detection, to which the volumes are cropped before computing the voxel-level metrics. The margin
+        must be of at least one voxel, which leaves all metric values unchanged.
+        :param: validation_surface_dice_tolerances: list of tolerances (in mm) for the surface Dice. When SurfDice is
+        listed in the extra metrics, it is replaced by one SurfDice@<tolerance> metric for each tolerance.
+        :param: validation_object_matching: strategy for pairing the ground truth and detection objects, to sample from
+        [many-to-many, one-to-one]. With many-to-many, every overlapping pair of objects is a match. With one-to-one,
+        each object is matched at most once, following the assignment maximizing the sum of the Dice scores.
+        :param: validation_objectwise_strategy: strategy for computing the object-wise metrics over the probability
+        thresholds, to sample from [per-threshold, component-tree]. With per-threshold, the objects are extracted anew
+        from each binarized detection. With component-tree, the objects for all thresholds are read off a single
+        component tree of the probability map, with identical results.
+        :param: validation_probability_dtype: floating-point type in which the predictions are loaded, to sample from
+        [float32, float64]. Predictions stored as integers are kept in their stored type.
+        :param: validation_volumes_memory_limit: maximum memory (in MB) used for keeping the loaded volumes of all
+        patients from the probability thresholds sweep until the extra metrics computation. The volumes which do not
+        fit are loaded again from disk when computing the extra metrics.
+        :param: validation_prefetch_depth: number of upcoming patients whose volumes are loaded in the background while
+        the current patient is being processed sequentially, 0 to disable the prefetching.
+        :param: validation_prefetch_memory_limit: maximum memory (in MB) used by the volumes loaded in advance.
+        :param: validation_volume_cache_folder: folder where the decoded volumes are cached on disk, to be memory-mapped
+        on later runs instead of being decompressed again. No cache is used if not provided.
+        :param: validation_volume_cache_size: maximum size (in MB) of the volume cache on disk, the least recently used
+        volumes being evicted first.
+        :param: validation_volume_cache_content_hash: whether the content of the source files is hashed as part of the
+        volume cache keys, on top of their path, size, and modification time. Safer when the files might be modified
+        without changing their modification time, but every source file is then fully read upon each load.
+        :param: validation_results_formats: list of formats in which the results tables (i.e., [class]_dice_scores) are
+        saved, to sample from [csv, feather, parquet]. The columnar formats (Feather and Parquet) are saved with typed
+        columns, and loaded memory-mapped in place of the csv files (requires pyarrow).
+        :param: validation_optimal_threshold_objective: objective maximized when selecting the optimal probability
+        threshold and Dice overlap cut-off, to sample from [dice, f1, weighted]. The weighted objective combines the
+        average Dice and F1-score with the weights from validation_optimal_threshold_objective_weights.
+        :param: validation_optimal_threshold_objective_weights: weights of the average Dice and F1-score in the weighted
+        objective.
         :return:
         """
         if self.config.has_option('Validation', 'input_folder'):
@@ -207,4 +304,125 @@ class SharedResources:
 
         if self.config.has_option('Validation', 'use_brats_data'):
             if self.config['Validation']['use_brats_data'].split('#')[0].strip() != '':
-                self.validation_use_brats_data = True if self.config['Validation']['use_brats_data'].split('#')[0].strip().lower() == 'true' else False
\ No newline at end of file
+                self.validation_use_brats_data = True if self.config['Validation']['use_brats_data'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Validation', 'probability_thresholds'):
+            if self.config['Validation']['probability_thresholds'].split('#')[0].strip() != '':
+                self.validation_probability_thresholds = self.__parse_probability_thresholds(self.config['Validation']['probability_thresholds'].split('#')[0].strip())
+
+        if self.config.has_option('Validation', 'probability_threshold_search'):
+            if self.config['Validation']['probability_threshold_search'].split('#')[0].strip() != '':
+                self.validation_probability_threshold_search = self.config['Validation']['probability_threshold_search'].split('#')[0].strip().lower()
+        if self.validation_probability_threshold_search not in ['exhaustive', 'coarse-to-fine']:
+            raise ValueError('Unsupported probability threshold search strategy: {}.'.format(self.validation_probability_threshold_search))
+
+        if self.config.has_option('Validation', 'probability_threshold_candidates'):
+            if self.config['Validation']['probability_threshold_candidates'].split('#')[0].strip() != '':
+                self.validation_probability_threshold_candidates = int(self.config['Validation']['probability_threshold_candidates'].split('#')[0].strip())
+
+        if self.config.has_option('Validation', 'crop_margin'):
+            if self.config['Validation']['crop_margin'].split('#')[0].strip() != '':
+                self.validation_crop_margin = int(self.config['Validation']['crop_margin'].split('#')[0].strip())
+        if self.validation_crop_margin < 1:
+            raise ValueError('The crop margin must be of at least one voxel, got {}.'.format(self.validation_crop_margin))
+
+        if self.config.has_option('Validation', 'surface_dice_tolerances'):
+            if self.config['Validation']['surface_dice_tolerances'].split('#')[0].strip() != '':
+                self.validation_surface_dice_tolerances = [float(x.strip()) for x in self.config['Validation']['surface_dice_tolerances'].split('#')[0].strip().split(',')]
+        if self.config.has_option('Validation', 'object_matching'):
+            if self.config['Validation']['object_matching'].split('#')[0].strip() != '':
+                self.validation_object_matching = self.config['Validation']['object_matching'].split('#')[0].strip().lower()
+        if self.validation_object_matching not in ['many-to-many', 'one-to-one']:
+            raise ValueError('Unsupported object matching strategy: {}.'.format(self.validation_object_matching))
+
+        if self.config.has_option('Validation', 'objectwise_strategy'):
+            if self.config['Validation']['objectwise_strategy'].split('#')[0].strip() != '':
+                self.validation_objectwise_strategy = self.config['Validation']['objectwise_strategy'].split('#')[0].strip().lower()
+        if self.validation_objectwise_strategy not in ['per-threshold', 'component-tree']:
+            raise ValueError('Unsupported object-wise computation strategy: {}.'.format(self.validation_objectwise_strategy))
+
+        if self.config.has_option('Validation', 'probability_dtype'):
+            if self.config['Validation']['probability_dtype'].split('#')[0].strip() != '':
+                self.validation_probability_dtype = self.config['Validation']['probability_dtype'].split('#')[0].strip().lower()
+        if self.validation_probability_dtype not in ['float32', 'float64']:
+            raise ValueError('Unsupported probability type: {}.'.format(self.validation_probability_dtype))
+
+        if self.config.has_option('Validation', 'volumes_memory_limit'):
+            if self.config['Validation']['volumes_memory_limit'].split('#')[0].strip() != '':
+                self.validation_volumes_memory_limit = float(self.config['Validation']['volumes_memory_limit'].split('#')[0].strip())
+        if self.validation_volumes_memory_limit < 0:
+            raise ValueError('The volumes memory limit must be positive, got {}.'.format(self.validation_volumes_memory_limit))
+
+        if self.config.has_option('Validation', 'prefetch_depth'):
+            if self.config['Validation']['prefetch_depth'].split('#')[0].strip() != '':
+                self.validation_prefetch_depth = int(self.config['Validation']['prefetch_depth'].split('#')[0].strip())
+        if self.validation_prefetch_depth < 0:
+            raise ValueError('The prefetch depth must be a positive number of patients, got {}.'.format(self.validation_prefetch_depth))
+
+        if self.config.has_option('Validation', 'prefetch_memory_limit'):
+            if self.config['Validation']['prefetch_memory_limit'].split('#')[0].strip() != '':
+                self.validation_prefetch_memory_limit = float(self.config['Validation']['prefetch_memory_limit'].split('#')[0].strip())
+        if self.validation_prefetch_memory_limit < 0:
+            raise ValueError('The prefetch memory limit must be positive, got {}.'.format(self.validation_prefetch_memory_limit))
+
+        if self.config.has_option('Validation', 'volume_cache_folder'):
+            if self.config['Validation']['volume_cache_folder'].split('#')[0].strip() != '':
+                self.validation_volume_cache_folder = self.config['Validation']['volume_cache_folder'].split('#')[0].strip()
+
+        if self.config.has_option('Validation', 'volume_cache_size'):
+            if self.config['Validation']['volume_cache_size'].split('#')[0].strip() != '':
+                self.validation_volume_cache_size = float(self.config['Validation']['volume_cache_size'].split('#')[0].strip())
+        if self.validation_volume_cache_size < 0:
+            raise ValueError('The volume cache size must be positive, got {}.'.format(self.validation_volume_cache_size))
+
+        if self.config.has_option('Validation', 'volume_cache_content_hash'):
+            if self.config['Validation']['volume_cache_content_hash'].split('#')[0].strip() != '':
+                self.validation_volume_cache_content_hash = True \
+                    if self.config['Validation']['volume_cache_content_hash'].split('#')[0].strip().lower() == 'true'\
+                    else False
+
+        if self.config.has_option('Validation', 'results_format'):
+            if self.config['Validation']['results_format'].split('#')[0].strip() != '':
+                self.validation_results_formats = [x.strip().lower() for x in self.config['Validation']['results_format'].split('#')[0].strip().split(',')]
+        for results_format in self.validation_results_formats:
+            if results_format not in ['csv', 'feather', 'parquet']:
+                raise ValueError('Unsupported results format: {}.'.format(results_format))
+            if results_format != 'csv' and importlib.util.find_spec('pyarrow') is None:
+                raise ValueError('The {} results format requires pyarrow, which is not installed.'.format(results_format))
+
+        if self.config.has_option('Validation', 'optimal_threshold_objective'):
+            if self.config['Validation']['optimal_threshold_objective'].split('#')[0].strip() != '':
+                self.validation_optimal_threshold_objective = self.config['Validation']['optimal_threshold_objective'].split('#')[0].strip().lower()
+        if self.validation_optimal_threshold_objective not in ['dice', 'f1', 'weighted']:
+            raise ValueError('Unsupported optimal threshold objective: {}.'.format(self.validation_optimal_threshold_objective))
+
+        if self.config.has_option('Validation', 'optimal_threshold_objective_weights'):
+            if self.config['Validation']['optimal_threshold_objective_weights'].split('#')[0].strip() != '':
+                self.validation_optimal_threshold_objective_weights = [float(x.strip()) for x in self.config['Validation']['optimal_threshold_objective_weights'].split('#')[0].strip().split(',')]
+        if len(self.validation_optimal_threshold_objective_weights) != 2:
+            raise ValueError('Two weights (Dice and F1-score) are expected for the optimal threshold objective, got {}.'.format(self.validation_optimal_threshold_objective_weights))
+
+        if 'SurfDice' in self.validation_metric_names:
+            index = self.validation_metric_names.index('SurfDice')
+            self.validation_metric_names[index:index + 1] = ['SurfDice@{}'.format(x) for x in
+                                                             self.validation_surface_dice_tolerances]
+
+    @staticmethod
+    def __parse_probability_thresholds(value):
+        """
+        Convert the user-specified probability thresholds, either a comma-separated list or a start:stop:step range
+        (where stop is included), to a sorted list of unique values in [0., 1.].
+        """
+        if ':' in value:
+            start, stop, step = [float(x.strip()) for x in value.split(':')]
+            if step <= 0.:
+                raise ValueError('The step of the probability thresholds range must be positive, got {}.'.format(step))
+            # The tolerance only absorbs the rounding errors, the values beyond stop being left out
+            nb_values = int(math.floor((stop - start) / step + 1e-9)) + 1
+            thresholds = [start + (x * step) for x in range(nb_values)]
+        else:
+            thresholds = [float(x.strip()) for x in value.split(',')]
+        thresholds = sorted(set([round(x, 4) for x in thresholds]))
+        if len(thresholds) == 0 or thresholds[0] < 0. or thresholds[-1] > 1.:
+            raise ValueError('The probability thresholds must be in [0., 1.], got {}.'.format(value))
+        return thresholds
@@ -0,0 +1,126 @@
+import io
+import json
+import os
+import pandas as pd
+from typing import List
+
+from ..Utils.results_store import read_results_table, write_results_table, results_table_exists
+
+
+class ResultsJournal:
+    """
+    Results table (e.g., all_dice_scores.csv) kept in memory with an index on its (Fold, Patient, Threshold) rows, where
+    the modified rows are appended to a journal file next to the csv file instead of rewriting the whole table.
+    Each commit is written as a single line, flushed and synced to disk, such that a crash can only lose the last
+    incomplete commit. The journal is replayed upon loading the table, and compacted into the results files (with the
+    rows of each patient contiguous and sorted by increasing probability threshold) with compact().
+    """
+    def __init__(self, filename: str, columns: List[str]) -> None:
+        """
+        :param filename: csv file holding the results table.
+        :param columns: columns expected in the table, appended to the columns of an existing csv file if missing.
+        """
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.columns = list(columns)
+        self._rows = {}
+        self._pending_keys = []
+
+        if results_table_exists(self.filename):
+            results_df = read_results_table(self.filename)
+            if results_df.columns[0] != 'Fold':
+                results_df = results_df.iloc[:, 1:]
+            self.columns = list(results_df.columns) + [x for x in self.columns if x not in list(results_df.columns)]
+            self.__load_rows(results_df)
+        if os.path.exists(self.journal_filename):
+            self.__replay()
+            self.compact()
+
+    @staticmethod
+    def get_key(fold, patient, threshold) -> tuple:
+        return int(fold), str(patient), round(float(threshold), 4)
+
+    def get_row(self, fold, patient, threshold) -> List:
+        """
+        Values of the row for the given fold, patient, and probability threshold, or None if missing.
+        """
+        return self._rows.get(self.get_key(fold, patient, threshold))
+
+    def set_row(self, values: List) -> None:
+        """
+        Insert or update a row, from the values of its first columns (starting with Fold, Patient, and Threshold).
+        The values of the remaining columns are kept from the existing row, or left empty for a new row.
+        """
+        key = self.get_key(values[0], values[1], values[2])
+        previous_values = self._rows.get(key, [None] * len(self.columns))
+        self._rows[key] = list(values) + previous_values[len(values):]
+        self._pending_keys.append(key)
+
+    def set_values(self, fold, patient, threshold, values: dict) -> None:
+        """
+        Update some columns of an existing row, given as a dictionary of column names and values.
+        """
+        key = self.get_key(fold, patient, threshold)
+        self.__add_columns(list(values.keys()))
+        row = self._rows[key]
+        for column, value in values.items():
+            row[self.columns.index(column)] = value
+        self._pending_keys.append(key)
+
+    def commit(self) -> None:
+        """
+        Append the rows modified since the last commit to the journal file.
+        """
+        if len(self._pending_keys) == 0:
+            return
+        keys = list(dict.fromkeys(self._pending_keys))
+        rows_df = pd.DataFrame([self._rows[k] for k in keys], columns=self.columns, dtype=object)
+        with open(self.journal_filename, 'a') as f:
+            f.write(json.dumps({'rows': rows_df.to_csv(index=False)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending_keys = []
+
+    def compact(self) -> None:
+        """
+        Write the whole table to the results files, and discard the journal.
+        """
+        self.commit()
+        write_results_table(self.to_dataframe(), self.filename)
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Table with the rows of each patient contiguous and sorted by increasing probability threshold, with the patients
+        in their original order, as expected when reading back the results files.
+        """
+        patients_order = {}
+        for key in self._rows:
+            patients_order.setdefault(key[:2], len(patients_order))
+        keys = sorted(self._rows, key=lambda k: (patients_order[k[:2]], k[2]))
+        return pd.DataFrame([self._rows[k] for k in keys], columns=self.columns, dtype=object)
+
+    def __add_columns(self, columns: List[str]) -> None:
+        missing_columns = [x for x in columns if x not in self.columns]
+        self.columns.extend(missing_columns)
+        for row in self._rows.values():
+            row.extend([None] * len(missing_columns))
+
+    def __load_rows(self, results_df: pd.DataFrame) -> None:
+        results_df = results_df.reindex(columns=self.columns)
+        results_df['Patient'] = results_df.Patient.astype(str)
+        for values in results_df.astype(object).where(results_df.notnull(), None).values.tolist():
+            self._rows[self.get_key(values[0], values[1], values[2])] = values
+
+    def __replay(self) -> None:
+        with open(self.journal_filename, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Incomplete last commit, interrupted by a crash
+                    break
+                rows_df = pd.read_csv(io.StringIO(record['rows']))
+                self.__add_columns(list(rows_df.columns))
+                self.__load_rows(rows_df)
@@ -0,0 +1,94 @@
+import os
+import pandas as pd
+from typing import List
+
+from ..Utils.resources import SharedResources
+
+COLUMNAR_RESULTS_FORMATS = ['feather', 'parquet']
+
+
+def get_results_filename(filename: str, results_format: str) -> str:
+    """
+    Filename of a results table for the given format, from the name of its csv file.
+    """
+    return os.path.splitext(filename)[0] + '.' + results_format
+
+
+def to_typed_results(results_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Results table with a fixed schema, where Fold is an integer, Patient a string, True Positive a boolean (possibly
+    missing), and all the remaining columns are floating-point values (with missing values as NaN and 'inf' as
+    infinity). In the class-averaged tables, True Positive holds the fraction of true positive classes instead, and
+    is kept as a floating-point value.
+    """
+    typed_df = pd.DataFrame(index=results_df.index)
+    for column in results_df.columns:
+        values = results_df[column]
+        if column == 'Fold':
+            typed_df[column] = pd.to_numeric(values).astype('int64')
+        elif column == 'Patient':
+            typed_df[column] = values.astype(str)
+        elif column == 'True Positive':
+            flags = values.dropna().astype(str)
+            if flags.isin(['True', 'False']).all():
+                typed_df[column] = values.map(lambda x: None if pd.isnull(x) else str(x) == 'True')
+            else:
+                typed_df[column] = pd.to_numeric(values, errors='coerce').astype('float64')
+        else:
+            typed_df[column] = pd.to_numeric(values, errors='coerce').astype('float64')
+    return typed_df.reset_index(drop=True)
+
+
+def write_results_table(results_df: pd.DataFrame, filename: str, formats: List[str] = None) -> None:
+    """
+    Save a results table in all the requested formats, the csv file being written as is and the columnar files
+    (Feather or Parquet) with typed columns. Each file is written atomically.
+    :param results_df: results table to save.
+    :param filename: csv filename of the table, the columnar files being placed next to it.
+    :param formats: list of formats to write, from [csv, feather, parquet] (default to the configuration file).
+    """
+    if formats is None:
+        formats = SharedResources.getInstance().validation_results_formats
+    for results_format in formats:
+        format_filename = get_results_filename(filename, results_format)
+        tmp_filename = format_filename + '.tmp'
+        if results_format == 'csv':
+            results_df.to_csv(tmp_filename, index=False)
+        elif results_format == 'feather':
+            # Uncompressed to be memory-mapped without any copy upon loading
+            to_typed_results(results_df).to_feather(tmp_filename, compression='uncompressed')
+        elif results_format == 'parquet':
+            to_typed_results(results_df).to_parquet(tmp_filename, index=False)
+        else:
+            raise ValueError('Unsupported results format: {}.'.format(results_format))
+        os.replace(tmp_filename, format_filename)
+
+
+def read_results_table(filename: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Load a results table, from its columnar file (memory-mapped) if available and at least as recent as the csv file,
+    or from the csv file otherwise.
+    :param filename: csv filename of the table.
+    :param columns: (optional) list of columns to load, all columns being loaded if not provided.
+    :return: pd.DataFrame with the results table.
+    """
+    csv_mtime = os.path.getmtime(filename) if os.path.exists(filename) else None
+    for results_format in COLUMNAR_RESULTS_FORMATS:
+        format_filename = get_results_filename(filename, results_format)
+        if os.path.exists(format_filename) and (csv_mtime is None or os.path.getmtime(format_filename) >= csv_mtime):
+            if results_format == 'feather':
+                from pyarrow import feather
+                table = feather.read_table(format_filename, columns=columns, memory_map=True)
+            else:
+                from pyarrow import parquet
+                table = parquet.read_table(format_filename, columns=columns, memory_map=True)
+            return table.to_pandas()
+
+    results_df = pd.read_csv(filename, usecols=columns)
+    if columns is not None:
+        results_df = results_df[columns]
+    return results_df
+
+
+def results_table_exists(filename: str) -> bool:
+    return True in [os.path.exists(get_results_filename(filename, x)) for x in ['csv'] + COLUMNAR_RESULTS_FORMATS]
@@ -0,0 +1,92 @@
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+# Shared memory blocks attached in the current (worker) process, by name. Attaching only once per process avoids
+# mapping the same volume again for every task, and the oldest blocks are detached when no longer needed.
+_attached_blocks = OrderedDict()
+_max_attached_blocks = 16
+
+
+class SharedVolume:
+    """
+    Array placed once in shared memory to be handed to the processes of a multiprocessing.Pool. Only the name, shape,
+    and type of the block are pickled for each task, and the processes access the array through a zero-copy view.
+    The process creating the volume owns the shared memory block, and must release it once all tasks are done.
+    """
+    def __init__(self, array: np.ndarray) -> None:
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self._block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._block.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._block.buf)[...] = array
+
+    def __getstate__(self) -> dict:
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        Read-only view on the shared array, attaching to the shared memory block if needed.
+        """
+        block = self._block if self._block is not None else _attach_block(self.name)
+        view = np.ndarray(self.shape, dtype=self.dtype, buffer=block.buf)
+        view.flags.writeable = False
+        return view
+
+    def release(self) -> None:
+        """
+        Free the shared memory block, only to be called by the process which created the volume.
+        """
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+
+def _attach_block(name: str) -> shared_memory.SharedMemory:
+    if name in _attached_blocks:
+        _attached_blocks.move_to_end(name)
+        return _attached_blocks[name]
+
+    block = shared_memory.SharedMemory(name=name)
+    _attached_blocks[name] = block
+    while len(_attached_blocks) > _max_attached_blocks:
+        _, oldest_block = _attached_blocks.popitem(last=False)
+        try:
+            oldest_block.close()
+        except BufferError:
+            # A view on the block is still in use, the block will be detached once the view is garbage collected.
+            pass
+    return block
+
+
+def get_volume_array(volume) -> np.ndarray:
+    """
+    Array behind a volume given either directly as a np.ndarray, or as a SharedVolume.
+    """
+    return volume.array if isinstance(volume, SharedVolume) else volume
+
+
+def share_volume(array: np.ndarray, backend: str = 'process'):
+    """
+    Volume to hand to the workers of a pool, placed in shared memory for processes, and given as is for threads which
+    directly share the memory of the main process.
+    """
+    return SharedVolume(array) if backend == 'process' else array
+
+
+def release_volume(volume) -> None:
+    if isinstance(volume, SharedVolume):
+        volume.release()
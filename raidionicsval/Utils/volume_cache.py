@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+import traceback
+import uuid
+import numpy as np
+from typing import Callable
+
+from ..Utils.resources import SharedResources
+
+_volume_cache = None
+
+
+class VolumeCache:
+    """
+    On-disk cache of the decoded volumes, stored as raw .npy files which are memory-mapped on later runs instead of
+    decompressing the source files again.
+    Each entry is keyed by the path, size, and modification time of the source file (and optionally its content hash),
+    and by the kind of decoding applied (e.g., binary ground truth or float32 probabilities), such that any change to
+    the source file leads to a new entry, while a cache hit does not read the source file at all. The least recently
+    used entries are evicted once the cache exceeds its maximum size.
+    The entries are written atomically, such that a partially written entry is never loaded. The evictions are only
+    serialized between the threads of a process, an entry evicted by another process being decoded again if needed.
+    """
+    def __init__(self, folder: str, max_size: float = 10240, content_hash: bool = False) -> None:
+        """
+        :param folder: folder where the cache entries are stored (will be created if non-existing).
+        :param max_size: maximum size of the cache on disk, in MB.
+        :param content_hash: whether the content of the source files is part of the keys, at the cost of reading the
+        whole source file for every load.
+        """
+        self.folder = folder
+        self.max_size = max_size * 1e6
+        self.content_hash = content_hash
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_key(self, filename: str, kind: str) -> str:
+        stats = os.stat(filename)
+        description = [os.path.abspath(filename), stats.st_size, stats.st_mtime_ns, kind]
+        if self.content_hash:
+            content_hash = hashlib.blake2b(digest_size=16)
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**22), b''):
+                    content_hash.update(chunk)
+            description.append(content_hash.hexdigest())
+        return hashlib.blake2b(json.dumps(description).encode(), digest_size=20).hexdigest()
+
+    def load(self, filename: str, kind: str, decoder: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Volume decoded from the given file, memory-mapped (read-only) from the cache if available, or decoded and then
+        stored in the cache otherwise.
+        :param filename: source file of the volume.
+        :param kind: description of the decoding, part of the cache key.
+        :param decoder: function decoding the volume from the source file.
+        :return: np.ndarray with the decoded volume.
+        """
+        entry_filename = os.path.join(self.folder, self.get_key(filename, kind) + '.npy')
+        if os.path.exists(entry_filename):
+            try:
+                volume = np.load(entry_filename, mmap_mode='r')
+                # Marking the entry as recently used
+                os.utime(entry_filename)
+                return volume
+            except (OSError, ValueError):
+                # The entry might have been evicted by another process in the meantime
+                pass
+
+        volume = decoder()
+        try:
+            self.__store(entry_filename, volume)
+        except OSError:
+            print('Issue storing the decoded volume for {} in the cache.'.format(filename))
+            print(traceback.format_exc())
+        return volume
+
+    def __store(self, entry_filename: str, volume: np.ndarray) -> None:
+        if volume.nbytes > self.max_size:
+            return
+        tmp_filename = os.path.join(self.folder, '.' + uuid.uuid4().hex + '.npy')
+        np.save(tmp_filename, np.ascontiguousarray(volume))
+        os.replace(tmp_filename, entry_filename)
+        self.__evict()
+
+    def __evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in its maximum size, the entries which cannot be
+        removed being skipped.
+        """
+        with self._lock:
+            entries = []
+            for f in os.listdir(self.folder):
+                if f.endswith('.npy') and not f.startswith('.'):
+                    try:
+                        stats = os.stat(os.path.join(self.folder, f))
+                        entries.append([stats.st_mtime_ns, stats.st_size, f])
+                    except OSError:
+                        continue
+            total_size = sum([x[1] for x in entries])
+            for _, size, f in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.folder, f))
+                    total_size -= size
+                except OSError:
+                    # E.g., an entry still memory-mapped cannot be removed on Windows, the next ones being evicted
+                    continue
+
+
+def get_volume_cache():
+    """
+    Cache of decoded volumes as set in the configuration file, or None if no cache folder has been provided.
+    """
+    global _volume_cache
+    folder = SharedResources.getInstance().validation_volume_cache_folder
+    if folder is None or folder == '':
+        return None
+    content_hash = SharedResources.getInstance().validation_volume_cache_content_hash
+    if _volume_cache is None or _volume_cache.folder != folder or _volume_cache.content_hash != content_hash:
+        _volume_cache = VolumeCache(folder, max_size=SharedResources.getInstance().validation_volume_cache_size,
+                                    content_hash=content_hash)
+    return _volume_cache
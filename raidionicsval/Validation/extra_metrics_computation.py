@@ -2,43 +2,78 @@ import logging
 import math
 import os
 import traceback
-import itertools
-import multiprocessing
 from copy import deepcopy
 import pandas as pd
-import nibabel as nib
 import numpy as np
 from typing import List
 # from medpy.metric.binary import hd95, volume_correlation, assd, ravd, obj_assd
-from sklearn.metrics import jaccard_score, normalized_mutual_info_score, roc_auc_score, cohen_kappa_score
 from ..Utils.resources import SharedResources
-from ..Computation.medpy_metrics import (compute_hd95, compute_assd, compute_ravd, compute_volume_correlation,
-                                         compute_object_assd)
-
-
-def compute_patient_extra_metrics(patient_object, class_index, optimal_threshold, metrics: List[str] = []):
+from ..Utils.io_converters import ClassVolumes
+from ..Utils.results_store import read_results_table
+from ..Utils.shared_volumes import SharedVolume, get_volume_array, release_volume
+from ..Utils.parallel_backend import get_parallel_backend
+from ..Computation.medpy_metrics import compute_volume_correlation, SurfaceDistances
+from ..Computation.cropping_computation import compute_union_bounding_box
+from ..Computation.confusion_computation import (compute_probability_histograms, compute_roc_auc_from_histograms,
+                                                 compute_average_precision_from_histograms)
+
+# Metrics which are closed-form functions of the voxel-wise confusion counts, and which can therefore be computed
+# without accessing the ground truth and detection volumes.
+COUNT_BASED_METRICS = ['VS', 'GCE', 'MI', 'RI', 'ARI', 'VOI', 'Jaccard', 'IOU', 'TPR', 'TNR', 'FPR', 'FNR', 'PPV',
+                       'MCC', 'CKS', 'RAVD', 'ProbD']
+# Threshold-free metrics computed from the raw probability map, through the histograms of the probabilities inside and
+# outside the ground truth.
+PROBABILITY_BASED_METRICS = ['AUC', 'AP']
+# Metrics derived from the distances between the ground truth and detection, computed together from a single
+# SurfaceDistances object. The surface Dice metrics are named after their tolerance in mm, e.g., SurfDice@2.0.
+SURFACE_METRICS = ['HD95', 'HD99', 'HD100', 'ASSD', 'OASSD']
+SURFACE_DICE_PREFIX = 'SurfDice@'
+
+
+def is_surface_metric(metric: str) -> bool:
+    return metric in SURFACE_METRICS or metric.startswith(SURFACE_DICE_PREFIX)
+
+
+def prepare_patient_extra_metrics(patient_object, class_index, optimal_threshold, metrics: List[str] = []):
+    """
+    First step of the extra metrics computation for one patient and class, at the optimal probability threshold.
+    The metrics derived from the confusion counts or the probability histograms are cheap and directly computed, while
+    the metrics requiring the voxel arrays are grouped into tasks for parallel_metric_computation, to be run in
+    parallel with the tasks from other patients. All surface metrics are grouped in a single task, to share the borders
+    and distance transforms.
+    :return: the list of [metric name, metric value] pairs in the order of the metrics (with None for the metrics
+    computed by the tasks), the list of tasks arguments, and the list of the estimated cost of each task.
+    """
     extra_metrics_results = []
     try:
-        if (patient_object.get_optimal_class_extra_metrics(class_index, optimal_threshold) is not None and
-                patient_object.get_optimal_class_extra_metrics(class_index, optimal_threshold)[1:] is not None):
-            metric_values = [x[1] for x in patient_object.get_optimal_class_extra_metrics(class_index, optimal_threshold)[1:]]
-            if False not in [x == x for x in metric_values]:
+        optimal_extra_metrics = patient_object.get_optimal_class_extra_metrics(class_index, optimal_threshold)
+        if optimal_extra_metrics is not None:
+            stored_metrics = dict(optimal_extra_metrics[1:])
+            metric_values = [stored_metrics.get(x) for x in metrics]
+            if False not in [x == x and x is not None for x in metric_values]:
                 # If all metric values have been computed, i.e., no nan or None etc...
-                return patient_object.get_optimal_class_extra_metrics(class_index, optimal_threshold)[1:]
+                return [[x, stored_metrics[x]] for x in metrics], [], []
         else:
             metric_values = [None] * len(metrics)
 
-        ground_truth_ni = nib.load(patient_object._ground_truth_filepaths[class_index])
-        detection_ni = nib.load(patient_object._prediction_filepaths[class_index])
-
-        gt = ground_truth_ni.get_fdata()
-        gt[gt >= 1] = 1
-        gt = gt.astype('uint8')
-
-        detection = detection_ni.get_fdata()[:]
-        detection[detection < optimal_threshold] = 0
-        detection[detection >= optimal_threshold] = 1
-        detection = detection.astype('uint8')
+        # Reusing the volumes kept from the probability thresholds sweep, if any, instead of loading them again
+        # (the probability histograms requiring the whole prediction, unless computed during the sweep).
+        volumes = patient_object.get_class_volumes(class_index)
+        probability_histograms = patient_object.get_class_probability_histograms(class_index)
+        missing_histograms = len([x for x in metrics if x in PROBABILITY_BASED_METRICS]) != 0 and\
+            probability_histograms is None
+        if volumes is None or not volumes.is_valid_for(optimal_threshold) or\
+                (missing_histograms and volumes.crop_threshold is not None):
+            volumes = ClassVolumes(*patient_object.get_class_filenames(class_index),
+                                   dtype=SharedResources.getInstance().validation_probability_dtype)
+        ground_truth_ni = volumes.ground_truth_ni
+        detection_ni = volumes.detection_ni
+        gt = volumes.gt
+
+        if missing_histograms:
+            probability_histograms = compute_probability_histograms(gt, volumes.probabilities)
+            patient_object.set_class_probability_histograms(class_index, probability_histograms)
+        detection = (volumes.probabilities >= optimal_threshold).astype('uint8')
 
         # # Cleaning the too small objects that might be noise in the detection
         # if np.count_nonzero(detection) > 0:
@@ -51,89 +86,259 @@ def compute_patient_extra_metrics(patient_object, class_index, optimal_threshold
         #     refined_image[refined_image != 0] = 1
         #     detection = refined_image
 
-        tp_array = np.zeros(detection.shape)
-        fp_array = np.zeros(detection.shape)
-        tn_array = np.zeros(detection.shape)
-        fn_array = np.zeros(detection.shape)
-
-        tp_array[(gt == 1) & (detection == 1)] = 1
-        fp_array[(gt == 0) & (detection == 1)] = 1
-        tn_array[(gt == 0) & (detection == 0)] = 1
-        fn_array[(gt == 1) & (detection == 0)] = 1
-
-        # N-B: Sometimes unstable: it will hang forever if the image is too large it seems...
-        # If so, just use 1 process
-        # @TODO. Have to investigate how to fix or bypass the issue, should we resample to [1,1,1] to compute the metrics
-        if SharedResources.getInstance().number_processes > 1:
-            try:
-                pool = multiprocessing.Pool(processes=SharedResources.getInstance().number_processes)
-                extra_metrics_results = pool.map(parallel_metric_computation, zip(metrics, metric_values,
-                                                                                  itertools.repeat(gt),
-                                                                                  itertools.repeat(detection),
-                                                                                  itertools.repeat(detection_ni.header),
-                                                                                  itertools.repeat(ground_truth_ni.header),
-                                                                                  itertools.repeat(tp_array),
-                                                                                  itertools.repeat(tn_array),
-                                                                                  itertools.repeat(fp_array),
-                                                                                  itertools.repeat(fn_array)))
-                pool.close()
-                pool.join()
-            except Exception as e:
-                print("Issue computing metrics for patient {} in the multiprocessing loop.".format(patient_object.unique_id))
-                print(traceback.format_exc())
-        else:
-            for metric in metrics:
+        # Restricting the voxel-level computations to the region around the ground truth and detection, all voxels
+        # outside being true negatives which are added back to the counts.
+        nb_voxels = int(np.prod(volumes.shape))
+        crop = compute_union_bounding_box([gt, detection], margin=SharedResources.getInstance().validation_crop_margin)
+        if crop is not None:
+            gt = gt[crop]
+            detection = detection[crop]
+
+        tp = np.count_nonzero((gt == 1) & (detection == 1))
+        fp = np.count_nonzero((gt == 0) & (detection == 1))
+        fn = np.count_nonzero((gt == 1) & (detection == 0))
+        tn = nb_voxels - tp - fp - fn
+
+        voxel_metrics = [x for x in metrics if x not in COUNT_BASED_METRICS + PROBABILITY_BASED_METRICS]
+        voxel_tasks = [x for x in voxel_metrics if not is_surface_metric(x)]
+        voxel_task_values = [metric_values[metrics.index(x)] for x in voxel_tasks]
+        surface_metrics = [x for x in voxel_metrics if is_surface_metric(x)]
+        if len(surface_metrics) != 0:
+            voxel_tasks.append(surface_metrics)
+            voxel_task_values.append([metric_values[metrics.index(x)] for x in surface_metrics])
+        tasks = [[task, task_values, gt, detection, detection_ni.header, ground_truth_ni.header, tp, tn, fp, fn]
+                 for task, task_values in zip(voxel_tasks, voxel_task_values)]
+        tasks_costs = [estimate_metric_task_cost(task, gt, detection) for task in voxel_tasks]
+
+        # Keeping the same ordering as the list of metrics to compute
+        for metric in metrics:
+            if metric in COUNT_BASED_METRICS:
                 try:
-                    metric_value = compute_specific_metric_value(metric=metric, gt=gt, detection=detection,
-                                                                 tp=np.sum(tp_array), tn=np.sum(tn_array),
-                                                                 fp=np.sum(fp_array), fn=np.sum(fn_array),
-                                                                 gt_ni_header=ground_truth_ni.header,
-                                                                 det_ni_header=detection_ni.header)
-                    extra_metrics_results.append([metric, metric_value])
+                    extra_metrics_results.append([metric, compute_count_based_metric_value(metric, tp=tp, fp=fp,
+                                                                                           fn=fn, tn=tn)])
                 except Exception as e:
                     print('Issue computing metric {} for patient {}'.format(metric, patient_object.unique_id))
                     print(traceback.format_exc())
+            elif metric in PROBABILITY_BASED_METRICS:
+                try:
+                    extra_metrics_results.append([metric, compute_probability_based_metric_value(metric,
+                                                                                                 *probability_histograms)])
+                except Exception as e:
+                    print('Issue computing metric {} for patient {}'.format(metric, patient_object.unique_id))
+                    print(traceback.format_exc())
+            else:
+                extra_metrics_results.append([metric, None])
     except Exception as e:
         print('Global issue computing metrics for patient {}'.format(patient_object.unique_id))
         print(traceback.format_exc())
+        return [], [], []
+
+    return extra_metrics_results, tasks, tasks_costs
+
+
+def collect_patient_extra_metrics(extra_metrics_results: List, tasks_results: List) -> List:
+    """
+    Last step of the extra metrics computation for one patient and class, filling in the values computed by the tasks
+    from prepare_patient_extra_metrics.
+    :param extra_metrics_results: list of [metric name, metric value] pairs from prepare_patient_extra_metrics.
+    :param tasks_results: list with the results from parallel_metric_computation for each task.
+    :return: list of [metric name, metric value] pairs, in the order of the metrics.
+    """
+    computed_values = dict([x for task_results in tasks_results for x in task_results])
+    return [[metric, computed_values[metric]] if metric in computed_values else [metric, value]
+            for metric, value in extra_metrics_results]
+
+
+def share_extra_metrics_tasks_volumes(tasks: List) -> List:
+    """
+    Place the ground truth and detection volumes, common to all tasks of a patient, once in shared memory when
+    using a pool of processes (threads directly sharing the volumes).
+    The volumes must be released with release_extra_metrics_tasks_volumes once all tasks are done.
+    """
+    if len(tasks) == 0 or get_parallel_backend() != 'process':
+        return tasks
+    shared_gt = SharedVolume(tasks[0][2])
+    shared_detection = SharedVolume(tasks[0][3])
+    return [task[:2] + [shared_gt, shared_detection] + task[4:] for task in tasks]
+
+
+def release_extra_metrics_tasks_volumes(tasks: List) -> None:
+    for task in tasks:
+        for volume in task[2:4]:
+            release_volume(volume)
+
+
+def estimate_metric_task_cost(metrics, gt: np.ndarray, detection: np.ndarray) -> float:
+    """
+    Rough estimate of the cost of a task from prepare_patient_extra_metrics, in number of voxels processed, used to
+    start the most expensive tasks first. The surface metrics require two distance transforms over the volume for the
+    surface distances, and two more for the volume distances (ASSD and OASSD), while the other metrics are of the order
+    of a single pass over the volume.
+    """
+    metrics = metrics if isinstance(metrics, list) else [metrics]
+    nb_passes = 0
+    if True in [is_surface_metric(x) and x not in ['ASSD', 'OASSD'] for x in metrics]:
+        nb_passes += 2
+    if True in [x in ['ASSD', 'OASSD'] for x in metrics]:
+        nb_passes += 2
+    nb_passes += len([x for x in metrics if not is_surface_metric(x)])
+    return float(nb_passes * gt.size)
+
 
-    return extra_metrics_results
+def compute_patient_probability_histograms(patient_object, class_index):
+    """
+    Histograms of the prediction probabilities inside and outside the ground truth for the given patient and class,
+    used to aggregate the patient-wise distributions into cohort-level ROC and precision-recall curves.
+    :return: tuple with the histograms of the positive and negative voxels.
+    """
+    volumes = ClassVolumes(patient_object._ground_truth_filepaths[class_index],
+                           patient_object._prediction_filepaths[class_index],
+                           SharedResources.getInstance().validation_probability_dtype)
+    probability_histograms = compute_probability_histograms(volumes.gt, volumes.probabilities)
+    patient_object.set_class_probability_histograms(class_index, probability_histograms)
+    return probability_histograms
 
 
 def parallel_metric_computation(args):
     """
     Metrics computation method linked to the multiprocessing strategy. Effectively where the call to compute is made.
-    :param args: list of arguments split from the lists given to the multiprocessing.Pool call.
-    :return: list with metric name and computed metric value.
+    :param args: list of arguments split from the lists given to the multiprocessing.Pool call. The first two
+    arguments are either a metric name and its current value, or lists of surface metric names and current values to
+    compute together from the same SurfaceDistances object. The ground truth and detection can be given as
+    SharedVolume, to avoid pickling them for every task.
+    :return: list of [metric name, computed metric value] pairs.
     """
-    metric = args[0]
-    metric_value = args[1] #args[1][1]
-    gt = args[2]
-    detection = args[3]
+    metrics = args[0] if isinstance(args[0], list) else [args[0]]
+    metric_values = args[1] if isinstance(args[0], list) else [args[1]]
+    gt = get_volume_array(args[2])
+    detection = get_volume_array(args[3])
     det_header = args[4]
     gt_header = args[5]
-    tp_array = args[6]
-    tn_array = args[7]
-    fp_array = args[8]
-    fn_array = args[9]
+    tp = args[6]
+    tn = args[7]
+    fp = args[8]
+    fn = args[9]
+
+    results = []
+    surface_distances = SurfaceDistances(detection, gt, voxelspacing=det_header.get_zooms())
+    for metric, metric_value in zip(metrics, metric_values):
+        if metric_value == metric_value and metric_value is not None:
+            results.append([metric, metric_value])
+            continue
+
+        try:
+            metric_value = compute_specific_metric_value(metric=metric, gt=gt, detection=detection,
+                                                         tp=tp, tn=tn, fp=fp, fn=fn,
+                                                         gt_ni_header=gt_header,
+                                                         det_ni_header=det_header,
+                                                         surface_distances=surface_distances)
+        except Exception as e:
+            print('Computing {} gave an exception'.format(metric))
+            pass
+        results.append([metric, metric_value])
+
+    return results
+
+
+def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_header, det_ni_header,
+                                  surface_distances=None):
+    metric_value = None
+    if metric in COUNT_BASED_METRICS:
+        metric_value = compute_count_based_metric_value(metric, tp=tp, fp=fp, fn=fn, tn=tn)
+    elif is_surface_metric(metric):
+        metric_value = math.inf
+        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
+            if surface_distances is None:
+                surface_distances = SurfaceDistances(detection, gt, voxelspacing=det_ni_header.get_zooms())
+            metric_value = compute_surface_metric_value(metric, surface_distances)
+        elif metric.startswith(SURFACE_DICE_PREFIX) and (np.max(gt) == 1 or np.max(detection) == 1):
+            metric_value = 0.
+    elif metric == 'VC':
+        metric_value = math.inf
+        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
+            metric_value, pval = compute_volume_correlation(detection, gt,
+                                                            nb_slices=det_ni_header.get_data_shape()[0])
+    elif metric == 'MahaD':
+        metric_value = math.inf
+        gt_n = np.count_nonzero(detection)
+        seg_n = np.count_nonzero(gt)
 
-    if metric_value == metric_value and metric_value is not None:
-        return [metric, metric_value]
+        if gt_n != 0 and seg_n != 0:
+            gt_indices = np.flip(np.where(gt == 1), axis=0)
+            gt_mean = gt_indices.mean(axis=1)
+            gt_cov = np.cov(gt_indices)
 
-    try:
-        metric_value = compute_specific_metric_value(metric=metric, gt=gt, detection=detection,
-                                                     tp=np.sum(tp_array), tn=np.sum(tn_array),
-                                                     fp=np.sum(fp_array), fn=np.sum(fn_array),
-                                                     gt_ni_header=gt_header,
-                                                     det_ni_header=det_header)
-    except Exception as e:
-        print('Computing {} gave an exception'.format(metric))
-        pass
+            seg_indices = np.flip(np.where(detection == 1), axis=0)
+            seg_mean = seg_indices.mean(axis=1)
+            seg_cov = np.cov(seg_indices)
 
-    return [metric, metric_value]
+            # calculate common covariance matrix
+            common_cov = (gt_n * gt_cov + seg_n * seg_cov) / (gt_n + seg_n)
+            common_cov_inv = np.linalg.inv(common_cov)
+
+            mean = gt_mean - seg_mean
+            metric_value = math.sqrt(mean.dot(common_cov_inv).dot(mean.T))
+    else:
+        logging.warning("Metric with name {} has not been implemented!".format(metric))
+    return metric_value
+
+
+def compute_surface_metric_value(metric, surface_distances):
+    """
+    Compute a distance-based metric from the SurfaceDistances object shared by all surface metrics of a patient,
+    where the borders and distance transforms are only computed once.
+    :param metric: name of the metric, from SURFACE_METRICS or starting with SURFACE_DICE_PREFIX.
+    :param surface_distances: SurfaceDistances object, with the detection as result and the ground truth as reference.
+    :return: the metric value.
+    """
+    metric_value = None
+    if metric == 'HD95':
+        metric_value = surface_distances.hausdorff_distance(percentile=95)
+    elif metric == 'HD99':
+        metric_value = surface_distances.hausdorff_distance(percentile=99)
+    elif metric == 'HD100':
+        metric_value = surface_distances.hausdorff_distance(percentile=100)
+    elif metric == 'ASSD' or metric == 'OASSD':
+        # With binary masks, the foreground is the only object and the object-wise ASSD is equal to the ASSD
+        metric_value = surface_distances.average_symmetric_distance()
+    elif metric.startswith(SURFACE_DICE_PREFIX):
+        metric_value = surface_distances.surface_dice(tolerance=float(metric[len(SURFACE_DICE_PREFIX):]))
+    else:
+        logging.warning("Metric with name {} has not been implemented!".format(metric))
+    return metric_value
+
+
+def compute_probability_based_metric_value(metric, inside_histogram, outside_histogram):
+    """
+    Compute a threshold-free metric from the histograms of the prediction probabilities inside and outside the
+    ground truth, i.e., using the soft probability map rather than the binarized detection.
+    :param metric: name of the metric, from PROBABILITY_BASED_METRICS.
+    :return: the metric value, or math.inf when the metric is undefined.
+    """
+    metric_value = None
+    if metric == 'AUC':
+        metric_value = compute_roc_auc_from_histograms(inside_histogram, outside_histogram)
+    elif metric == 'AP':
+        metric_value = compute_average_precision_from_histograms(inside_histogram, outside_histogram)
+    else:
+        logging.warning("Metric with name {} has not been implemented!".format(metric))
+    return metric_value
 
 
-def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_header, det_ni_header):
+def compute_count_based_metric_value(metric, tp, fp, fn, tn):
+    """
+    Compute a metric from the voxel-wise confusion counts only, without accessing the voxel arrays.
+    The counts are converted to float beforehand, to avoid integer overflows on large volumes.
+    :param metric: name of the metric, from COUNT_BASED_METRICS.
+    :param tp: number of true positive voxels.
+    :param fp: number of false positive voxels.
+    :param fn: number of false negative voxels.
+    :param tn: number of true negative voxels.
+    :return: the metric value, or math.inf when the metric is undefined for the given counts (math.nan for CKS, as
+    returned by sklearn's cohen_kappa_score).
+    """
+    tp, fp, fn, tn = float(tp), float(fp), float(fn), float(tn)
+    total = tp + fp + fn + tn
     metric_value = None
     if metric == 'VS':
         metric_value = math.inf
@@ -146,18 +351,34 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
             param12 = (fp * (fp + (2 * tn))) / (tn + fp)
             param21 = (fp * (fp + (2 * tp))) / (tp + fp)
             param22 = (fn * (fn + (2 * tn))) / (tn + fn)
-            metric_value = (1 / np.prod(gt_ni_header.get_data_shape()[0:3])) * min(param11 + param12, param21 + param22)
+            metric_value = (1 / total) * min(param11 + param12, param21 + param22)
         else:
             metric_value = math.inf
     elif metric == 'MI':
-        metric_value = normalized_mutual_info_score(gt.flatten(), detection.flatten())
+        # Normalized mutual information (arithmetic normalization) between the two binary labelings
+        gt_marginals = [x for x in [tp + fn, tn + fp] if x != 0]
+        det_marginals = [x for x in [tp + fp, tn + fn] if x != 0]
+        if len(gt_marginals) == 1 and len(det_marginals) == 1:
+            # Limit case where none of the labelings is split
+            metric_value = 1.
+        elif len(gt_marginals) == 1 or len(det_marginals) == 1:
+            metric_value = 0.
+        else:
+            mi = 0.
+            for joint, gt_marginal, det_marginal in [(tp, tp + fn, tp + fp), (fn, tp + fn, tn + fn),
+                                                     (fp, tn + fp, tp + fp), (tn, tn + fp, tn + fn)]:
+                if joint != 0:
+                    mi += (joint / total) * math.log((joint * total) / (gt_marginal * det_marginal))
+            h_gt = -sum([(x / total) * math.log(x / total) for x in gt_marginals])
+            h_det = -sum([(x / total) * math.log(x / total) for x in det_marginals])
+            metric_value = max(mi, 0.) / ((h_gt + h_det) / 2.)
     elif metric == 'RI':
         metric_value = 0.
         a = 0.5 * ((tp * (tp - 1)) + (fp * (fp - 1)) + (tn * (tn - 1)) + (fn * (fn - 1)))
         b = 0.5 * ((math.pow(tp + fn, 2) + math.pow(tn + fp, 2)) - (math.pow(tp, 2) + math.pow(tn, 2) + math.pow(fp, 2) + math.pow(fn, 2)))
         c = 0.5 * ((math.pow(tp + fp, 2) + math.pow(tn + fn, 2)) - (math.pow(tp, 2) + math.pow(tn, 2) + math.pow(fp, 2) + math.pow(fn, 2)))
-        d = np.prod(gt_ni_header.get_data_shape()[0:3]) * (np.prod(gt_ni_header.get_data_shape()[0:3]) - 1) / 2 - (a + b + c)
-        num = a + b
+        d = total * (total - 1) / 2 - (a + b + c)
+        num = a + d
         den = a + b + c + d
         if den != 0:
             metric_value = num / den
@@ -166,7 +387,7 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
         a = 0.5 * ((tp * (tp - 1)) + (fp * (fp - 1)) + (tn * (tn - 1)) + (fn * (fn - 1)))
         b = 0.5 * ((math.pow(tp + fn, 2) + math.pow(tn + fp, 2)) - (math.pow(tp, 2) + math.pow(tn, 2) + math.pow(fp, 2) + math.pow(fn, 2)))
         c = 0.5 * ((math.pow(tp + fp, 2) + math.pow(tn + fn, 2)) - (math.pow(tp, 2) + math.pow(tn, 2) + math.pow(fp, 2) + math.pow(fn, 2)))
-        d = np.prod(gt_ni_header.get_data_shape()[0:3]) * (np.prod(gt_ni_header.get_data_shape()[0:3]) - 1) / 2 - (a + b + c)
+        d = total * (total - 1) / 2 - (a + b + c)
         num = 2 * (a * d - b * c)
         den = math.pow(c, 2) + math.pow(b, 2) + 2 * a * d + (a + d) * (c + b)
         if den != 0:
@@ -174,7 +395,6 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
     elif metric == 'VOI':
         fn_tp = fn + tp
         fp_tp = fp + tp
-        total = np.prod(gt_ni_header.get_data_shape()[0:3])
 
         if fn_tp == 0 or (fn_tp / total) == 1 or fp_tp == 0 or (fp_tp / total) == 1:
             metric_value = math.inf
@@ -191,13 +411,13 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
             mi = h1 + h2 - h12
             metric_value = h1 + h2 - (2 * mi)
     elif metric == 'Jaccard':
-        metric_value = jaccard_score(gt.flatten(), detection.flatten())
+        metric_value = 0.
+        if (tp + fp + fn) != 0:
+            metric_value = tp / (tp + fp + fn)
     elif metric == 'IOU':
         metric_value = math.inf
-        intersection = (gt == 1) & (detection == 1)
-        union = (gt == 1) | (detection == 1)
-        if np.count_nonzero(union) != 0:
-            metric_value = np.count_nonzero(intersection) / np.count_nonzero(union)
+        if (tp + fp + fn) != 0:
+            metric_value = tp / (tp + fp + fn)
     elif metric == 'TPR':
         metric_value = math.inf
         if (tp + fn) != 0:
@@ -218,8 +438,6 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
         metric_value = math.inf
         if (tp + fp) != 0:
             metric_value = tp / (tp + fp)
-    elif metric == 'AUC':
-        metric_value = roc_auc_score(gt.flatten(), detection.flatten())
     elif metric == 'MCC':
         metric_value = math.inf
         num = (tp * tn) - (fp * fn)
@@ -227,60 +445,21 @@ def compute_specific_metric_value(metric, gt, detection, tp, tn, fp, fn, gt_ni_h
         if den != 0:
             metric_value = num / den
     elif metric == 'CKS':
-        metric_value = cohen_kappa_score(gt.flatten(), detection.flatten())
-    elif metric == 'HD95':
-        metric_value = math.inf
-        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
-            metric_value = compute_hd95(detection, gt, voxelspacing=det_ni_header.get_zooms(), connectivity=1)
-    elif metric == 'ASSD':
-        metric_value = math.inf
-        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
-            metric_value = compute_assd(detection, gt, voxel_spacing=det_ni_header.get_zooms())
-    elif metric == 'OASSD':
-        metric_value = math.inf
-        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
-            metric_value = compute_object_assd(detection, gt, voxel_spacing=det_ni_header.get_zooms())
+        metric_value = math.nan
+        observed_agreement = (tp + tn) / total
+        expected_agreement = (((tp + fp) * (tp + fn)) + ((tn + fn) * (tn + fp))) / (total * total)
+        if expected_agreement != 1:
+            metric_value = (observed_agreement - expected_agreement) / (1 - expected_agreement)
     elif metric == 'RAVD':
         metric_value = math.inf
-        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
-            metric_value = compute_ravd(detection, gt)
-    elif metric == 'VC':
-        metric_value = math.inf
-        if np.max(gt) == 1 and np.max(detection) == 1:  # Computation does not work if no binary object in the array
-            metric_value, pval = compute_volume_correlation(detection, gt)
-    elif metric == 'MahaD':
-        metric_value = math.inf
-        gt_n = np.count_nonzero(detection)
-        seg_n = np.count_nonzero(gt)
-
-        if gt_n != 0 and seg_n != 0:
-            gt_indices = np.flip(np.where(gt == 1), axis=0)
-            gt_mean = gt_indices.mean(axis=1)
-            gt_cov = np.cov(gt_indices)
-
-            seg_indices = np.flip(np.where(detection == 1), axis=0)
-            seg_mean = seg_indices.mean(axis=1)
-            seg_cov = np.cov(seg_indices)
-
-            # calculate common covariance matrix
-            common_cov = (gt_n * gt_cov + seg_n * seg_cov) / (gt_n + seg_n)
-            common_cov_inv = np.linalg.inv(common_cov)
-
-            mean = gt_mean - seg_mean
-            metric_value = math.sqrt(mean.dot(common_cov_inv).dot(mean.T))
+        if (tp + fn) != 0 and (tp + fp) != 0:
+            metric_value = ((tp + fp) - (tp + fn)) / (tp + fn)
     elif metric == 'ProbD':
-        # metric_value = -1.
         metric_value = math.inf
-        gt_flat = gt.flatten().astype(np.int8)
-        det_flat = detection.flatten().astype(np.int8)
-
-        probability_difference = np.absolute(gt_flat - det_flat).sum()
-        probability_joint = (gt_flat * det_flat).sum()
-
-        if probability_joint != 0:
-            metric_value = probability_difference / (2. * probability_joint)
+        if tp != 0:
+            metric_value = (fp + fn) / (2. * tp)
     else:
-        logging.warning("Metric with name {} has not been implemented!".format(metric))
+        logging.warning("Metric with name {} is not derived from the confusion counts!".format(metric))
     return metric_value
 
 
@@ -300,7 +479,7 @@ def compute_overall_metrics_correlation(input_folder, output_folder, data=None,
     results = None
     if data is None:
         results_filename = os.path.join(input_folder, 'Validation', class_name + '_dice_scores.csv')
-        results = pd.read_csv(results_filename)
+        results = read_results_table(results_filename)
     else:
         results = deepcopy(data)
 
@@ -4,7 +4,8 @@ import numpy as np
 import os
 import h5py
 import nibabel as nib
-from copy import deepcopy
+from scipy.ndimage import label, find_objects
+from scipy.optimize import linear_sum_assignment
 from ..Utils.resources import SharedResources
 
 
@@ -37,6 +38,113 @@ def box_overlap_leniant(box1, box2):
     return overlap_perc
 
 
+class ObjectCandidate:
+    """
+    Lightweight description of a connected component, exposing the same attributes as skimage's regionprops which
+    are used for pairing the objects (i.e., label, area, and slice).
+    """
+    def __init__(self, label_value: int, area: int, object_slice: tuple):
+        self.label = label_value
+        self.area = area
+        self.slice = object_slice
+
+    @property
+    def bbox(self) -> tuple:
+        return tuple([x.start for x in self.slice] + [x.stop for x in self.slice])
+
+
+def label_objects(binary_image, min_size=0):
+    """
+    Connected components analysis where the objects with less than min_size voxels are discarded, and the remaining
+    objects are relabeled consecutively (in the same order as a second labeling of the cleaned image would produce).
+    All object sizes are obtained at once with a bincount, and the removal and relabeling with a lookup table.
+    :param binary_image: binary array.
+    :param min_size: minimum number of voxels for an object to be kept.
+    :return: the label array, and the list of ObjectCandidate (ordered by label value).
+    """
+    labels, nb_labels = label(binary_image)
+    sizes = np.bincount(labels.ravel(), minlength=nb_labels + 1)
+    kept = sizes >= min_size
+    kept[0] = False
+    lookup_table = np.zeros(nb_labels + 1, dtype=labels.dtype)
+    lookup_table[kept] = np.arange(1, np.count_nonzero(kept) + 1, dtype=labels.dtype)
+    if np.count_nonzero(kept) != nb_labels:
+        labels = lookup_table[labels]
+
+    candidates = [ObjectCandidate(label_value=i + 1, area=int(area), object_slice=object_slice) for i, (area, object_slice)
+                  in enumerate(zip(sizes[kept], find_objects(labels, max_label=np.count_nonzero(kept))))]
+    return labels, candidates
+
+
+def compute_objects_contingency(gt_labels, detection_labels):
+    """
+    Sparse contingency table between the ground truth and detection objects, i.e., the number of overlapping voxels
+    for every pair of labels actually overlapping, obtained in a single pass over the overlap voxels.
+    :return: three np.ndarray with the ground truth labels, detection labels, and voxel counts of the overlapping
+    pairs, sorted by ground truth label and then by detection label.
+    """
+    overlap = (gt_labels != 0) & (detection_labels != 0)
+    nb_detection_labels = int(np.max(detection_labels)) + 1
+    pair_ids, counts = np.unique(gt_labels[overlap].astype(np.int64) * nb_detection_labels +
+                                 detection_labels[overlap].astype(np.int64), return_counts=True)
+    return pair_ids // nb_detection_labels, pair_ids % nb_detection_labels, counts
+
+
+def select_one_to_one_pairs(gt_values, det_values, dices):
+    """
+    Optimal one-to-one matching between the ground truth and detection objects (Hungarian algorithm), maximizing the
+    sum of the Dice scores over the overlapping pairs.
+    :return: boolean np.ndarray indicating which of the input pairs are kept.
+    """
+    gt_indices, gt_rows = np.unique(gt_values, return_inverse=True)
+    det_indices, det_cols = np.unique(det_values, return_inverse=True)
+    scores = np.zeros((len(gt_indices), len(det_indices)))
+    scores[gt_rows, det_cols] = dices
+    rows, cols = linear_sum_assignment(scores, maximize=True)
+    selected = np.zeros(scores.shape, dtype=bool)
+    selected[rows, cols] = True
+    return selected[gt_rows, det_cols]
+
+
+def compute_instance_detection_results(matching_results, gt_areas, nb_detections):
+    """
+    Object-wise metrics from the matching between the ground truth and detection objects.
+    @TODO. Might need to improve the object-wise metrics computation, here again with TP/TN/FP/FN
+    :param matching_results: list of [ground truth label, detection label, Dice] for the matching pairs, sorted by
+    ground truth label and then by detection label.
+    :param gt_areas: list with the number of voxels of each ground truth object, ordered by label value.
+    :param nb_detections: number of detection objects.
+    :return: list with [Dice, Recall, Precision, F1, Largest Focus Dice].
+    """
+    if nb_detections == 0:
+        if len(gt_areas) == 0:
+            return [1., 1., 1., 1., 0.]
+        else:
+            return [0., 0., 1., 0.5, 0.]
+
+    average_dice = 0.0
+    largest_component_dice = 0.0
+    recall = 0.0
+    precision = 1.0
+    f1_score = 0.0
+    try:
+        if len(matching_results) != 0:
+            array_matching = np.asarray(matching_results)
+            average_dice = np.mean(array_matching, axis=0)[2]
+            recall = len(np.unique(array_matching[:, 0])) / len(gt_areas)
+            precision = len(np.unique(array_matching[:, 1])) / nb_detections
+            f1_score = 2. * ((precision * recall) / (precision + recall))
+            index_larger_component = list(gt_areas).index(np.max(gt_areas))
+            matching_larger_component = [x[0] for x in matching_results].index(index_larger_component + 1) if (index_larger_component + 1) in [x[0] for x in matching_results] else -1
+            if matching_larger_component != -1:
+                largest_component_dice = matching_results[matching_larger_component][2]
+            if len(gt_areas) == 0 and nb_detections > 0:
+                precision = 0
+    except Exception as e:
+        print(traceback.format_exc())
+    return [average_dice, recall, precision, f1_score, largest_component_dice]
+
+
 class InstanceSegmentationValidation:
     """
     Perform the instance detection validation side (i.e., recall, precision).
@@ -55,6 +163,7 @@ class InstanceSegmentationValidation:
         self.matching_results = []
         self.instance_detection_results = [None, None, None, None, None]  # Dice, Recall, Precision, F1, Largest Focus Dice
         self.tiny_objects_removal_threshold = SharedResources.getInstance().validation_tiny_objects_removal_threshold
+        self.object_matching = SharedResources.getInstance().validation_object_matching
 
     def set_trace_parameters(self, output_folder, fold_number, patient, threshold):
         """
@@ -74,20 +183,7 @@ class InstanceSegmentationValidation:
         self.__select_candidates()
         if len(self.detection_candidates) != 0:
             self.__pair_candidates()
-            self.__compute_metrics()
-        else:
-            if len(self.gt_candidates) == 0:
-                self.instance_detection_results[0] = 1.
-                self.instance_detection_results[1] = 1.
-                self.instance_detection_results[2] = 1.
-                self.instance_detection_results[3] = 1.
-                self.instance_detection_results[4] = 0.
-            else:
-                self.instance_detection_results[0] = 0.
-                self.instance_detection_results[1] = 0.
-                self.instance_detection_results[2] = 1.
-                self.instance_detection_results[3] = 0.5
-                self.instance_detection_results[4] = 0.
+        self.__compute_metrics()
 
         return 1
 
@@ -104,31 +200,13 @@ class InstanceSegmentationValidation:
         are discarded, in both instances. Safe way to handle potential noise in the ground truth, especially if a
         third-party software (e.g. 3DSlicer) was used.
         """
-        from scipy.ndimage import measurements
-        from skimage.measure import regionprops
-
         # Cleaning the too small objects that might be noise in the ground truth
-        self.gt_labels = measurements.label(self.gt_image)[0]
-        refined_image = deepcopy(self.gt_labels)
-        for c in range(1, np.max(self.gt_labels)+1):
-            if np.count_nonzero(self.gt_labels == c) < self.tiny_objects_removal_threshold:
-                refined_image[refined_image == c] = 0
-        refined_image[refined_image != 0] = 1
-        self.gt_labels = measurements.label(refined_image)[0]
-        self.gt_candidates = regionprops(self.gt_labels)
+        self.gt_labels, self.gt_candidates = label_objects(self.gt_image, self.tiny_objects_removal_threshold)
 
         # Cleaning the too small objects that might be noise in the detection
         if np.count_nonzero(self.detection_image) > 0:
-            self.detection_labels = measurements.label(self.detection_image)[0]
-            # print('Found {} objects.'.format(np.max(self.detection_labels)))
-            refined_image = deepcopy(self.detection_labels)
-            for c in range(1, np.max(self.detection_labels) + 1):
-                if np.count_nonzero(self.detection_labels == c) < self.tiny_objects_removal_threshold:
-                    refined_image[refined_image == c] = 0
-            refined_image[refined_image != 0] = 1
-            self.detection_labels = measurements.label(refined_image)[0]
-            # print('Found {} objects after cleaning up.'.format(np.max(self.detection_labels)))
-            self.detection_candidates = regionprops(self.detection_labels)
+            self.detection_labels, self.detection_candidates = label_objects(self.detection_image,
+                                                                             self.tiny_objects_removal_threshold)
 
         if self.dump_trace:
             dump_gt_filename = os.path.join(self.output_folder, str(self.fold_number), '1_' +
@@ -147,37 +225,35 @@ class InstanceSegmentationValidation:
     def __pair_candidates(self, study_state=False):
         """
         Identify matching objects between the ground truth and detection candidates generated in self.__select_candidates.
-        @TODO. Optimally, and to avoid any bias which may or may not apply, if two detection candidates overlap with the
-        same ground truth candidate, only the one with the highest Dice should be kept as the correct pair and the second
-        detection candidate should be considered as a false positive.
+        The Dice of every overlapping pair is obtained from the contingency table of the ground truth and detection
+        labels. With the many-to-many matching, all overlapping pairs are kept. With the one-to-one matching, if
+        multiple detection candidates overlap with the same ground truth candidate (or conversely), only the pairs
+        from the optimal assignment are kept, and the other detection candidates are considered as false positives.
         """
-        for g, go in enumerate(self.gt_candidates):
-            gt_object = go.slice
-            gt_label_value = g + 1
-            for d, do in enumerate(self.detection_candidates):
-                det_label_value = d + 1
-                det_object = do.slice
-                is_overlap = box_overlap(gt_object, det_object)
-                if is_overlap > 0:
-                    roi = [min(gt_object[0].start, det_object[0].start), max(gt_object[0].stop, det_object[0].stop),
-                           min(gt_object[1].start, det_object[1].start), max(gt_object[1].stop, det_object[1].stop),
-                           min(gt_object[2].start, det_object[2].start), max(gt_object[2].stop, det_object[2].stop)]
-
-                    sub_gt_object = deepcopy(self.gt_labels[roi[0]:roi[1], roi[2]:roi[3], roi[4]:roi[5]])
-                    sub_det_object = deepcopy(self.detection_labels[roi[0]:roi[1], roi[2]:roi[3], roi[4]:roi[5]])
-
-                    sub_gt_object[sub_gt_object != gt_label_value] = 0
-                    sub_gt_object[sub_gt_object == gt_label_value] = 1
-
-                    sub_det_object[sub_det_object != det_label_value] = 0
-                    sub_det_object[sub_det_object == det_label_value] = 1
-
-                    dice_overlap = np.sum(sub_det_object[sub_gt_object == 1]) * 2.0 / (np.sum(sub_gt_object) + np.sum(sub_det_object))
-                    if dice_overlap > 0.0:
-                        if study_state:
-                            self.matching_results.append([gt_label_value, det_label_value, dice_overlap, sub_gt_object, sub_det_object])
-                        else:
-                            self.matching_results.append([gt_label_value, det_label_value, dice_overlap])
+        if self.detection_labels is None or len(self.gt_candidates) == 0 or len(self.detection_candidates) == 0:
+            return
+
+        gt_values, det_values, counts = compute_objects_contingency(self.gt_labels, self.detection_labels)
+        gt_areas = np.asarray([x.area for x in self.gt_candidates])
+        det_areas = np.asarray([x.area for x in self.detection_candidates])
+        dices = counts * 2.0 / (gt_areas[gt_values - 1] + det_areas[det_values - 1])
+        if self.object_matching == 'one-to-one' and len(dices) != 0:
+            kept = select_one_to_one_pairs(gt_values, det_values, dices)
+            gt_values, det_values, dices = gt_values[kept], det_values[kept], dices[kept]
+
+        for gt_label_value, det_label_value, dice_overlap in zip(gt_values, det_values, dices):
+            gt_label_value = int(gt_label_value)
+            det_label_value = int(det_label_value)
+            if study_state:
+                gt_object = self.gt_candidates[gt_label_value - 1].slice
+                det_object = self.detection_candidates[det_label_value - 1].slice
+                roi = tuple([slice(min(gt_object[x].start, det_object[x].start), max(gt_object[x].stop, det_object[x].stop))
+                             for x in range(len(gt_object))])
+                sub_gt_object = (self.gt_labels[roi] == gt_label_value).astype(self.gt_labels.dtype)
+                sub_det_object = (self.detection_labels[roi] == det_label_value).astype(self.detection_labels.dtype)
+                self.matching_results.append([gt_label_value, det_label_value, dice_overlap, sub_gt_object, sub_det_object])
+            else:
+                self.matching_results.append([gt_label_value, det_label_value, dice_overlap])
         if self.dump_trace:
             output_file = os.path.join(self.output_folder, str(self.fold_number), '1_' + self.patient.split('_')[0],
                                        'matching_' + str(int(self.threshold * 100)) + '.hd5')
@@ -189,28 +265,6 @@ class InstanceSegmentationValidation:
             f.close()
 
     def __compute_metrics(self):
-        """
-        @TODO. Might need to improve the object-wise metrics computation, here again with TP/TN/FP/FN
-        :return:
-        """
-        average_dice = 0.0
-        largest_component_dice = 0.0
-        recall = 0.0
-        precision = 1.0
-        f1_score = 0.0
-        try:
-            if len(self.matching_results) != 0:
-                array_matching = np.asarray(self.matching_results)
-                average_dice = np.mean(array_matching, axis=0)[2]
-                recall = len(np.unique(array_matching[:, 0])) / len(self.gt_candidates)
-                precision = len(np.unique(array_matching[:, 1])) / len(self.detection_candidates)
-                f1_score = 2. * ((precision * recall) / (precision + recall))
-                index_larger_component = [x.area for x in self.gt_candidates].index(np.max([x.area for x in self.gt_candidates]))
-                matching_larger_component = [x[0] for x in self.matching_results].index(index_larger_component + 1) if (index_larger_component + 1) in [x[0] for x in self.matching_results] else -1
-                if matching_larger_component != -1:
-                    largest_component_dice = self.matching_results[matching_larger_component][2]
-                if len(self.gt_candidates) == 0 and len(self.detection_candidates) > 0:
-                    precision = 0
-        except Exception as e:
-            print(traceback.format_exc())
-        self.instance_detection_results = [average_dice, recall, precision, f1_score, largest_component_dice]
+        self.instance_detection_results = compute_instance_detection_results(self.matching_results,
+                                                                             [x.area for x in self.gt_candidates],
+                                                                             len(self.detection_candidates))
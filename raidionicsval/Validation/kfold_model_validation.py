@@ -1,4 +1,3 @@
-import multiprocessing
 import itertools
 
 import time
@@ -7,13 +6,22 @@ from math import ceil
 
 from tqdm import tqdm
 
-from ..Computation.dice_computation import separate_dice_computation
+from ..Computation.dice_computation import compute_patient_dice_scores
+from ..Computation.confusion_computation import compute_roc_auc_from_histograms, \
+    compute_average_precision_from_histograms, compute_probability_curves_from_histograms
 from ..Validation.instance_segmentation_validation import *
 from ..Utils.resources import SharedResources
-from ..Utils.PatientMetricsStructure import PatientMetrics
-from ..Utils.io_converters import get_fold_from_file
-from ..Validation.validation_utilities import best_segmentation_probability_threshold_analysis, compute_fold_average
-from ..Validation.extra_metrics_computation import compute_patient_extra_metrics
+from ..Utils.PatientMetricsStructure import PatientMetrics, load_patients_scores
+from ..Utils.io_converters import get_fold_from_file, VolumesPrefetcher
+from ..Utils.results_journal import ResultsJournal
+from ..Utils.results_store import read_results_table
+from ..Utils.cohort_metrics import CohortMetrics
+from ..Utils.parallel_backend import get_parallel_backend, create_pool
+from ..Validation.validation_utilities import best_segmentation_probability_threshold_analysis, compute_fold_average,\
+    get_coarse_probability_thresholds, get_refined_probability_thresholds, select_probability_threshold_candidates
+from ..Validation.extra_metrics_computation import prepare_patient_extra_metrics, collect_patient_extra_metrics, \
+    parallel_metric_computation, share_extra_metrics_tasks_volumes, release_extra_metrics_tasks_volumes, \
+    compute_patient_probability_histograms, PROBABILITY_BASED_METRICS
 
 
 class ModelValidation:
@@ -40,24 +48,37 @@ class ModelValidation:
         print("Detection overlap: ", self.detection_overlap_thresholds)
         self.gt_files_suffix = SharedResources.getInstance().validation_gt_files_suffix
         self.prediction_files_suffix = SharedResources.getInstance().validation_prediction_files_suffix
+        self.probability_thresholds = SharedResources.getInstance().validation_probability_thresholds
         self.patients_metrics = {}
+        # Memory used by the volumes kept for the extra metrics computation, over all patients
+        self.held_volumes_nbytes = 0
+        self.pool = None
 
     def run(self):
-        self.__compute_metrics()
-        class_optimal = best_segmentation_probability_threshold_analysis(self.input_folder,
-                                                                         detection_overlap_thresholds=self.detection_overlap_thresholds)
-        if len(SharedResources.getInstance().validation_metric_names) != 0:
-            self.__compute_extra_metrics(class_optimal=class_optimal)
+        try:
+            self.__compute_metrics()
+            if SharedResources.getInstance().validation_probability_threshold_search == 'coarse-to-fine':
+                self.__refine_metrics()
+            class_optimal = best_segmentation_probability_threshold_analysis(self.input_folder,
+                                                                             detection_overlap_thresholds=self.detection_overlap_thresholds)
+            if len(SharedResources.getInstance().validation_metric_names) != 0:
+                self.__compute_extra_metrics(class_optimal=class_optimal)
+        finally:
+            self.__close_pool()
+        cohort = CohortMetrics.from_folder(os.path.join(self.input_folder, 'Validation'),
+                                           SharedResources.getInstance().validation_class_names)
         compute_fold_average(self.input_folder, class_optimal=class_optimal, metrics=self.metric_names,
-                             true_positive_state=False)
+                             true_positive_state=False, cohort=cohort)
         compute_fold_average(self.input_folder, class_optimal=class_optimal, metrics=self.metric_names,
-                             true_positive_state=True)
+                             true_positive_state=True, cohort=cohort)
 
     def __compute_metrics(self):
         """
-        Generate the Dice scores (and default instance detection metrics) for all the patients and 10 probability
-        thresholds equally-spaced. All the computed results will be stored inside all_dice_scores.csv.
-        The results are saved after each patient, making it possible to resume the computation if a crash occurred.
+        Generate the Dice scores (and default instance detection metrics) for all the patients and all probability
+        thresholds specified in the configuration file (or only a coarse subset of them with the coarse-to-fine search).
+        All the computed results will be stored inside all_dice_scores.csv.
+        The results are appended to a journal after each patient, making it possible to resume the computation if a
+        crash occurred, and compacted into the csv files once all patients are done.
         @TODO. Include an override flag to recompute anyway.
         :return:
         """
@@ -76,45 +97,117 @@ class ModelValidation:
         self.results_df_base_columns.extend(["OW Dice", "OW Recall", "OW Precision", "OW F1", "OW Dice Largest Object", '#GT', '#Det'])
         self.results_df_base_columns.extend(SharedResources.getInstance().validation_metric_names)
 
-        if not os.path.exists(self.dice_output_filename):
-            self.results_df = pd.DataFrame(columns=self.results_df_base_columns)
-        else:
-            self.results_df = pd.read_csv(self.dice_output_filename)
-            if self.results_df.columns[0] != 'Fold':
-                self.results_df = pd.read_csv(self.dice_output_filename, index_col=0)
-            missing_metrics = [x for x in SharedResources.getInstance().validation_metric_names if
-                               not x in list(self.results_df.columns)[1:]]
-            for m in missing_metrics:
-                self.results_df[m] = None
-
+        self.results_df = ResultsJournal(self.dice_output_filename, self.results_df_base_columns)
         for c in SharedResources.getInstance().validation_class_names:
-            if not os.path.exists(self.class_dice_output_filenames[c]):
-                self.class_results_df[c] = pd.DataFrame(columns=self.results_df_base_columns)
-            else:
-                self.class_results_df[c] = pd.read_csv(self.class_dice_output_filenames[c])
-                if self.class_results_df[c].columns[0] != 'Fold':
-                    self.class_results_df[c] = pd.read_csv(self.class_dice_output_filenames[c], index_col=0)
-                missing_metrics = [x for x in SharedResources.getInstance().validation_metric_names if
-                                   not x in list(self.class_results_df[c].columns)[1:]]
-                for m in missing_metrics:
-                    self.class_results_df[c][m] = None
-
-        self.results_df['Patient'] = self.results_df.Patient.astype(str)
-        for c in SharedResources.getInstance().validation_class_names:
-            self.class_results_df[c]['Patient'] = self.class_results_df[c].Patient.astype(str)
+            self.class_results_df[c] = ResultsJournal(self.class_dice_output_filenames[c], self.results_df_base_columns)
 
-        results_per_folds = []
+        self.folds_test_sets = []
         for fold in range(0, self.fold_number):
-            print('\nProcessing fold {}/{}.\n'.format(fold + 1, self.fold_number))
             if self.split_way == 'two-way':
                 test_set, _ = get_fold_from_file(filename=cross_validation_description_file, fold_number=fold)
             else:
                 val_set, test_set = get_fold_from_file(filename=cross_validation_description_file, fold_number=fold)
-            results = self.__compute_metrics_for_fold(data_list=test_set, fold_number=fold)
-            results_per_folds.append(results)
+            self.folds_test_sets.append(test_set)
 
-    def __compute_metrics_for_fold(self, data_list, fold_number):
-        for i, patient in enumerate(tqdm(data_list)):
+        thresholds = self.probability_thresholds
+        if SharedResources.getInstance().validation_probability_threshold_search == 'coarse-to-fine':
+            thresholds, self.coarse_stride = get_coarse_probability_thresholds(
+                self.probability_thresholds, SharedResources.getInstance().validation_probability_threshold_candidates)
+            self.coarse_thresholds = thresholds
+            print('Coarse probability thresholds: {}'.format(thresholds))
+        self.__compute_metrics_for_folds(thresholds)
+
+    def __refine_metrics(self):
+        """
+        Second stage of the coarse-to-fine search, where the metrics are computed for all patients only for the
+        probability thresholds lying around the best coarse candidates of each class. The thresholds already
+        present in the results files are also included, so that all patients are evaluated for the same thresholds.
+        """
+        candidates = []
+        existing_thresholds = []
+        for c in SharedResources.getInstance().validation_class_names:
+            class_results = read_results_table(self.class_dice_output_filenames[c],
+                                               columns=['Threshold', 'PiW Dice', 'True Positive'])
+            coarse_results = class_results.loc[np.isin(np.round(class_results['Threshold'], 4), self.coarse_thresholds)]
+            candidates.extend(select_probability_threshold_candidates(coarse_results,
+                                                                      SharedResources.getInstance().validation_probability_threshold_candidates))
+            existing_thresholds.extend([float(np.round(x, 4)) for x in np.unique(class_results['Threshold'].values)])
+        thresholds = get_refined_probability_thresholds(self.probability_thresholds, candidates, self.coarse_stride)
+        thresholds = sorted(set(thresholds + existing_thresholds))
+        print('Refining around the probability thresholds {}, with: {}'.format(sorted(set(candidates)), thresholds))
+        self.__compute_metrics_for_folds(thresholds)
+
+    def __compute_metrics_for_folds(self, thresholds):
+        """
+        Compute the basic metrics for the patients of all folds, dispatched together to a single pool of processes
+        kept for the whole run (when multiple processes are allowed). The results are collected in the original order
+        of the patients, and written to the csv files by the main process only.
+        """
+        # The results already computed are read once for all patients, to only compute the missing ones
+        patients_scores = load_patients_scores(self.output_folder, SharedResources.getInstance().validation_class_names)
+        patients_tasks = []
+        for fold in range(0, self.fold_number):
+            patients_tasks.extend(self.__prepare_metrics_for_fold(data_list=self.folds_test_sets[fold],
+                                                                  fold_number=fold, thresholds=thresholds,
+                                                                  patients_scores=patients_scores))
+
+        number_processes = SharedResources.getInstance().number_processes
+        tasks = [[patient_metrics.unique_id, patient_metrics.patient_id, fold_number,
+                  [patient_metrics.get_class_filenames(c) for c in range(len(patient_metrics.class_names))],
+                  missing_thresholds, number_processes] for patient_metrics, fold_number, missing_thresholds in
+                 patients_tasks]
+        prefetcher = None
+        if get_parallel_backend() != 'serial' and len(patients_tasks) > 1:
+            # Each process handles a whole patient, with the probability thresholds being processed sequentially
+            patients_results = self.__get_pool().imap(compute_patient_dice_scores, [x[:5] + [1] for x in tasks])
+        else:
+            # The volumes of the upcoming patients are loaded in the background while the current one is processed
+            prefetched_volumes = itertools.repeat(None)
+            if SharedResources.getInstance().validation_prefetch_depth > 0 and len(patients_tasks) > 1:
+                prefetcher = VolumesPrefetcher([x[3] for x in tasks],
+                                               depth=SharedResources.getInstance().validation_prefetch_depth,
+                                               memory_limit=SharedResources.getInstance().validation_prefetch_memory_limit,
+                                               dtype=SharedResources.getInstance().validation_probability_dtype)
+                prefetched_volumes = iter(prefetcher)
+            patients_results = (compute_patient_dice_scores(task + [volumes]) for task, volumes in
+                                zip(tasks, prefetched_volumes))
+
+        folds_tasks = {}
+        folds_failures = {}
+        for (patient_metrics, fold_number, missing_thresholds), classes_results in tqdm(zip(patients_tasks,
+                                                                                            patients_results),
+                                                                                        total=len(patients_tasks)):
+            folds_tasks[fold_number] = folds_tasks.get(fold_number, 0) + 1
+            if classes_results is None:
+                folds_failures[fold_number] = folds_failures.get(fold_number, 0) + 1
+                continue
+            try:
+                self.__write_patient_dice_scores(patient_metrics, fold_number, missing_thresholds, classes_results)
+            except Exception as e:
+                print('Issue processing patient {}\n'.format(patient_metrics.unique_id))
+                print(traceback.format_exc())
+                folds_failures[fold_number] = folds_failures.get(fold_number, 0) + 1
+                continue
+        if prefetcher is not None:
+            prefetcher.close()
+        self.results_df.compact()
+        for c in SharedResources.getInstance().validation_class_names:
+            self.class_results_df[c].compact()
+        # Not a single patient from a fold being processed points to a setup issue, rather than to faulty inputs
+        failed_folds = [x for x in folds_tasks.keys() if folds_failures.get(x, 0) == folds_tasks[x]]
+        if len(failed_folds) != 0:
+            raise RuntimeError('The metrics computation failed for all the patients of fold(s) {}, no results could be'
+                               ' collected.'.format(', '.join([str(x) for x in sorted(failed_folds)])))
+
+    def __prepare_metrics_for_fold(self, data_list, fold_number, thresholds, patients_scores):
+        """
+        Identify the files of the patients from the current fold, and the probability thresholds remaining to compute
+        for each of them.
+        :param patients_scores: results already computed for all patients, as given by load_patients_scores.
+        :return: list of [PatientMetrics, fold number, list of probability thresholds] for the patients to process.
+        """
+        patients_tasks = []
+        for i, patient in enumerate(data_list):
             uid = None
             try:
                 # Option1. Working for files using the original naming conventions.
@@ -130,24 +223,42 @@ class ModelValidation:
                 # Placeholder for holding all metrics for the current patient
                 patient_metrics = PatientMetrics(id=uid, patient_id=pid, fold_number=fold_number,
                                                  class_names=SharedResources.getInstance().validation_class_names)
-                patient_metrics.init_from_file(self.output_folder)
+                patient_metrics.init_from_scores(patients_scores.get((fold_number, pid)))
 
                 success = self.__identify_patient_files(patient_metrics, sub_folder_index, fold_number)
                 self.patients_metrics[uid] = patient_metrics
 
                 # Checking if values have already been computed for the current patient to skip it if so.
+                # Otherwise, only the missing probability thresholds are computed for an already complete patient.
+                missing_thresholds = thresholds
                 if patient_metrics.is_complete():
-                    continue
+                    missing_thresholds = patient_metrics.get_missing_probability_thresholds(thresholds)
+                    if len(missing_thresholds) == 0:
+                        continue
                 if not success:
                     print('Input files not found for patient {}\n'.format(uid))
                     continue
 
-                self.__generate_dice_scores_for_patient(patient_metrics, fold_number)
+                patients_tasks.append([patient_metrics, fold_number, missing_thresholds])
             except Exception as e:
                 print('Issue processing patient {}\n'.format(uid))
                 print(traceback.format_exc())
                 continue
-        return 0
+        return patients_tasks
+
+    def __get_pool(self):
+        """
+        Pool of processes (or threads) shared by all the patients, created upon first use and kept for the whole run.
+        """
+        if self.pool is None:
+            self.pool = create_pool()
+        return self.pool
+
+    def __close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
     def __identify_patient_files(self, patient_metrics, folder_index, fold_number):
         """
@@ -252,123 +363,178 @@ class ModelValidation:
         patient_metrics.set_patient_filenames(patient_filenames)
         return True
 
-    def __generate_dice_scores_for_patient(self, patient_metrics, fold_number):
+    def __write_patient_dice_scores(self, patient_metrics, fold_number, thresholds, classes_results):
         """
-        Compute the basic metrics for all classes of the current patient
+        Store the basic metrics computed for all classes of the current patient, for the given probability thresholds,
+        and fill in the csv files on disk.
+        :param classes_results: list with, for each class, the results computed by compute_patient_dice_scores.
         :return:
         """
         uid = patient_metrics.patient_id
         classes = SharedResources.getInstance().validation_class_names
         nb_classes = len(classes)
-        patient_filenames = {}
-        thr_range = np.arange(0.1, 1.1, 0.1)
+        thr_range = np.round(np.asarray(thresholds, dtype='float64'), 4)
 
-        # Iterating over all classes, where independent files are expected
         for c in range(nb_classes):
-            gt_filename, det_filename = patient_metrics.get_class_filenames(c)
-            ground_truth_ni = nib.load(gt_filename)
-            detection_ni = nib.load(det_filename)
-
-            gt = ground_truth_ni.get_fdata()
-            gt[gt >= 1] = 1
-
-            class_tp_threshold = SharedResources.getInstance().validation_true_positive_volume_thresholds[c]
-            gt_volume = np.count_nonzero(gt) * np.prod(ground_truth_ni.header.get_zooms()) * 1e-3
-            tp_state = True if gt_volume > class_tp_threshold else False
-            extra = [np.round(gt_volume, 4), tp_state]
-            pat_results = []
-            if SharedResources.getInstance().number_processes > 1:
-                pool = multiprocessing.Pool(processes=SharedResources.getInstance().number_processes)
-                pat_results = pool.map(separate_dice_computation, zip(thr_range,
-                                                                      itertools.repeat(fold_number),
-                                                                      itertools.repeat(gt),
-                                                                      itertools.repeat(detection_ni),
-                                                                      itertools.repeat(uid),
-                                                                      itertools.repeat(extra)
-                                                                      )
-                                       )
-                pool.close()
-                pool.join()
-            else:
-                for thr_value in thr_range:
-                    thr_res = separate_dice_computation([thr_value, fold_number, gt, detection_ni, uid, extra])
-                    pat_results.append(thr_res)
+            pat_results, probability_histograms, volumes = classes_results[c]
+            if probability_histograms is not None:
+                patient_metrics.set_class_probability_histograms(c, probability_histograms)
+            # The volumes are kept for the extra metrics computation, as long as the memory limit allows it
+            if volumes is not None:
+                self.__release_class_volumes(patient_metrics, c)
+            if volumes is not None and self.held_volumes_nbytes + volumes.nbytes <= \
+                    SharedResources.getInstance().validation_volumes_memory_limit * 1e6:
+                patient_metrics.set_class_volumes(c, volumes)
+                self.held_volumes_nbytes += volumes.nbytes
 
             patient_metrics.set_class_regular_metrics(classes[c], pat_results)
-            # Filling in the csv files on disk for faster resume
-            class_results_filename = self.class_dice_output_filenames[classes[c]]
+            # Filling in the results journal on disk for faster resume
             for ind, th in enumerate(thr_range):
-                th = np.round(th, 2)
-                sub_df = self.class_results_df[classes[c]].loc[
-                    (self.class_results_df[classes[c]]['Patient'] == uid) & (self.class_results_df[classes[c]]['Fold'] == fold_number) & (
-                            self.class_results_df[classes[c]]['Threshold'] == th)]
-                # ind_values = np.asarray(pat_results[ind])
-                # buff_df = pd.DataFrame(ind_values.reshape(1, len(self.results_df_base_columns)),
-                #                        columns=list(self.results_df_base_columns))
-                if len(sub_df) == 0:
-                    extra_metrics = [None] * len(SharedResources.getInstance().validation_metric_names)
-                    ind_values = np.asarray(pat_results[ind][0] + extra_metrics)
-                    buff_df = pd.DataFrame(ind_values.reshape(1, len(self.results_df_base_columns)),
-                                           columns=list(self.results_df_base_columns))
-                    # self.class_results_df[classes[c]] = self.class_results_df[classes[c]].append(buff_df,
-                    #                                                                              ignore_index=True)
-                    self.class_results_df[classes[c]] = pd.concat([self.class_results_df[classes[c]], buff_df],
-                                                                  ignore_index=True)
-                else:
-                    ind_values = pat_results[ind][0] + list(self.class_results_df[classes[c]].loc[sub_df.index.values[0], :].values[len(pat_results[ind][0]):])
-                    self.class_results_df[classes[c]].loc[sub_df.index.values[0], :] = ind_values
-            self.class_results_df[classes[c]].to_csv(class_results_filename, index=False)
+                self.class_results_df[classes[c]].set_row(pat_results[ind][0])
+            self.class_results_df[classes[c]].commit()
 
         # Should compute the class macro-average results if multiple classes
-        class_averaged_results = None
-        class_results = []
-        for c in classes:
-            pat_class_results = patient_metrics.get_class_metrics(c)
-            pat_class_extra_metrics = patient_metrics.get_class_extra_metrics_without_header(c)
-            final_pat_class_res = [pat_class_results[x] for x in range(len(thr_range))]
-            if len(SharedResources.getInstance().validation_metric_names) != 0:
-                final_pat_class_res = [pat_class_results[x] + pat_class_extra_metrics[x] for x in range(len(thr_range))]
-            class_results.append(final_pat_class_res)
-        class_averaged_results = np.average(np.asarray(class_results).astype('float32')[:, :, 1:], axis=0)
+        extra_metric_names = []
+        if len(SharedResources.getInstance().validation_metric_names) != 0:
+            extra_metric_names = self.results_df.columns[SharedResources.getInstance().upper_default_metrics_index:]
+        class_results = [patient_metrics.get_class_metrics_array(c, list(thr_range), extra_metric_names) for c in
+                         classes]
+        class_averaged_results = np.average(np.stack(class_results), axis=0)
 
-        # Filling in the csv files on disk for faster resume
+        # Filling in the results journal on disk for faster resume
         for ind, th in enumerate(thr_range):
-            th = np.round(th, 2)
-            sub_df = self.results_df.loc[
-                (self.results_df['Patient'] == uid) & (self.results_df['Fold'] == fold_number) & (
-                            self.results_df['Threshold'] == th)]
-            # ind_values = np.asarray([fold_number, uid, np.round(th, 2)] + list(class_averaged_results[ind]))
-            # buff_df = pd.DataFrame(ind_values.reshape(1, len(self.results_df_base_columns)),
-            #                        columns=list(self.results_df_base_columns))
-            if len(sub_df) == 0:
-                ind_values = np.asarray([fold_number, uid, np.round(th, 2)] + list(class_averaged_results[ind]))
-                buff_df = pd.DataFrame(ind_values.reshape(1, len(self.results_df_base_columns)),
-                                       columns=list(self.results_df_base_columns))
-                # self.results_df = self.results_df.append(buff_df, ignore_index=True)
-                self.results_df = pd.concat([self.results_df, buff_df], ignore_index=True)
-            else:
-                ind_values = [fold_number, uid, np.round(th, 2)] + list(class_averaged_results[ind])
-                self.results_df.loc[sub_df.index.values[0], :] = ind_values
-        self.results_df.to_csv(self.dice_output_filename, index=False)
+            self.results_df.set_row(np.asarray([fold_number, uid, np.round(th, 4)] + list(class_averaged_results[ind])))
+        self.results_df.commit()
 
-    def __compute_extra_metrics(self, class_optimal: dict = {}):
+    def __release_class_volumes(self, patient_metrics, class_index: int) -> None:
         """
+        Discard the volumes kept for the extra metrics computation of one class of a patient, if any.
+        """
+        volumes = patient_metrics.get_class_volumes(class_index)
+        if volumes is not None:
+            self.held_volumes_nbytes -= volumes.nbytes
+            patient_metrics.release_class_volumes(class_index)
 
+    def __compute_extra_metrics(self, class_optimal: dict = {}):
+        """
+        Compute the extra metrics for all patients and classes, at the optimal probability threshold of each class.
+        The metrics requiring the voxel arrays are split into (patient, class, metric group) tasks dispatched to the
+        pool of processes, by windows of patients where the most expensive tasks (i.e., the surface metrics over the
+        largest volumes) are started first. The next window is prepared while the tasks of the current one are running.
         """
         print("Computing extra metrics for all patients.\n")
         classes = SharedResources.getInstance().validation_class_names
-        for c in classes:
-            optimal_values = class_optimal[c]['All']
-            for p in tqdm(self.patients_metrics):
+        number_processes = SharedResources.getInstance().number_processes
+        patients_classes = [[c, p] for c in classes for p in self.patients_metrics]
+        window_size = 2 * number_processes if get_parallel_backend() != 'serial' else 1
+
+        progress = tqdm(total=len(patients_classes))
+        pending_windows = []
+        for start in range(0, len(patients_classes), window_size):
+            window = []
+            for c, p in patients_classes[start:start + window_size]:
                 # Initializing/completing the list which will hold the extra metrics
                 self.patients_metrics[p].setup_extra_metrics(self.metric_names)
-                pat_metrics = compute_patient_extra_metrics(self.patients_metrics[p], classes.index(c), optimal_values[1],
-                                                            SharedResources.getInstance().validation_metric_names)
-                self.patients_metrics[p].set_optimal_class_extra_metrics(classes.index(c), optimal_values[1], pat_metrics)
-
-                # Filling in the overall dataframe and dumping results to csv after each patient
-                for pm in pat_metrics:
-                    metric_name = pm[0]
-                    metric_value = pm[1]
-                    self.class_results_df[c].at[self.class_results_df[c].loc[(self.class_results_df[c]['Patient'] == self.patients_metrics[p].patient_id) & (self.class_results_df[c]['Threshold'] == optimal_values[1])].index.values[0], metric_name] = metric_value
-                self.class_results_df[c].to_csv(self.class_dice_output_filenames[c], index=False)
+                extra_metrics_results, tasks, tasks_costs = prepare_patient_extra_metrics(
+                    self.patients_metrics[p], classes.index(c), class_optimal[c]['All'][1],
+                    SharedResources.getInstance().validation_metric_names)
+                window.append([c, p, extra_metrics_results, tasks, tasks_costs, None])
+
+            if get_parallel_backend() != 'serial':
+                self.__submit_extra_metrics_window(window)
+                pending_windows.append(window)
+                while len(pending_windows) > 1:
+                    self.__store_extra_metrics_window(pending_windows.pop(0), class_optimal, progress)
+            else:
+                self.__store_extra_metrics_window(window, class_optimal, progress)
+        while len(pending_windows) > 0:
+            self.__store_extra_metrics_window(pending_windows.pop(0), class_optimal, progress)
+        progress.close()
+
+        for c in classes:
+            self.class_results_df[c].compact()
+        for c in classes:
+            if len([x for x in SharedResources.getInstance().validation_metric_names if x in PROBABILITY_BASED_METRICS]) != 0:
+                self.__compute_cohort_probability_curves(class_name=c)
+
+    def __submit_extra_metrics_window(self, window):
+        """
+        Send the tasks of all the patients from the window to the pool of processes, by decreasing estimated cost.
+        """
+        window_tasks = []
+        for entry in window:
+            entry[3] = share_extra_metrics_tasks_volumes(entry[3])
+            entry[5] = [None] * len(entry[3])
+            window_tasks.extend([[cost, entry, i] for i, cost in enumerate(entry[4])])
+        for cost, entry, i in sorted(window_tasks, key=lambda x: x[0], reverse=True):
+            entry[5][i] = self.__get_pool().apply_async(parallel_metric_computation, (entry[3][i],))
+
+    def __store_extra_metrics_window(self, window, class_optimal, progress):
+        """
+        Gather the extra metrics of all the patients from the window, once their tasks are done, and fill in the
+        results files.
+        """
+        classes = SharedResources.getInstance().validation_class_names
+        for c, p, extra_metrics_results, tasks, tasks_costs, async_results in window:
+            optimal_threshold = class_optimal[c]['All'][1]
+            tasks_results = []
+            try:
+                if async_results is None:
+                    tasks_results = [parallel_metric_computation(task) for task in tasks]
+                else:
+                    tasks_results = [x.get() for x in async_results]
+            except Exception as e:
+                print("Issue computing metrics for patient {} in the multiprocessing loop.".format(
+                    self.patients_metrics[p].unique_id))
+                print(traceback.format_exc())
+            finally:
+                release_extra_metrics_tasks_volumes(tasks)
+            pat_metrics = collect_patient_extra_metrics(extra_metrics_results, tasks_results)
+            updated_metrics = self.patients_metrics[p].set_optimal_class_extra_metrics(classes.index(c),
+                                                                                       optimal_threshold, pat_metrics)
+            self.__release_class_volumes(self.patients_metrics[p], classes.index(c))
+
+            # Filling in the results table, only with the newly computed metrics
+            if len(updated_metrics) != 0:
+                self.class_results_df[c].set_values(self.patients_metrics[p].fold_number,
+                                                    self.patients_metrics[p].patient_id, optimal_threshold,
+                                                    dict([(pm[0], pm[1]) for pm in pat_metrics if
+                                                          pm[0] in updated_metrics]))
+            progress.update(1)
+
+        # Appending the results to the journal after each window of patients
+        for c in set([x[0] for x in window]):
+            self.class_results_df[c].commit()
+
+    def __compute_cohort_probability_curves(self, class_name: str) -> None:
+        """
+        Aggregate the patient-wise probability histograms into cohort-level ROC and precision-recall curves, and
+        the corresponding ROC-AUC and average precision values, computed over all voxels from all patients.
+        The histograms not available in memory (i.e., patients fully processed in a previous run) are recomputed.
+        """
+        class_index = SharedResources.getInstance().validation_class_names.index(class_name)
+        inside_histogram = None
+        outside_histogram = None
+        for p in self.patients_metrics:
+            try:
+                histograms = self.patients_metrics[p].get_class_probability_histograms(class_index)
+                if histograms is None:
+                    histograms = compute_patient_probability_histograms(self.patients_metrics[p], class_index)
+                inside_histogram = histograms[0] if inside_histogram is None else inside_histogram + histograms[0]
+                outside_histogram = histograms[1] if outside_histogram is None else outside_histogram + histograms[1]
+            except Exception as e:
+                print('Issue computing the probability histograms for patient {}'.format(self.patients_metrics[p].unique_id))
+                print(traceback.format_exc())
+
+        if inside_histogram is None:
+            return
+
+        curves_df = pd.DataFrame(compute_probability_curves_from_histograms(inside_histogram, outside_histogram))
+        curves_df.to_csv(os.path.join(self.output_folder, class_name + '_cohort_probability_curves.csv'), index=False)
+        cohort_df = pd.DataFrame([[len(self.patients_metrics),
+                                   compute_roc_auc_from_histograms(inside_histogram, outside_histogram),
+                                   compute_average_precision_from_histograms(inside_histogram, outside_histogram)]],
+                                 columns=['#Patients', 'AUC', 'AP'])
+        cohort_df.to_csv(os.path.join(self.output_folder, class_name + '_cohort_probability_metrics.csv'), index=False)
+        print("Cohort-level ROC-AUC of {:.4f} and AP of {:.4f} for class {}.\n".format(cohort_df['AUC'][0],
+                                                                                     cohort_df['AP'][0], class_name))
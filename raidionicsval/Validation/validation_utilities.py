@@ -1,15 +1,64 @@
 import csv
 import os
+import math
 import pandas as pd
 import numpy as np
-import math
-from copy import deepcopy
-import matplotlib.pyplot as plt
 from ..Utils.resources import SharedResources
+from ..Utils.cohort_metrics import CohortMetrics
+from ..Plotting.optimal_threshold_plot import plot_optimal_threshold_study
+
+
+def get_coarse_probability_thresholds(thresholds, nb_candidates=1):
+    """
+    Subset of the probability thresholds evaluated first in the coarse-to-fine search. With n thresholds and k
+    candidates refined afterwards, a stride of sqrt(n / 2k) between the coarse values minimizes the total number of
+    evaluated thresholds, which then grows as sqrt(n) instead of n. The highest threshold is always included.
+    :param thresholds: sorted list of all probability thresholds (float).
+    :param nb_candidates: number of best coarse thresholds which will be refined around.
+    :return: sorted list of coarse probability thresholds, and the stride used between them.
+    """
+    stride = max(1, int(round(math.sqrt(len(thresholds) / (2. * max(1, nb_candidates))))))
+    coarse_thresholds = [thresholds[x] for x in range(len(thresholds) - 1, -1, -stride)]
+    return sorted(coarse_thresholds), stride
+
+
+def get_refined_probability_thresholds(thresholds, candidates, stride):
+    """
+    All probability thresholds lying strictly between the coarse neighbours of each candidate.
+    :param thresholds: sorted list of all probability thresholds (float).
+    :param candidates: list of the best coarse probability thresholds (float).
+    :param stride: stride between the coarse thresholds, as given by get_coarse_probability_thresholds.
+    :return: sorted list of probability thresholds to evaluate during the refinement.
+    """
+    refined_thresholds = []
+    for candidate in candidates:
+        index = int(np.argmin(np.abs(np.asarray(thresholds) - candidate)))
+        refined_thresholds.extend(thresholds[max(0, index - stride + 1):index + stride])
+    return sorted(set(refined_thresholds))
+
+
+def select_probability_threshold_candidates(results, nb_candidates=1):
+    """
+    Best probability thresholds based on the average pixel-wise Dice, from the results already computed. The
+    candidates are selected independently across all patients and across the true positive patients only, similar
+    to the optimal threshold analysis.
+    :param results: pd.DataFrame with the content of a [class]_dice_scores.csv file.
+    :param nb_candidates: number of best thresholds to select for each patient population.
+    :return: sorted list of the selected probability thresholds (float).
+    """
+    candidates = []
+    for subset in [results, results.loc[results["True Positive"].astype(str) == 'True']]:
+        if len(subset) == 0:
+            continue
+        mean_dices = subset.groupby('Threshold')['PiW Dice'].mean().sort_values(ascending=False, kind='stable')
+        candidates.extend(list(mean_dices.index.values[:nb_candidates]))
+    return sorted(set([float(np.round(x, 4)) for x in candidates]))
 
 
-def best_segmentation_probability_threshold_analysis(folder, detection_overlap_thresholds=None):
+def best_segmentation_probability_threshold_analysis(folder, detection_overlap_thresholds=None, cohort=None):
     classes = SharedResources.getInstance().validation_class_names
+    if cohort is None:
+        cohort = CohortMetrics.from_folder(os.path.join(folder, 'Validation'), classes)
     class_optimal = {}
     for c in classes:
         class_optimal[c] = {}
@@ -17,300 +66,288 @@ def best_segmentation_probability_threshold_analysis(folder, detection_overlap_t
         class_optimal[c]['True Positive'] = []
         optimal_overlap, optimal_threshold = best_segmentation_probability_threshold_analysis_inner(folder,
                                                                                                     detection_overlap_thresholds,
-                                                                                                    c, False)
+                                                                                                    c, False, cohort)
         class_optimal[c]['All'] = [optimal_overlap, optimal_threshold]
         optimal_overlap_tp, optimal_threshold_tp = best_segmentation_probability_threshold_analysis_inner(folder,
                                                                                                           detection_overlap_thresholds,
-                                                                                                          c, True)
+                                                                                                          c, True, cohort)
         class_optimal[c]['True Positive'] = [optimal_overlap_tp, optimal_threshold_tp]
 
     return class_optimal
 
 
 def best_segmentation_probability_threshold_analysis_inner(folder, detection_overlap_thresholds, class_name,
-                                                           true_positive_state):
+                                                           true_positive_state, cohort=None, objective=None,
+                                                           plot=True):
     """
     The best threshold probability and object overlap are determined based on a combination of overall DICE
     performance and F1-score. The recall here is not object-wise (i.e., each tumor part not considered individually),
     but at a patient-level based on overall Dice and overlap cut-off.
     :param folder: main validation directory containing the all_dice_scores.csv file.
     :param detection_overlap_thresholds: list of threshold values (float) to use in the range [0., 1.].
+    :param cohort: (optional) CohortMetrics with the results of all classes, loaded from the folder if not provided.
+    :param objective: (optional) name of the objective to maximize, from OPTIMAL_THRESHOLD_OBJECTIVES, or function
+    returning the objective value of each row of the study table (default to the configuration file).
+    :param plot: whether to save the figures of the study inside the OptimalSearch sub-folder.
     :return: optimal probability threshold and Dice cut-off.
     """
     suffix = "_tp" if true_positive_state else ""
-    patient_dices_filename = os.path.join(folder, 'Validation', class_name + '_dice_scores.csv')
     study_filename = os.path.join(folder, 'Validation', class_name + '_optimal_dice_study' + suffix + '.csv')
-    study_file = open(study_filename, 'w')
-    study_writer = csv.writer(study_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    study_writer.writerow(
-        ['Detection threshold', 'Dice threshold', 'Dice', 'PiW Recall', 'PiW Precision', 'PiW F1', 'Found', 'Total'])
+    if cohort is None:
+        cohort = CohortMetrics.from_folder(os.path.join(folder, 'Validation'), [class_name])
+
+    study_rows = compute_optimal_threshold_study(cohort, class_name, detection_overlap_thresholds, true_positive_state)
+    study_results = pd.DataFrame(study_rows, columns=OPTIMAL_THRESHOLD_STUDY_COLUMNS)
+    max_overlap, max_threshold, max_global_metrics_value = select_optimal_threshold(study_results, objective)
+
+    with open(study_filename, 'w') as study_file:
+        study_writer = csv.writer(study_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        study_writer.writerow(OPTIMAL_THRESHOLD_STUDY_COLUMNS)
+        study_writer.writerows(study_rows)
+        study_writer.writerow(['', '', '', '', '', '', '', ''])
+        study_writer.writerow([max_overlap, max_threshold, '', '', '', '', '', ''])
+    print('Class \'{}\' - Selected values (Overlap: {}, Threshold: {}) for global metric of {}.'
+          ' True positive case: {}'.format(class_name, max_overlap, max_threshold, max_global_metrics_value,
+                                           true_positive_state))
+
+    if plot:
+        plot_optimal_threshold_study(os.path.join(folder, 'Validation', 'OptimalSearch'), study_results)
 
-    all_dices = pd.read_csv(patient_dices_filename)
+    return max_overlap, max_threshold
+
+
+def compute_optimal_threshold_study(cohort, class_name, detection_overlap_thresholds=None, true_positive_state=False):
+    """
+    Average pixel-wise metrics over the patients whose Dice (rounded to 3 decimals) reaches each overlap cut-off, for
+    every (overlap cut-off, probability threshold) pair at once.
+    For each probability threshold, the patients are sorted by decreasing Dice and the metrics cumulated, such that
+    the patients reaching any cut-off are a prefix of the sorted patients, and their sums a single lookup.
+    :param cohort: CohortMetrics with the results of the class.
+    :param detection_overlap_thresholds: list of Dice overlap cut-offs (float) in the range [0., 1.].
+    :param true_positive_state: whether only the true positive patients are considered.
+    :return: list of rows following OPTIMAL_THRESHOLD_STUDY_COLUMNS, by overlap cut-off and then by probability
+    threshold.
+    """
     object_detection_dice_thresholds = [0.]
     if detection_overlap_thresholds is not None and type(detection_overlap_thresholds) is list:
         object_detection_dice_thresholds = detection_overlap_thresholds
 
-    thresholds = [np.round(x, 2) for x in list(np.unique(all_dices['Threshold'].values))]
+    thresholds = [np.round(x, 4) for x in list(cohort.thresholds)]
     nb_thresh = len(thresholds)
-    recall_precision_results = []
+    if nb_thresh == 0:
+        return []
+    population = cohort.get_population_mask(class_name, 'True Positive' if true_positive_state else 'All')
+    population = population.reshape(-1, nb_thresh)
+    pixelwise_metrics = np.stack([cohort.get_metric_values(class_name, m) for m in ['PiW Dice', 'PiW Recall',
+                                                                                    'PiW Precision', 'PiW F1']],
+                                 axis=-1).reshape(-1, nb_thresh, 4)
+    dices = np.round(pixelwise_metrics[..., 0], 3)
+
+    # The patients outside the population (or without Dice) are sorted last, and never reach any cut-off
+    sorting_keys = np.where(population & ~np.isnan(dices), dices, -np.inf)
+    order = np.argsort(-sorting_keys, axis=0, kind='stable')
+    sorted_keys = np.take_along_axis(sorting_keys, order, axis=0)
+    cumulated_metrics = np.concatenate([np.zeros((1, nb_thresh, 4)),
+                                        np.cumsum(np.take_along_axis(pixelwise_metrics, order[..., np.newaxis], axis=0),
+                                                  axis=0)], axis=0)
+    overlaps = np.asarray(object_detection_dice_thresholds, dtype='float64')
+    nb_found = np.stack([np.searchsorted(-sorted_keys[:, t], -overlaps, side='right') for t in range(nb_thresh)],
+                        axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_metrics = cumulated_metrics[nb_found, np.arange(nb_thresh)[np.newaxis, :]] / nb_found[..., np.newaxis]
+    nb_gt = np.count_nonzero(population, axis=0)
+
+    study_rows = []
+    for o, obj in enumerate(object_detection_dice_thresholds):
+        for thr in range(nb_thresh):
+            study_rows.append([obj, thresholds[thr]] + list(mean_metrics[o, thr]) + [int(nb_found[o, thr]),
+                                                                                    int(nb_gt[thr])])
+    return study_rows
 
-    max_global_metrics_value = 0
-    max_threshold = None
-    max_overlap = None
-    if true_positive_state:
-        all_dices = all_dices.loc[all_dices["True Positive"] == True]
 
-    for obj in object_detection_dice_thresholds:
-        for thr in range(nb_thresh):
-            pixelwise_metrics_df = all_dices[['PiW Dice', 'PiW Recall', 'PiW Precision', 'PiW F1']]
-            dice_selected_pixelwise_metrics_df = pixelwise_metrics_df.loc[np.round(pixelwise_metrics_df['PiW Dice'], 3) >= obj]
-            dice_selected_pixelwise_metrics = dice_selected_pixelwise_metrics_df[thr::nb_thresh]
-            mean_dice = dice_selected_pixelwise_metrics['PiW Dice'].values.mean()
-            mean_recall = dice_selected_pixelwise_metrics['PiW Recall'].values.mean()
-            mean_precision = dice_selected_pixelwise_metrics['PiW Precision'].values.mean()
-            mean_f1 = dice_selected_pixelwise_metrics['PiW F1'].values.mean()
-
-            gt = all_dices['True Positive'].values[thr::nb_thresh]
-            nb_gt = len(gt)
-            nb_found = len(dice_selected_pixelwise_metrics)
-
-            recall_precision_results.append([obj, thresholds[thr], mean_dice, mean_recall, mean_precision, mean_f1, nb_found, nb_gt])
-            study_writer.writerow([obj, thresholds[thr], mean_dice, mean_recall, mean_precision, mean_f1, nb_found, nb_gt])
-
-            global_result = mean_dice
-            if global_result > max_global_metrics_value:
-                max_global_metrics_value = global_result
-                max_threshold = thresholds[thr]
-                max_overlap = obj
-
-    # # Small trick to comply with further computation. Otherwise, patients with a 0% Dice detection would still be
-    # # considered as true positives, which is a behaviour to avoid.
-    # if max_overlap == 0.:
-    #     max_overlap = 0.01
-    study_writer.writerow(['', '', '', '', '', '', '', ''])
-    study_writer.writerow([max_overlap, max_threshold, '', '', '', '', '', ''])
-    study_file.close()
-    print('Class \'{}\' - Selected values (Overlap: {}, Threshold: {}) for global metric of {}.'
-          ' True positive case: {}'.format(class_name, max_overlap, max_threshold, max_global_metrics_value,
-                                           true_positive_state))
+def select_optimal_threshold(study_results, objective=None):
+    """
+    (Overlap cut-off, probability threshold) pair maximizing the objective, the first one being kept in case of ties.
+    No pair is selected if the objective never exceeds 0.
+    :param study_results: pd.DataFrame with the optimal threshold study.
+    :param objective: name of the objective from OPTIMAL_THRESHOLD_OBJECTIVES, or function returning the objective
+    value of each row of the study (default to the configuration file).
+    :return: optimal overlap cut-off, optimal probability threshold, and the corresponding objective value.
+    """
+    if objective is None:
+        objective = SharedResources.getInstance().validation_optimal_threshold_objective
+    if not callable(objective):
+        objective = OPTIMAL_THRESHOLD_OBJECTIVES[objective]
+    scores = np.asarray(objective(study_results), dtype='float64')
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if len(scores) == 0 or not scores[np.argmax(scores)] > 0:
+        return None, None, 0
+    best = int(np.argmax(scores))
+    return study_results['Detection threshold'].tolist()[best], study_results['Dice threshold'].values[best],\
+        scores[best]
 
-    recall_precision_results = np.asarray(recall_precision_results)
-    plt.rcParams["font.weight"] = "bold"
-    plt.rcParams["axes.labelweight"] = "bold"
-    fig, ax = plt.subplots()
-    fig2, ax2 = plt.subplots()
-    fig3, ax3 = plt.subplots()
-    fig4, ax4 = plt.subplots()
-    for o, obj in enumerate(object_detection_dice_thresholds):
-        threshs = recall_precision_results[o * nb_thresh:(o + 1) * nb_thresh, 1]
-        dices = recall_precision_results[o * nb_thresh:(o + 1) * nb_thresh, 2]
-        F1s = recall_precision_results[o * nb_thresh:(o + 1) * nb_thresh, 5]
-        ax.plot(threshs, dices, label=str(obj * 100) + '% overlap')
-        ax2.plot(threshs, F1s, label=str(obj * 100) + '% overlap')
-        ax3.plot(dices, F1s, label=str(obj * 100) + '% overlap')
-        ax4.scatter(threshs, dices, label=str(obj * 100) + '% overlap' + '_Dice', marker='x')
-        ax4.scatter(threshs, F1s, label=str(obj * 100) + '% overlap' + '_F1s', marker='o')
-
-    ax.set(xlabel='Network probability threshold', ylabel='Dice')  # title='Dice over network probability.'
-    ax.set_xlim(0., 1.)
-    ax.set_ylim(0., 1.)
-    ax.grid(linestyle='--')
-    ax.legend()
-    ax2.set(xlabel='Network probability threshold', ylabel='F1-score')  # , title='F1-score over network probability.'
-    ax2.set_xlim(0., 1.)
-    ax2.set_ylim(0., 1.)
-    ax2.grid(linestyle='--')
-    ax2.legend()
-    ax3.set(xlabel='Dices', ylabel='F1-score')  # , title='F1-score over dice evolution.'
-    ax3.set_xlim(0., 1.)
-    ax3.set_ylim(0., 1.)
-    ax3.grid(linestyle='--')
-    ax3.legend()
-    ax4.set(xlabel='Network probability threshold',
-            ylabel='Probability')  # , title='Combined dice/F1-score over network probability.'
-    ax4.set_xlim(0., 1.)
-    ax4.set_ylim(0., 1.)
-    ax4.grid(linestyle='--')
-    ax4.legend(loc='lower center')
-    # plt.show()
-
-    os.makedirs(os.path.join(folder, 'Validation', 'OptimalSearch'), exist_ok=True)
-    fig.savefig(os.path.join(folder, 'Validation', 'OptimalSearch', 'dice_over_threshold.png'), dpi=300,
-                bbox_inches="tight")
-    fig2.savefig(os.path.join(folder, 'Validation', 'OptimalSearch', 'F1_over_threshold.png'), dpi=300,
-                 bbox_inches="tight")
-    fig3.savefig(os.path.join(folder, 'Validation', 'OptimalSearch', 'F1_over_dice.png'), dpi=300,
-                 bbox_inches="tight")
-    fig4.savefig(os.path.join(folder, 'Validation', 'OptimalSearch', 'metrics_scatter_over_threshold.png'), dpi=300,
-                 bbox_inches="tight")
 
-    return max_overlap, max_threshold
+def compute_weighted_objective(study_results):
+    weights = SharedResources.getInstance().validation_optimal_threshold_objective_weights
+    return weights[0] * study_results['Dice'].values + weights[1] * study_results['PiW F1'].values
 
 
-def compute_fold_average(folder, data=None, class_optimal={}, metrics=[], suffix='', true_positive_state=False):
+OPTIMAL_THRESHOLD_STUDY_COLUMNS = ['Detection threshold', 'Dice threshold', 'Dice', 'PiW Recall', 'PiW Precision',
+                                   'PiW F1', 'Found', 'Total']
+OPTIMAL_THRESHOLD_OBJECTIVES = {'dice': lambda study_results: study_results['Dice'].values,
+                                'f1': lambda study_results: study_results['PiW F1'].values,
+                                'weighted': compute_weighted_objective}
+
+
+def compute_fold_average(folder, data=None, class_optimal={}, metrics=[], suffix='', true_positive_state=False,
+                         cohort=None):
     classes = SharedResources.getInstance().validation_class_names
     optimal_tag = 'All' if not true_positive_state else 'True Positive'
+    if data is None and cohort is None:
+        cohort = CohortMetrics.from_folder(os.path.join(folder, 'Validation'), classes)
     for c in classes:
         optimal_values = class_optimal[c][optimal_tag]
         compute_fold_average_inner(folder, data=data, class_name=c, best_threshold=optimal_values[1],
                                    best_overlap=optimal_values[0], metrics=metrics, suffix=suffix,
-                                   true_positive_state=true_positive_state)
+                                   true_positive_state=true_positive_state, cohort=cohort)
 
 
 def compute_fold_average_inner(folder, class_name, data=None, best_threshold=0.5, best_overlap=0.0, metrics=[],
-                               suffix='', true_positive_state=False):
+                               suffix='', true_positive_state=False, cohort=None):
     """
     :param folder: Main study folder where the results will be dumped (assuming inside a Validation sub-folder)
+    :param data: (optional) pd.DataFrame with the results to average, used as is (i.e., without selecting the true
+    positive patients).
     :param best_threshold:
     :param best_overlap:
-    :param metric_names:
+    :param metrics: list of the extra metrics to average, in addition to the default ones.
+    :param cohort: (optional) CohortMetrics with the results, loaded from the folder if neither data nor cohort
+    are provided.
     :return:
     """
-    results = None
-    if data is None:
-        results_filename = os.path.join(folder, 'Validation', class_name + '_dice_scores.csv')
-        results = pd.read_csv(results_filename)
-        if true_positive_state:
-            results = results.loc[results["True Positive"] == True]
-    else:
-        results = deepcopy(data)
+    category = 'True Positive' if true_positive_state else 'All'
+    if data is not None:
+        cohort = CohortMetrics({class_name: data})
+        category = 'All'
+    elif cohort is None:
+        cohort = CohortMetrics.from_folder(os.path.join(folder, 'Validation'), [class_name])
 
     suffix = "tp" + suffix if true_positive_state else suffix
-    results.replace('inf', np.nan, inplace=True)
-    results.replace(float('inf'), np.nan, inplace=True)
-    results.replace('', np.nan, inplace=True)
-    results.replace(' ', np.nan, inplace=True)
-    unique_folds = np.unique(results['Fold'])
-    nb_folds = len(unique_folds)
-    metrics_per_fold = []
-
-    metric_names = list(results.columns[3:])
-    # if metrics is not None:
-    #     metric_names.extend(metrics)
-
-    fold_average_columns = ['Fold', '# samples', 'Patient-wise recall', 'Patient-wise precision', 'Patient-wise specificity',
-                            'Patient-wise F1', 'Patient-wise Accuracy', 'Patient-wise Balanced accuracy']
-    for m in metric_names:
-        fold_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-
-    # Regarding the overlap threshold, should the patient discarded for recall be
-    # used for other metrics computation?
-    for f in unique_folds:
-        patientwise_metrics = compute_patientwise_fold_metrics(results, f, best_threshold, best_overlap)
-        fold_average_metrics, fold_std_metrics = compute_singe_fold_average_metrics(results, f, best_threshold, best_overlap, metrics)
-        fold_metrics = []
-        for m in range(len(fold_average_metrics)):
-            fold_metrics.append(fold_average_metrics[m])
-            fold_metrics.append(fold_std_metrics[m])
-        fold_average = [f, len(np.unique(results.loc[results['Fold'] == f]['Patient'].values))] + patientwise_metrics + fold_metrics
-        metrics_per_fold.append(fold_average)
-
-    metrics_per_fold_df = pd.DataFrame(data=metrics_per_fold, columns=fold_average_columns)
+    metrics_per_fold_df, pooled_fold_averaged_results_df = compute_fold_average_metrics(cohort, class_name,
+                                                                                        best_threshold,
+                                                                                        best_overlap, metrics,
+                                                                                        category)
     study_filename = os.path.join(folder, 'Validation', class_name + '_folds_metrics_average.csv') if suffix == '' else os.path.join(folder,
                                                                                                  'Validation',
                                                                                                  class_name + '_folds_metrics_average_' + suffix + '.csv')
     metrics_per_fold_df.to_csv(study_filename, index=False)
-
-    ####### Averaging the results from the different folds ###########
-    total_samples = metrics_per_fold_df['# samples'].sum()
-    patientwise_fold_metrics_to_average = metrics_per_fold_df.values[:, 2:8]
-    fold_metrics_to_average = metrics_per_fold_df.values[:, 8:][:, 0::2]
-    fold_std_metrics_to_average = metrics_per_fold_df.values[:, 8:][:, 1::2]
-    total_fold_metrics_to_average = np.concatenate((patientwise_fold_metrics_to_average, fold_metrics_to_average), axis=1)
-    fold_metrics_average = np.mean(total_fold_metrics_to_average, axis=0)
-    fold_metrics_std = np.std(total_fold_metrics_to_average, axis=0)
-    fold_averaged_results = [total_samples]
-    for m in range(len(fold_metrics_average)):
-        fold_averaged_results.append(fold_metrics_average[m])
-        fold_averaged_results.append(fold_metrics_std[m])
-
-    # Performing pooled estimates (taking into account the sample size for each fold) when relevant
-    pooled_fold_averaged_results = [len(unique_folds), total_samples]
-    pw_index = 6  # Length of the initial fold_average_columns, without the first two elements.
-    for m in range(total_fold_metrics_to_average.shape[1]):
-        mean_final = 0
-        std_final = 0
-        for f in range(len(unique_folds)):
-            fold_val = total_fold_metrics_to_average[f, m]
-            fold_sample_size = list(metrics_per_fold_df['# samples'])[f]
-            mean_final = mean_final + (fold_val * fold_sample_size)
-            # For patient-wise metrics, there is no std value for within each fold
-            if m < pw_index:
-                std_final = std_final
-            else:
-                std_final = std_final + ((fold_sample_size - 1) * math.pow(fold_std_metrics_to_average[f, m-pw_index], 2) + (fold_sample_size) * math.pow(fold_val, 2))
-        mean_final = mean_final / total_samples
-        if m >= pw_index:
-            std_final = math.sqrt((1 / (total_samples - 1)) * (std_final - (total_samples * math.pow(mean_final, 2))))
-        else:
-            std_final = np.std(total_fold_metrics_to_average[:, m])
-        pooled_fold_averaged_results.extend([mean_final, std_final])
-
-    overall_average_columns = ['Fold', '# samples']
-    for m in ['Patient-wise recall', 'Patient-wise precision', 'Patient-wise specificity', 'Patient-wise F1',
-              'Patient-wise Accuracy', 'Patient-wise Balanced accuracy']:
-        overall_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-
-    for m in metric_names:
-        overall_average_columns.extend([m + ' (Mean)', m + ' (Std)'])
-    pooled_fold_averaged_results_df = pd.DataFrame(data=np.asarray(pooled_fold_averaged_results).reshape(1, len(overall_average_columns)), columns=overall_average_columns)
     study_filename = os.path.join(folder, 'Validation', class_name + '_overall_metrics_average.csv') if suffix == '' else os.path.join(folder,
                                                                                                  'Validation',
                                                                                                  class_name + '_overall_metrics_average_' + suffix + '.csv')
     pooled_fold_averaged_results_df.to_csv(study_filename, index=False)
 
 
-def compute_singe_fold_average_metrics(results, fold_number, best_threshold, best_overlap, metric_names):
-    fold_results = results.loc[results['Fold'] == fold_number]
-    thresh_index = (np.round(fold_results['Threshold'], 1) == best_threshold)
-    all_for_thresh = fold_results.loc[thresh_index]
-    if len(all_for_thresh) == 0:
-        # Empty fold? Can indicate something went wrong, or was not computed properly beforehand
-        return None
-    upper_default_metrics_index = SharedResources.getInstance().upper_default_metrics_index
-    default_metrics_average = list(np.mean(all_for_thresh.values[:, 3:upper_default_metrics_index], axis=0))
-    default_metrics_std = [np.std(all_for_thresh.values[:, x], axis=0) for x in range(3, upper_default_metrics_index)]
-
-    extra_metrics_average = []
-    extra_metrics_std = []
-    for m in metric_names:
-        if m in fold_results.columns.values:
-            if m in ['HD95', 'ASSD', 'RAVD', 'VC', 'OASSD']:
-                avg = fold_results.loc[thresh_index][fold_results.loc[thresh_index][m] != -1.0][m].dropna().astype(
-                    'float32').mean()
-                std = fold_results.loc[thresh_index][fold_results.loc[thresh_index][m] != -1.0][m].dropna().astype(
-                    'float32').std(ddof=0)
-            else:
-                avg = all_for_thresh[m].dropna().astype('float32').mean()
-                std = all_for_thresh[m].dropna().astype('float32').std(ddof=0)
-            extra_metrics_average.append(avg)
-            extra_metrics_std.append(std)
-
-    return default_metrics_average + extra_metrics_average, default_metrics_std + extra_metrics_std
-
-
-def compute_patientwise_fold_metrics(results, fold_number, best_threshold, best_overlap):
-    fold_results = results.loc[results['Fold'] == fold_number]
-    thresh_index = (np.round(fold_results['Threshold'], 1) == best_threshold)
-    all_for_thresh = fold_results.loc[thresh_index]
-    if len(all_for_thresh) == 0:
-        # Empty fold? Can indicate something went wrong, or was not computed properly beforehand
-        fold_average = [-1., -1., -1., -1., -1., -1.]
-        return fold_average
-
-    true_positives = fold_results.loc[thresh_index & (fold_results['PiW Dice'] > best_overlap) & (fold_results['True Positive'] == True)]
-    false_positives = fold_results.loc[thresh_index & (fold_results['True Positive'] == False) & (fold_results['Detection volume (ml)'] > 0.)]
-    true_negatives = fold_results.loc[thresh_index & (fold_results['True Positive'] == False) & (fold_results['Detection volume (ml)'] == 0.)]
-    false_negatives = fold_results.loc[thresh_index & (fold_results['PiW Dice'] <= best_overlap) & (fold_results['True Positive'] == True)]
-    patient_wise_recall = len(true_positives) / (len(true_positives) + len(false_negatives) + 1e-6)
-    patient_wise_precision = len(true_positives) / (len(true_positives) + len(false_positives) + 1e-6)
-    patient_wise_specificity = len(true_negatives) / (len(true_negatives) + len(false_positives) + 1e-6)
-    patient_wise_f1 = 2 * len(true_positives) / ((2 * len(true_positives)) + len(false_positives) + len(false_negatives) + 1e-6)
-    accuracy = (len(true_positives) + len(true_negatives)) / (len(true_positives) + len(true_negatives) + len(false_positives) + len(false_negatives))
-    balanced_accuracy = (patient_wise_recall + patient_wise_specificity) / 2
-
-    # fold_number, len(np.unique(fold_results['Patient'].values))
-    patientwise_metrics = [patient_wise_recall, patient_wise_precision, patient_wise_specificity, patient_wise_f1,
-                           accuracy, balanced_accuracy]
-    return patientwise_metrics
+PATIENTWISE_METRIC_NAMES = ['Patient-wise recall', 'Patient-wise precision', 'Patient-wise specificity',
+                            'Patient-wise F1', 'Patient-wise Accuracy', 'Patient-wise Balanced accuracy']
+# Metrics for which -1 denotes a value which could not be computed (e.g., no detection), excluded from the averages
+UNDEFINED_VALUE_METRIC_NAMES = ['HD95', 'ASSD', 'RAVD', 'VC', 'OASSD']
+
 
+def compute_fold_average_metrics(cohort, class_name, best_threshold, best_overlap, metrics=[], category='All'):
+    """
+    Per-fold and pooled statistics of all metrics at the optimal probability threshold, computed for all folds and
+    metrics at once over the fold axis of the cohort cube.
+    For each fold: the patient-wise recall, precision, specificity, F1, accuracy, and balanced accuracy (where a
+    patient is found if its Dice exceeds the overlap cut-off), and the mean and standard deviation of the default
+    and extra metrics over the patients. The extra metrics are averaged as float32, ignoring the missing values (and
+    the -1 values for the distance-based metrics).
+    Across the folds: the mean and standard deviation of the fold values for the patient-wise metrics, and the
+    pooled mean and standard deviation (weighted by the number of patients in each fold) for the other metrics.
+    :param cohort: CohortMetrics with the results of the class.
+    :param metrics: list of the extra metrics to average, the ones missing from the results being skipped.
+    :param category: population of patients, from ['All', 'True Positive'].
+    :return: pd.DataFrame with one row per fold, and pd.DataFrame with the single row of pooled estimates.
+    """
+    nb_default_metrics = SharedResources.getInstance().upper_default_metrics_index - 3
+    default_metric_names = cohort.metric_names[:nb_default_metrics]
+    extra_metric_names = [x for x in metrics if x in cohort.metric_names]
+    fold_patients_count = cohort.get_fold_patients_count(class_name, category)
+    folds = np.flatnonzero(fold_patients_count > 0)
+    nb_samples = fold_patients_count[folds]
+
+    values, population = cohort.get_optimal_values(class_name, best_threshold, default_metric_names +
+                                                   extra_metric_names + ['True Positive'], category)
+    values = values[folds]
+    population = population[folds]
+    values[values == np.inf] = np.nan
+    nb_patients = np.count_nonzero(population, axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Patient-wise detection metrics
+        dices = values[..., default_metric_names.index('PiW Dice')]
+        true_positive_states = values[..., -1]
+        detection_volumes = values[..., default_metric_names.index('Detection volume (ml)')]
+        true_positives = np.count_nonzero(population & (dices > best_overlap) & (true_positive_states == 1.), axis=1)
+        false_positives = np.count_nonzero(population & (true_positive_states == 0.) & (detection_volumes > 0.), axis=1)
+        true_negatives = np.count_nonzero(population & (true_positive_states == 0.) & (detection_volumes == 0.), axis=1)
+        false_negatives = np.count_nonzero(population & (dices <= best_overlap) & (true_positive_states == 1.), axis=1)
+        recall = true_positives / (true_positives + false_negatives + 1e-6)
+        precision = true_positives / (true_positives + false_positives + 1e-6)
+        specificity = true_negatives / (true_negatives + false_positives + 1e-6)
+        f1 = 2 * true_positives / ((2 * true_positives) + false_positives + false_negatives + 1e-6)
+        accuracy = (true_positives + true_negatives) / (true_positives + true_negatives + false_positives +
+                                                        false_negatives)
+        balanced_accuracy = (recall + specificity) / 2
+        patientwise_metrics = np.stack([recall, precision, specificity, f1, accuracy, balanced_accuracy], axis=1)
+        # Folds without any patient at the optimal threshold, can indicate something was not computed properly
+        patientwise_metrics[nb_patients == 0] = -1.
+
+        # Default metrics, averaged over all patients
+        default_values = values[..., :nb_default_metrics]
+        default_mask = population[..., np.newaxis]
+        default_means = np.where(default_mask, default_values, 0.).sum(axis=1) / nb_patients[:, np.newaxis]
+        default_stds = np.sqrt(np.where(default_mask, (default_values - default_means[:, np.newaxis]) ** 2, 0.).sum(
+            axis=1) / nb_patients[:, np.newaxis])
+
+        # Extra metrics, averaged as float32 over the patients with a valid value
+        extra_values = values[..., nb_default_metrics:-1]
+        extra_mask = population[..., np.newaxis] & ~np.isnan(extra_values)
+        undefined_columns = np.asarray([x in UNDEFINED_VALUE_METRIC_NAMES for x in extra_metric_names], dtype=bool)
+        extra_mask = extra_mask & ~((extra_values == -1.) & undefined_columns)
+        extra_values = np.where(extra_mask, extra_values, 0.).astype('float32')
+        extra_counts = np.count_nonzero(extra_mask, axis=1)
+        extra_means = extra_values.sum(axis=1, dtype='float32') / extra_counts.astype('float32')
+        extra_averages = extra_values.sum(axis=1, dtype='float64') / extra_counts
+        extra_stds = np.sqrt((np.where(extra_mask, (extra_averages[:, np.newaxis] - extra_values) ** 2, 0.).sum(
+            axis=1, dtype='float64') / extra_counts).astype('float32'))
+
+    metrics_per_fold = {'Fold': cohort.folds[folds], '# samples': nb_samples}
+    for m, metric in enumerate(PATIENTWISE_METRIC_NAMES):
+        metrics_per_fold[metric] = patientwise_metrics[:, m]
+    for m, metric in enumerate(default_metric_names):
+        metrics_per_fold[metric + ' (Mean)'] = default_means[:, m]
+        metrics_per_fold[metric + ' (Std)'] = default_stds[:, m]
+    for m, metric in enumerate(extra_metric_names):
+        metrics_per_fold[metric + ' (Mean)'] = extra_means[:, m]
+        metrics_per_fold[metric + ' (Std)'] = extra_stds[:, m]
+    metrics_per_fold_df = pd.DataFrame(metrics_per_fold)
+
+    ####### Averaging the results from the different folds ###########
+    # Performing pooled estimates (taking into account the sample size for each fold) when relevant
+    total_samples = nb_samples.sum()
+    fold_means = np.concatenate([patientwise_metrics, default_means, extra_means.astype('float64')], axis=1)
+    fold_stds = np.concatenate([default_stds, extra_stds.astype('float64')], axis=1)
+    fold_sizes = nb_samples[:, np.newaxis].astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled_means = (fold_means * fold_sizes).sum(axis=0) / total_samples
+        pooled_stds = np.sqrt((1 / (total_samples - 1)) * (((fold_sizes - 1) * fold_stds ** 2 + fold_sizes *
+                                                            fold_means[:, len(PATIENTWISE_METRIC_NAMES):] ** 2).sum(
+            axis=0) - (total_samples * pooled_means[len(PATIENTWISE_METRIC_NAMES):] ** 2)))
+    # For patient-wise metrics, there is no std value for within each fold
+    pooled_stds = np.concatenate([np.std(patientwise_metrics, axis=0), pooled_stds])
+
+    pooled_fold_averaged_results = {'Fold': [float(len(folds))], '# samples': [float(total_samples)]}
+    for m, metric in enumerate(PATIENTWISE_METRIC_NAMES + default_metric_names + extra_metric_names):
+        pooled_fold_averaged_results[metric + ' (Mean)'] = [pooled_means[m]]
+        pooled_fold_averaged_results[metric + ' (Std)'] = [pooled_stds[m]]
+    return metrics_per_fold_df, pd.DataFrame(pooled_fold_averaged_results)
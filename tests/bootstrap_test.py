@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy.stats import bootstrap
+
+from raidionicsval.Utils.bootstrap import bootstrap_mean_confidence_intervals
+
+
+def get_dices(seed, size):
+    rng = np.random.default_rng(seed)
+    dices = rng.beta(5., 2., size)
+    dices[:size // 10] = 0.
+    return dices
+
+
+@pytest.mark.parametrize('method', ['percentile', 'bca'])
+@pytest.mark.parametrize('size', [30, 200])
+def test_intervals_match_scipy(method, size):
+    dices = get_dices(size, size)
+    interval = bootstrap_mean_confidence_intervals([dices], nb_resamples=20000, method=method, seed=1)[0]
+    reference = bootstrap((dices,), np.mean, n_resamples=20000, method=method, random_state=2).confidence_interval
+    # Both intervals are subject to Monte Carlo errors, small compared to the standard error of the mean
+    standard_error = np.std(dices) / np.sqrt(size)
+    assert interval[0, 0] == pytest.approx(reference.low, abs=0.1 * standard_error)
+    assert interval[1, 0] == pytest.approx(reference.high, abs=0.1 * standard_error)
+
+
+def test_several_strata_and_metrics_at_once():
+    dices = get_dices(0, 200)
+    values = np.stack([dices, 1. - dices], axis=1)
+    intervals = bootstrap_mean_confidence_intervals([values, dices[dices > 0.5]], nb_resamples=5000, seed=3)
+    assert intervals[0].shape == (2, 2)
+    assert intervals[1].shape == (2, 1)
+    # Each resampled mean of 1 - dices is 1 minus the resampled mean of dices, with a percentile interval
+    intervals = bootstrap_mean_confidence_intervals([values], nb_resamples=5000, method='percentile', seed=3)
+    np.testing.assert_allclose(intervals[0][::-1, 1], 1. - intervals[0][:, 0], atol=1e-12)
+    for interval, mean in zip(intervals[0].T, values.mean(axis=0)):
+        assert interval[0] < mean < interval[1]
+
+
+def test_intervals_are_reproducible_with_a_seed():
+    dices = get_dices(1, 100)
+    first = bootstrap_mean_confidence_intervals([dices], nb_resamples=2000, seed=7)[0]
+    second = bootstrap_mean_confidence_intervals([dices], nb_resamples=2000, seed=7, chunk_size=1000)[0]
+    other = bootstrap_mean_confidence_intervals([dices], nb_resamples=2000, seed=8)[0]
+    np.testing.assert_array_equal(first, bootstrap_mean_confidence_intervals([dices], nb_resamples=2000, seed=7)[0])
+    # Same draws, only the order of the summations differing with the size of the blocks
+    np.testing.assert_allclose(first, second, rtol=1e-12)
+    assert not np.array_equal(first, other)
+
+
+@pytest.mark.parametrize('method', ['percentile', 'bca'])
+def test_empty_and_constant_strata(method):
+    intervals = bootstrap_mean_confidence_intervals([np.zeros(0), np.full(50, 0.7), np.asarray([0.4])],
+                                                    nb_resamples=1000, method=method)
+    assert np.all(np.isnan(intervals[0]))
+    np.testing.assert_array_equal(intervals[1], [[0.7], [0.7]])
+    np.testing.assert_array_equal(intervals[2], [[0.4], [0.4]])
+
+
+def test_unsupported_method():
+    with pytest.raises(ValueError):
+        bootstrap_mean_confidence_intervals([np.ones(10)], method='basic')
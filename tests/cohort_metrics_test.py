@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from raidionicsval.Utils.cohort_metrics import CohortMetrics
+
+
+def get_results_table(extra_metrics: dict, thresholds=(0.5, 0.6)):
+    rows = []
+    for fold, patient in [(0, 'Pat001'), (0, 'Pat002'), (1, 'Pat003')]:
+        for t in thresholds:
+            rows.append([fold, patient, t, 0.8 - t / 10., True] + [v for v in extra_metrics.values()])
+    return pd.DataFrame(rows, columns=['Fold', 'Patient', 'Threshold', 'PiW Dice', 'True Positive'] +
+                        list(extra_metrics.keys()))
+
+
+def test_class_metric_names_leave_out_the_other_classes_metrics():
+    cohort = CohortMetrics({'tumor': get_results_table({'HD95': 3.2, 'ASSD': 1.1}),
+                            'other': get_results_table({'HD95': 2.5, 'Jaccard': 0.7})})
+    assert cohort.metric_names == ['PiW Dice', 'True Positive', 'HD95', 'ASSD', 'Jaccard']
+    assert cohort.get_class_metric_names('tumor') == ['PiW Dice', 'True Positive', 'HD95', 'ASSD']
+    assert cohort.get_class_metric_names('other') == ['PiW Dice', 'True Positive', 'HD95', 'Jaccard']
+
+
+def test_optimal_values_are_placed_by_fold_patient_and_threshold():
+    results_df = get_results_table({'HD95': 3.2})
+    cohort = CohortMetrics({'tumor': results_df.iloc[::-1]})
+    values, population = cohort.get_optimal_values('tumor', 0.6, ['PiW Dice', 'HD95'])
+    assert values.shape == (2, 2, 2)
+    np.testing.assert_array_equal(population, [[True, True], [True, False]])
+    np.testing.assert_allclose(values[population], [[0.74, 3.2]] * 3)
+    np.testing.assert_array_equal(cohort.get_fold_patients_count('tumor'), [2, 1])
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from raidionicsval.Computation.component_tree_computation import ProbabilityComponentTree,\
+    compute_thresholded_objectwise_results
+from raidionicsval.Validation.instance_segmentation_validation import InstanceSegmentationValidation, label_objects
+
+THRESHOLDS = [0.6, 0.1, 0.3, 0.5, 0.4, 0.2, 0.7, 0.8, 0.9]
+
+
+def get_random_case(seed, shape=(24, 20, 16)):
+    rng = np.random.default_rng(seed)
+    gt = gaussian_filter(rng.random(shape), 1.5) > 0.53
+    probabilities = gaussian_filter(rng.random(shape), 1.) + 0.3 * gt
+    probabilities = (probabilities - probabilities.min()) / (probabilities.max() - probabilities.min())
+    return gt.astype('uint8'), probabilities.astype('float32')
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('min_size', [0, 3, 10])
+def test_tree_objects_match_the_labeling_of_each_detection(seed, min_size):
+    _, probabilities = get_random_case(seed)
+    tree = ProbabilityComponentTree(probabilities, THRESHOLDS)
+    for t, threshold in enumerate(THRESHOLDS):
+        objects = tree.get_threshold_objects(t, min_size=min_size)
+        candidates = label_objects(probabilities >= threshold, min_size)[1]
+        assert list(tree.node_areas[objects]) == [x.area for x in candidates]
+
+
+def run_instance_validation(gt, detection, min_size, object_matching):
+    validation = InstanceSegmentationValidation(gt_image=gt, detection_image=detection.astype('uint8'))
+    validation.tiny_objects_removal_threshold = min_size
+    validation.object_matching = object_matching
+    validation.run()
+    return validation.instance_detection_results + [len(validation.gt_candidates), len(validation.detection_candidates)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('min_size', [0, 3, 10])
+@pytest.mark.parametrize('object_matching', ['many-to-many', 'one-to-one'])
+def test_results_match_the_instance_validation_at_each_threshold(seed, min_size, object_matching):
+    gt, probabilities = get_random_case(seed)
+    results = compute_thresholded_objectwise_results(gt, probabilities, THRESHOLDS, min_size=min_size,
+                                                     object_matching=object_matching)
+    assert len(results) == len(THRESHOLDS)
+    for threshold, result in zip(THRESHOLDS, results):
+        assert result == run_instance_validation(gt, probabilities >= threshold, min_size, object_matching)
+
+
+@pytest.mark.parametrize('empty_gt', [False, True])
+def test_results_without_ground_truth_or_detection(empty_gt):
+    gt, probabilities = get_random_case(0)
+    if empty_gt:
+        gt = np.zeros_like(gt)
+    # No detection at all above the last threshold
+    thresholds = [0.5, 1.1]
+    results = compute_thresholded_objectwise_results(gt, probabilities, thresholds)
+    for threshold, result in zip(thresholds, results):
+        assert result == run_instance_validation(gt, probabilities >= threshold, 0, 'many-to-many')
@@ -0,0 +1,49 @@
+import numpy as np
+
+from raidionicsval.Computation.confusion_computation import compute_thresholded_confusion_counts
+
+
+def get_reference_counts(gt, probabilities, thresholds):
+    """
+    Confusion counts from the binarization at each threshold, as performed in separate_dice_computation.
+    """
+    counts = []
+    for t in thresholds:
+        detection = probabilities >= np.round(np.float64(t), 4)
+        counts.append([np.count_nonzero(gt & detection), np.count_nonzero(~gt & detection),
+                       np.count_nonzero(gt & ~detection), np.count_nonzero(~gt & ~detection)])
+    return np.asarray(counts).T
+
+
+def get_synthetic_volume(dtype='float64'):
+    rng = np.random.default_rng(42)
+    gt = np.zeros((24, 20, 16), dtype=bool)
+    gt[5:15, 4:12, 3:10] = True
+    probabilities = rng.random(gt.shape)
+    probabilities[gt] = np.clip(probabilities[gt] + 0.3, 0., 1.)
+    # Values landing exactly on the thresholds, and on the bounds of [0., 1.]
+    exact_values = np.asarray([0., 0.1, 0.2, 0.25, 0.5, 0.7, 0.9, 1.])
+    probabilities.flat[rng.choice(probabilities.size, 400, replace=False)] = rng.choice(exact_values, 400)
+    return gt, probabilities.astype(dtype)
+
+
+def test_counts_match_per_threshold_binarization():
+    gt, probabilities = get_synthetic_volume()
+    thresholds = [0.1, 0.2, 0.25, 0.3, 0.5, 0.7, 0.9, 1.]
+    counts = compute_thresholded_confusion_counts(gt, probabilities, thresholds)
+    np.testing.assert_array_equal(np.asarray(counts), get_reference_counts(gt, probabilities, thresholds))
+
+
+def test_counts_match_for_float32_probabilities():
+    gt, probabilities = get_synthetic_volume('float32')
+    thresholds = list(np.round(np.arange(0.05, 1.0001, 0.05), 4))
+    counts = compute_thresholded_confusion_counts(gt, probabilities, thresholds)
+    np.testing.assert_array_equal(np.asarray(counts), get_reference_counts(gt, probabilities, thresholds))
+
+
+def test_counts_keep_the_thresholds_order_and_chunks():
+    gt, probabilities = get_synthetic_volume()
+    thresholds = [0.9, 0.1, 0.5, 0.25, 0.7]
+    counts = compute_thresholded_confusion_counts(gt, probabilities, thresholds, chunk_size=1000)
+    np.testing.assert_array_equal(np.asarray(counts), get_reference_counts(gt, probabilities, thresholds))
+    assert np.all(np.asarray(counts).sum(axis=0) == gt.size)
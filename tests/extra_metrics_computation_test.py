@@ -0,0 +1,81 @@
+import math
+import warnings
+import numpy as np
+import pytest
+from sklearn.metrics import matthews_corrcoef, cohen_kappa_score, jaccard_score, rand_score, adjusted_rand_score,\
+    normalized_mutual_info_score, mutual_info_score, roc_auc_score
+
+from raidionicsval.Computation.confusion_computation import compute_probability_histograms
+from raidionicsval.Validation.extra_metrics_computation import compute_count_based_metric_value,\
+    compute_probability_based_metric_value
+
+
+def get_confusion_counts(gt, detection):
+    return [np.count_nonzero(gt & detection), np.count_nonzero(~gt & detection), np.count_nonzero(gt & ~detection),
+            np.count_nonzero(~gt & ~detection)]
+
+
+def get_binary_entropy(volume):
+    p = np.count_nonzero(volume) / volume.size
+    return -sum([x * math.log2(x) for x in [p, 1. - p] if x != 0])
+
+
+SKLEARN_METRICS = {
+    'MCC': matthews_corrcoef,
+    'CKS': cohen_kappa_score,
+    'Jaccard': jaccard_score,
+    'RI': rand_score,
+    'ARI': adjusted_rand_score,
+    'MI': normalized_mutual_info_score,
+    'TPR': lambda gt, det: np.count_nonzero(gt & det) / np.count_nonzero(gt),
+    'PPV': lambda gt, det: np.count_nonzero(gt & det) / np.count_nonzero(det),
+    'VOI': lambda gt, det: get_binary_entropy(gt) + get_binary_entropy(det) - 2 * mutual_info_score(gt, det) /
+                           math.log(2),
+}
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('metric', list(SKLEARN_METRICS.keys()))
+def test_count_based_metrics_match_sklearn(metric, seed):
+    rng = np.random.default_rng(seed)
+    gt = rng.random(5000) < 0.2
+    detection = np.where(rng.random(5000) < 0.8, gt, rng.random(5000) < 0.1)
+    expected = SKLEARN_METRICS[metric](gt, detection)
+    assert compute_count_based_metric_value(metric, *get_confusion_counts(gt, detection)) == \
+           pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+def test_count_based_metrics_match_sklearn_for_a_perfect_detection():
+    gt = np.zeros(1000, dtype=bool)
+    gt[100:300] = True
+    counts = get_confusion_counts(gt, gt)
+    for metric in ['MCC', 'CKS', 'Jaccard', 'RI', 'ARI', 'MI']:
+        assert compute_count_based_metric_value(metric, *counts) == pytest.approx(SKLEARN_METRICS[metric](gt, gt))
+
+
+def test_undefined_kappa_is_reported_as_nan():
+    # A single class in both volumes gives an expected agreement of 1, for which sklearn returns NaN
+    for gt in [np.zeros(1000, dtype=bool), np.ones(1000, dtype=bool)]:
+        assert math.isnan(compute_count_based_metric_value('CKS', *get_confusion_counts(gt, gt)))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            assert math.isnan(cohen_kappa_score(gt, gt))
+
+
+def test_roc_auc_matches_sklearn():
+    rng = np.random.default_rng(3)
+    gt = rng.random(20000) < 0.3
+    # Probabilities at the centers of the histogram bins, such that only the equal values are ties
+    bins = rng.integers(0, 1000, 20000)
+    bins[gt] = np.minimum(bins[gt] + 200, 999)
+    probabilities = (bins + 0.5) / 1000.
+    inside_histogram, outside_histogram = compute_probability_histograms(gt, probabilities)
+    assert compute_probability_based_metric_value('AUC', inside_histogram, outside_histogram) == \
+           pytest.approx(roc_auc_score(gt, probabilities), rel=1e-12)
+
+
+def test_undefined_roc_auc_is_reported_as_inf():
+    probabilities = np.linspace(0., 1., 1000)
+    for gt in [np.zeros(1000, dtype=bool), np.ones(1000, dtype=bool)]:
+        inside_histogram, outside_histogram = compute_probability_histograms(gt, probabilities)
+        assert compute_probability_based_metric_value('AUC', inside_histogram, outside_histogram) == math.inf
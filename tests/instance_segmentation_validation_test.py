@@ -0,0 +1,95 @@
+import itertools
+import numpy as np
+import pytest
+from scipy.ndimage import label
+from skimage.measure import regionprops
+
+from raidionicsval.Validation.instance_segmentation_validation import label_objects, compute_objects_contingency,\
+    select_one_to_one_pairs
+
+
+def get_random_objects(seed, shape=(24, 20, 16), density=0.1):
+    rng = np.random.default_rng(seed)
+    binary_image = rng.random(shape) < density
+    # A few larger blobs among the noise
+    for _ in range(rng.integers(0, 4)):
+        corner = rng.integers(0, np.asarray(shape) - 5)
+        size = rng.integers(2, 6, 3)
+        binary_image[tuple([slice(c, c + s) for c, s in zip(corner, size)])] = True
+    return binary_image.astype('uint8')
+
+
+def label_objects_reference(binary_image, min_size):
+    # Removal of the small objects one at a time, and second labeling of the cleaned image
+    labels = label(binary_image)[0]
+    refined_image = labels.copy()
+    for c in range(1, np.max(labels) + 1):
+        if np.count_nonzero(labels == c) < min_size:
+            refined_image[refined_image == c] = 0
+    refined_image[refined_image != 0] = 1
+    labels = label(refined_image)[0]
+    return labels, regionprops(labels)
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('min_size', [0, 1, 3, 10])
+def test_label_objects_match_the_per_object_removal(seed, min_size):
+    binary_image = get_random_objects(seed)
+    labels, candidates = label_objects(binary_image, min_size)
+    reference_labels, reference_candidates = label_objects_reference(binary_image, min_size)
+    np.testing.assert_array_equal(labels, reference_labels)
+    assert len(candidates) == len(reference_candidates)
+    for candidate, reference in zip(candidates, reference_candidates):
+        assert candidate.label == reference.label
+        assert candidate.area == reference.area
+        assert candidate.slice == reference.slice
+        assert candidate.bbox == reference.bbox
+
+
+def test_label_objects_without_any_object():
+    labels, candidates = label_objects(np.zeros((5, 5, 5), dtype='uint8'), 3)
+    assert np.count_nonzero(labels) == 0
+    assert candidates == []
+    labels, candidates = label_objects(get_random_objects(0, density=0.05), 10**6)
+    assert np.count_nonzero(labels) == 0
+    assert candidates == []
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_objects_contingency_matches_the_pairwise_overlaps(seed):
+    gt_labels = label_objects(get_random_objects(seed), 3)[0]
+    detection_labels = label_objects(get_random_objects(seed + 100), 3)[0]
+    gt_values, det_values, counts = compute_objects_contingency(gt_labels, detection_labels)
+    reference = [[g, d, np.count_nonzero((gt_labels == g) & (detection_labels == d))]
+                 for g in range(1, np.max(gt_labels) + 1) for d in range(1, np.max(detection_labels) + 1)]
+    reference = [x for x in reference if x[2] != 0]
+    assert len(reference) != 0
+    assert np.stack([gt_values, det_values, counts], axis=1).tolist() == reference
+
+
+def test_objects_contingency_without_overlap():
+    gt_labels = np.zeros((4, 4, 4), dtype=np.int32)
+    detection_labels = np.zeros((4, 4, 4), dtype=np.int32)
+    gt_labels[0, 0, 0] = 1
+    detection_labels[3, 3, 3] = 1
+    for values in compute_objects_contingency(gt_labels, detection_labels):
+        assert len(values) == 0
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_one_to_one_pairs_maximize_the_sum_of_dices(seed):
+    rng = np.random.default_rng(seed)
+    pairs = sorted(set([(int(g), int(d)) for g, d in rng.integers(1, 5, (rng.integers(1, 9), 2))]))
+    gt_values = np.asarray([x[0] for x in pairs])
+    det_values = np.asarray([x[1] for x in pairs])
+    dices = rng.random(len(pairs))
+    selected = select_one_to_one_pairs(gt_values, det_values, dices)
+    assert len(np.unique(gt_values[selected])) == np.count_nonzero(selected)
+    assert len(np.unique(det_values[selected])) == np.count_nonzero(selected)
+
+    best = 0.
+    for subset in itertools.product([False, True], repeat=len(pairs)):
+        subset = np.asarray(subset)
+        if len(np.unique(gt_values[subset])) == len(np.unique(det_values[subset])) == np.count_nonzero(subset):
+            best = max(best, np.sum(dices[subset]))
+    assert np.sum(dices[selected]) == pytest.approx(best)
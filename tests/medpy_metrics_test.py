@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from raidionicsval.Computation.medpy_metrics import SurfaceDistances
+from raidionicsval.Validation.extra_metrics_computation import compute_surface_metric_value
+
+
+def get_synthetic_volumes(seed):
+    rng = np.random.default_rng(seed)
+    shape = (40, 36, 24)
+    zz, yy, xx = np.meshgrid(*[np.arange(s) for s in shape], indexing='ij')
+    reference = np.zeros(shape, dtype=bool)
+    result = np.zeros(shape, dtype=bool)
+    for _ in range(3):
+        center = rng.integers(8, 16, 3) + [10, 8, 0]
+        radius = rng.integers(3, 7)
+        reference |= ((zz - center[0]) ** 2 + (yy - center[1]) ** 2 + (xx - center[2]) ** 2) <= radius ** 2
+        center = center + rng.integers(-2, 3, 3)
+        result |= ((zz - center[0]) ** 2 + (yy - center[1]) ** 2 + (xx - center[2]) ** 2) <= (radius + 1) ** 2
+    # Isolated false positives, far from the reference
+    result[rng.integers(0, shape[0], 5), rng.integers(0, shape[1], 5), rng.integers(0, shape[2], 5)] = True
+    return result, reference
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('metric', ['HD95', 'HD100', 'ASSD', 'OASSD', 'SurfDice@1.0'])
+def test_kdtree_and_edt_backends_match_isotropic(metric, seed):
+    result, reference = get_synthetic_volumes(seed)
+    values = [compute_surface_metric_value(metric, SurfaceDistances(result, reference, voxelspacing=(1., 1., 1.),
+                                                                    backend=backend))
+              for backend in ['kdtree', 'edt']]
+    assert values[0] == values[1]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('metric', ['HD95', 'HD100', 'ASSD', 'OASSD', 'SurfDice@1.0'])
+def test_kdtree_and_edt_backends_match_anisotropic(metric, seed):
+    # Equally close voxels might differ in the last floating-point digit with an anisotropic spacing
+    result, reference = get_synthetic_volumes(seed)
+    values = [compute_surface_metric_value(metric, SurfaceDistances(result, reference, voxelspacing=(0.8, 0.8, 1.5),
+                                                                    backend=backend))
+              for backend in ['kdtree', 'edt']]
+    assert values[0] == pytest.approx(values[1], rel=1e-12)
+
+
+def test_kdtree_and_edt_backends_match_per_voxel():
+    result, reference = get_synthetic_volumes(3)
+    kdtree = SurfaceDistances(result, reference, voxelspacing=(1., 1., 1.), backend='kdtree')
+    edt = SurfaceDistances(result, reference, voxelspacing=(1., 1., 1.), backend='edt')
+    np.testing.assert_array_equal(kdtree.result_surface_distances, edt.result_surface_distances)
+    np.testing.assert_array_equal(kdtree.reference_surface_distances, edt.reference_surface_distances)
+    np.testing.assert_array_equal(kdtree.result_volume_distances, edt.result_volume_distances)
+    np.testing.assert_array_equal(kdtree.reference_volume_distances, edt.reference_volume_distances)
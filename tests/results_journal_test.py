@@ -0,0 +1,71 @@
+import os
+import pandas as pd
+
+from raidionicsval.Utils.results_journal import ResultsJournal
+
+COLUMNS = ['Fold', 'Patient', 'Threshold', 'PiW Dice']
+
+
+def test_truncated_last_commit_is_discarded(tmp_path):
+    filename = str(tmp_path / 'all_dice_scores.csv')
+    journal = ResultsJournal(filename, COLUMNS)
+    journal.set_row([0, 'Pat001', 0.5, 0.8])
+    journal.commit()
+    journal.set_row([0, 'Pat002', 0.5, 0.6])
+    journal.commit()
+    # Crash while the second commit was being written
+    with open(filename + '.journal', 'r') as f:
+        lines = f.readlines()
+    with open(filename + '.journal', 'w') as f:
+        f.write(lines[0] + lines[1][:len(lines[1]) // 2])
+
+    journal = ResultsJournal(filename, COLUMNS)
+    assert journal.get_row(0, 'Pat001', 0.5)[3] == 0.8
+    assert journal.get_row(0, 'Pat002', 0.5) is None
+    assert not os.path.exists(filename + '.journal')
+    assert len(pd.read_csv(filename)) == 1
+
+
+def test_resume_adding_a_metric(tmp_path):
+    filename = str(tmp_path / 'all_dice_scores.csv')
+    journal = ResultsJournal(filename, COLUMNS)
+    journal.set_row([0, 'Pat001', 0.5, 0.8])
+    journal.set_row([0, 'Pat001', 0.6, 0.7])
+    journal.compact()
+
+    # Second run with an extra metric, interrupted before the compaction
+    journal = ResultsJournal(filename, COLUMNS + ['HD95'])
+    assert journal.get_row(0, 'Pat001', 0.5)[4] is None
+    journal.set_values(0, 'Pat001', 0.5, {'HD95': 3.2, 'ASSD': 1.1})
+    journal.commit()
+
+    journal = ResultsJournal(filename, COLUMNS + ['HD95'])
+    assert journal.columns == COLUMNS + ['HD95', 'ASSD']
+    assert journal.get_row(0, 'Pat001', 0.5)[3:] == [0.8, 3.2, 1.1]
+    assert journal.get_row(0, 'Pat001', 0.6)[3] == 0.7
+    results_df = pd.read_csv(filename)
+    assert list(results_df.columns) == COLUMNS + ['HD95', 'ASSD']
+    assert list(results_df['Threshold']) == [0.5, 0.6]
+
+
+def test_recommits_are_idempotent(tmp_path):
+    filename = str(tmp_path / 'all_dice_scores.csv')
+    journal = ResultsJournal(filename, COLUMNS)
+    journal.set_row([1, 'Pat002', 0.5, 0.4])
+    journal.set_row([1, 'Pat001', 0.5, 0.9])
+    journal.commit()
+    journal.set_row([1, 'Pat002', 0.5, 0.6])
+    journal.set_row([1, 'Pat002', 0.5, 0.6])
+    journal.commit()
+    journal.commit()
+    with open(filename + '.journal', 'r') as f:
+        journal_lines = f.readlines()
+    # The same commits replayed twice, e.g., after a crash during a resumed run
+    with open(filename + '.journal', 'w') as f:
+        f.writelines(journal_lines + journal_lines)
+
+    journal = ResultsJournal(filename, COLUMNS)
+    expected = [[1, 'Pat002', 0.5, 0.6], [1, 'Pat001', 0.5, 0.9]]
+    assert journal.to_dataframe().values.tolist() == expected
+    assert pd.read_csv(filename).values.tolist() == expected
+    assert ResultsJournal(filename, COLUMNS).to_dataframe().values.tolist() == expected
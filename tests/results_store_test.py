@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from raidionicsval.Utils.results_store import to_typed_results, write_results_table, read_results_table
+
+COLUMNS = ['Fold', 'Patient', 'Threshold', 'PiW Dice', 'True Positive', 'HD95']
+
+
+def write_csv_and_typed(tmp_path, rows, results_format):
+    # Rows as strings, the way the results journal holds them
+    filename = str(tmp_path / 'all_dice_scores.csv')
+    write_results_table(pd.DataFrame(np.asarray(rows, dtype=str), columns=COLUMNS), filename, formats=['csv'])
+    csv_df = pd.read_csv(filename)
+    write_results_table(csv_df, filename, formats=[results_format])
+    # The columnar file is only preferred when at least as recent as the csv file
+    stats = os.stat(filename)
+    os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns - 10**9))
+    return filename, csv_df
+
+
+@pytest.mark.parametrize('results_format', ['feather', 'parquet'])
+def test_class_averaged_true_positive_round_trip(tmp_path, results_format):
+    rows = [[0, 'Pat001', 0.5, 0.8, 1.0, 3.2], [0, 'Pat002', 0.5, 0.4, 0.5, 'inf'], [1, 'Pat003', 0.5, 0., 0., 'nan']]
+    filename, csv_df = write_csv_and_typed(tmp_path, rows, results_format)
+    typed_df = read_results_table(filename)
+    assert typed_df['True Positive'].dtype == 'float64'
+    assert list(typed_df['True Positive']) == [1., 0.5, 0.]
+    assert list(typed_df['Fold']) == [0, 0, 1]
+    assert list(typed_df['Patient']) == ['Pat001', 'Pat002', 'Pat003']
+    np.testing.assert_array_equal(typed_df['HD95'], [3.2, np.inf, np.nan])
+    pd.testing.assert_frame_equal(typed_df, csv_df, check_dtype=False)
+
+
+@pytest.mark.parametrize('results_format', ['feather', 'parquet'])
+def test_class_true_positive_round_trip(tmp_path, results_format):
+    rows = [[0, 'Pat001', 0.5, 0.8, True, 3.2], [0, 'Pat002', 0.5, 0., False, 'nan']]
+    filename, csv_df = write_csv_and_typed(tmp_path, rows, results_format)
+    typed_df = read_results_table(filename)
+    assert typed_df['True Positive'].dtype == 'bool'
+    assert list(typed_df['True Positive']) == [True, False]
+    pd.testing.assert_frame_equal(typed_df, csv_df, check_dtype=False)
+
+
+def test_missing_true_positive_flags():
+    typed_df = to_typed_results(pd.DataFrame({'True Positive': ['True', None, 'False']}))
+    assert list(typed_df['True Positive']) == [True, None, False]
+    typed_df = to_typed_results(pd.DataFrame({'True Positive': ['0.5', None, '1.0']}))
+    np.testing.assert_array_equal(typed_df['True Positive'], [0.5, np.nan, 1.])
@@ -7,6 +7,8 @@ import sys
 import subprocess
 import traceback
 import zipfile
+import argparse
+import pandas as pd
 
 try:
     import requests
@@ -15,10 +17,10 @@ except:
     import requests
 
 
-def validation_pipeline_test():
+def validation_pipeline_test(number_processes: int = 1):
     logging.basicConfig()
     logging.getLogger().setLevel(logging.DEBUG)
-    logging.info("Running standard reporting unit test.\n")
+    logging.info("Running standard reporting unit test with {} process(es).\n".format(number_processes))
     logging.info("Downloading unit test resources.\n")
     test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_results_dir')
     if os.path.exists(test_dir):
@@ -52,7 +54,7 @@ def validation_pipeline_test():
         val_config.add_section('Default')
         val_config.set('Default', 'task', 'validation')
         val_config.set('Default', 'data_root', os.path.join(test_dir, 'Input_dataset'))
-        val_config.set('Default', 'number_processes', "1")
+        val_config.set('Default', 'number_processes', str(number_processes))
         val_config.add_section('Validation')
         val_config.set('Validation', 'input_folder', os.path.join(test_dir, 'StudyResults'))
         val_config.set('Validation', 'output_folder', os.path.join(test_dir, 'StudyResults'))
@@ -78,7 +80,7 @@ def validation_pipeline_test():
 
         logging.info("Collecting and comparing results.\n")
         scores_filename = os.path.join(test_dir, 'StudyResults', 'Validation', 'all_dice_scores.csv')
-        if not os.path.exists(scores_filename):
+        if not os.path.exists(scores_filename) or len(pd.read_csv(scores_filename)) == 0:
             logging.error("k-fold cross-validation unit test failed, no scores were generated.\n")
             shutil.rmtree(test_dir)
             raise ValueError("k-fold cross-validation unit test failed, no scores were generated.\n")
@@ -105,7 +107,7 @@ def validation_pipeline_test():
 
         logging.info("Collecting and comparing results.\n")
         scores_filename = os.path.join(test_dir, 'StudyResults', 'Validation', 'all_dice_scores.csv')
-        if not os.path.exists(scores_filename):
+        if not os.path.exists(scores_filename) or len(pd.read_csv(scores_filename)) == 0:
             logging.error("k-fold cross-validation CLI unit test failed, no scores were generated.\n")
             shutil.rmtree(test_dir)
             raise ValueError("k-fold cross-validation CLI unit test failed, no scores were generated.\n")
@@ -119,4 +121,9 @@ def validation_pipeline_test():
     shutil.rmtree(test_dir)
 
 
-validation_pipeline_test()
+if __name__ == '__main__':
+    # The guard is required for the pool processes started with spawn (macOS and Windows), which import this module
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=1, help='Number of processes used for the validation')
+    args = parser.parse_args()
+    validation_pipeline_test(number_processes=args.processes)
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+
+from raidionicsval.Utils.volume_cache import VolumeCache
+
+
+def load_counting(cache, filename, calls):
+    def decoder():
+        calls.append(filename)
+        return np.frombuffer(open(filename, 'rb').read(), dtype='uint8').copy()
+    return cache.load(filename, 'raw', decoder)
+
+
+def test_hits_are_keyed_on_path_size_and_modification_time(tmp_path):
+    filename = str(tmp_path / 'volume.bin')
+    with open(filename, 'wb') as f:
+        f.write(bytes(range(100)))
+    cache = VolumeCache(str(tmp_path / 'cache'))
+    calls = []
+    first = load_counting(cache, filename, calls)
+    second = load_counting(cache, filename, calls)
+    assert len(calls) == 1
+    np.testing.assert_array_equal(first, second)
+
+    # A modified file (new modification time) leads to a new entry
+    stats = os.stat(filename)
+    with open(filename, 'wb') as f:
+        f.write(bytes(range(1, 101)))
+    os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns + 10**9))
+    assert load_counting(cache, filename, calls)[0] == 1
+    assert len(calls) == 2
+
+
+def test_content_hash_detects_changes_keeping_the_modification_time(tmp_path):
+    filename = str(tmp_path / 'volume.bin')
+    with open(filename, 'wb') as f:
+        f.write(bytes(range(100)))
+    stats = os.stat(filename)
+    calls = []
+    cache = VolumeCache(str(tmp_path / 'cache'))
+    hashed_cache = VolumeCache(str(tmp_path / 'hashed_cache'), content_hash=True)
+    load_counting(cache, filename, calls)
+    load_counting(hashed_cache, filename, calls)
+
+    with open(filename, 'wb') as f:
+        f.write(bytes(range(1, 101)))
+    os.utime(filename, ns=(stats.st_atime_ns, stats.st_mtime_ns))
+    # Same path, size, and modification time: only the content hash tells the files apart
+    assert load_counting(cache, filename, calls)[0] == 0
+    assert load_counting(hashed_cache, filename, calls)[0] == 1
+    assert len(calls) == 3
+
+
+def test_entries_which_cannot_be_removed_are_skipped_upon_eviction(tmp_path, monkeypatch):
+    cache = VolumeCache(str(tmp_path / 'cache'), max_size=0.0025)
+    filenames = []
+    for i in range(3):
+        filenames.append(str(tmp_path / 'volume{}.bin'.format(i)))
+        with open(filenames[-1], 'wb') as f:
+            f.write(bytes([i]) * 1000)
+    calls = []
+    load_counting(cache, filenames[0], calls)
+    load_counting(cache, filenames[1], calls)
+    locked_entries = os.listdir(str(tmp_path / 'cache'))
+    assert len(locked_entries) == 2
+
+    # The least recently used entry cannot be removed, e.g., still memory-mapped on Windows
+    stats = os.stat(str(tmp_path / 'cache' / locked_entries[0]))
+    for entry in locked_entries:
+        os.utime(str(tmp_path / 'cache' / entry), ns=(stats.st_atime_ns, stats.st_mtime_ns - 10**9))
+    os.utime(str(tmp_path / 'cache' / locked_entries[0]), ns=(stats.st_atime_ns, stats.st_mtime_ns - 2 * 10**9))
+    remove = os.remove
+
+    def failing_remove(path):
+        if os.path.basename(path) == locked_entries[0]:
+            raise PermissionError(path)
+        remove(path)
+    monkeypatch.setattr(os, 'remove', failing_remove)
+    load_counting(cache, filenames[2], calls)
+    entries = os.listdir(str(tmp_path / 'cache'))
+    assert len(entries) == 2
+    assert locked_entries[0] in entries and locked_entries[1] not in entries